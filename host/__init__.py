@@ -0,0 +1,8 @@
+# coding: utf-8
+# host-side tools (CPython on Linux/macOS), they share the pipeline modules in src/ with the device
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
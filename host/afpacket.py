@@ -0,0 +1,143 @@
+# coding: utf-8
+# linux capture backend: an AF_PACKET socket with a memory mapped TPACKET_V3 rx ring. the kernel fills whole
+# blocks of frames, a burst is one block and its frames are memoryviews into the ring, nothing is copied.
+# needs CAP_NET_RAW (root), see host.live
+import mmap
+import select
+import socket
+import struct
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from capture import CaptureBackend
+
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_MR_PROMISC = 1
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_block_desc: version, offset_to_priv, then struct tpacket_hdr_v1
+BLOCK_STATUS = 8
+BLOCK_NUM_PKTS = 12
+BLOCK_FIRST_PKT = 16
+BLOCK_LEN = 20
+# struct tpacket3_hdr up to tp_mac: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac
+PACKET_HEADER = struct.Struct('IIIIIIH')
+U32 = struct.Struct('I')
+
+
+class AfPacketCapture(CaptureBackend):
+    # block_timeout_ms: the kernel hands over a block which is not full after that long, so a quiet network
+    # still sees its frames promptly
+    def __init__(self, interface, block_size=1 << 20, block_count=64, frame_size=2048, block_timeout_ms=10, promiscuous=True):
+        super().__init__(0)  # self.frames grows to the largest block seen
+        self.interface = interface
+        self.block_size = block_size
+        self.block_count = block_count
+        self.frame_size = frame_size
+        self.block_timeout_ms = block_timeout_ms
+        self.promiscuous = promiscuous
+        self._socket = None
+        self._ring = None
+        self._view = None
+        self._poll = None
+        self._block = 0  # next block to read
+        self._held = -1  # block handed out by the last burst, returned to the kernel by the next one
+        # capture timestamp of each frame of the burst
+        self.timestamps = []
+
+    def start(self):
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            # struct tpacket_req3: block size and count, frame size and count, retire timeout, priv size, features
+            frame_count = self.block_size // self.frame_size * self.block_count
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack('IIIIIII', self.block_size, self.block_count, self.frame_size,
+                                                                    frame_count, self.block_timeout_ms, 0, 0))
+            self._ring = mmap.mmap(sock.fileno(), self.block_size * self.block_count, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            sock.bind((self.interface, ETH_P_ALL))
+            if self.promiscuous:
+                # struct packet_mreq: ifindex, type, address length, address
+                sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP,
+                                struct.pack('iHH8s', socket.if_nametoindex(self.interface), PACKET_MR_PROMISC, 0, b''))
+        except OSError:
+            sock.close()
+            raise
+        self._socket = sock
+        self._view = memoryview(self._ring)
+        self._poll = select.poll()
+        self._poll.register(sock, select.POLLIN | select.POLLERR)
+
+    def stop(self):
+        if self._socket is None:
+            return
+        self.kernel_drops()
+        self.frames = [None] * len(self.frames)
+        self._view.release()
+        try:
+            self._ring.close()
+        except BufferError:
+            pass  # frames are still referenced, the mapping is released with the last of them
+        self._socket.close()
+        self._socket = None
+
+    def kernel_drops(self):
+        # struct tpacket_stats_v3: packets, drops, freeze_q_cnt. reading them resets them
+        _, drops, _ = struct.unpack('III', self._socket.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+        self.dropped_frames += drops
+        return drops
+
+    def _ready(self, block):
+        return U32.unpack_from(self._ring, block * self.block_size + BLOCK_STATUS)[0] & TP_STATUS_USER
+
+    def wait(self, timeout):
+        if not self._ready(self._block):
+            self._poll.poll(int(timeout * 1000))
+
+    def next_burst(self):
+        ring = self._ring
+        if self._held >= 0:
+            U32.pack_into(ring, self._held * self.block_size + BLOCK_STATUS, TP_STATUS_KERNEL)
+            self._held = -1
+        block = self._block
+        self.burst_frames = 0
+        self.burst_bytes = 0
+        if not self._ready(block):
+            self.backlog_bytes = 0
+            self.remaining_bytes = 0
+            return 0
+        start = block * self.block_size
+        count = U32.unpack_from(ring, start + BLOCK_NUM_PKTS)[0]
+        if count > len(self.frames):
+            self.frames.extend([None] * (count - len(self.frames)))
+            self.timestamps.extend([0.0] * (count - len(self.timestamps)))
+        frames = self.frames
+        timestamps = self.timestamps
+        view = self._view
+        unpack_from = PACKET_HEADER.unpack_from
+        offset = start + U32.unpack_from(ring, start + BLOCK_FIRST_PKT)[0]
+        for i in range(count):
+            next_offset, sec, nsec, snaplen, _, _, mac = unpack_from(ring, offset)
+            frames[i] = view[offset + mac:offset + mac + snaplen]
+            timestamps[i] = sec + nsec * 1e-9
+            offset += next_offset
+        self._held = block
+        self._block = (block + 1) % self.block_count
+        self.burst_frames = count
+        self.burst_bytes = U32.unpack_from(ring, start + BLOCK_LEN)[0]
+        # the blocks filled behind this one
+        ready = 1
+        while ready < self.block_count and self._ready((block + ready) % self.block_count):
+            ready += 1
+        self.backlog_bytes = self.burst_bytes + (ready - 1) * self.block_size
+        self.remaining_bytes = self.backlog_bytes - self.burst_bytes
+        if ready == self.block_count:
+            # no block left to the kernel, it dropped what arrived meanwhile
+            self.full_bursts += 1
+            self.kernel_drops()
+        return count
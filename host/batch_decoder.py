@@ -0,0 +1,274 @@
+# coding: utf-8
+# vectorized header decoding for large captures (requires numpy), produces the same aggregates as PacketStats with
+# the default decoder layers:
+#   python -m host.batch_decoder capture.pcapng --config src/config.json
+import argparse
+import itertools
+import json
+
+import numpy as np
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from config import Config
+from decoder import format_ip_addr, format_mac_addr
+from mapper import Mapper
+
+from host.pcap import CaptureReader
+
+HEADER_SIZE = 64  # enough for ethernet + ipv4 (with options) + icmp, or ethernet + ipv6 + icmpv6
+
+TYPE_UNKNOWN = 0
+TYPE_IPV4 = 1
+TYPE_IPV6 = 2
+TYPE_ARP = 3
+TYPE_NAMES = ('unknown', 'ipv4', 'ipv6', 'arp')
+
+PACKET_DTYPE = np.dtype([
+    ('ts', 'f8'),
+    ('length', 'u4'),
+    ('dst_mac', 'u8'),
+    ('src_mac', 'u8'),
+    ('eth_proto', 'u2'),
+    ('type', 'u1'),
+    ('ip_proto', 'u1'),
+    ('ttl', 'u1'),
+    ('src_ip', 'u4'),  # ipv4 only
+    ('dst_ip', 'u4'),
+    ('icmp_type', 'i2'),  # -1 when not icmp/icmpv6
+    ('icmp_code', 'i2'),
+    ('arp_opcode', 'u2'),
+])
+
+_COLUMNS = np.arange(HEADER_SIZE)
+# as registered in src/dissectors.py
+_ICMP_PROTOCOLS = (1, 58)
+_IPV6_EXTENSION_HEADERS = (0, 43, 60)
+_IPV6_FRAGMENT = 44
+
+
+def gather_headers(buffer, offsets, lengths, size=HEADER_SIZE):
+    # copies the first size bytes of every frame out of the (memory mapped) capture in one step
+    columns = _COLUMNS if size == HEADER_SIZE else np.arange(size)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    index = offsets[:, None] + columns
+    valid = columns < lengths[:, None]
+    return np.where(valid, data[np.minimum(index, len(data) - 1)], 0).astype(np.uint8)
+
+
+def _be(headers, start, size):
+    value = np.zeros(len(headers), dtype=np.uint64)
+    for i in range(size):
+        value = (value << np.uint64(8)) | headers[:, start + i].astype(np.uint64)
+    return value
+
+
+def _at(headers, rows, positions):
+    # one byte per row at a per row position, 0 past the header window
+    width = headers.shape[1]
+    return np.where(positions < width, headers[rows, np.minimum(positions, width - 1)], 0).astype(np.int64)
+
+
+def _ipv6_upper_layer(headers, lengths, rows):
+    # the extension header walk of dissectors._ipv6: (ip_proto, upper layer offset, whether there is an upper
+    # layer header, whether the walk needs bytes past the header window) of every row
+    width = headers.shape[1]
+    row_lengths = lengths[rows].astype(np.int64)
+    next_header = headers[rows, 20].astype(np.int64)
+    offset = np.full(len(rows), 54, dtype=np.int64)
+    upper = np.ones(len(rows), dtype=bool)
+    beyond = np.zeros(len(rows), dtype=bool)
+    active = np.ones(len(rows), dtype=bool)
+    for _ in range(4):
+        extension = active & np.isin(next_header, _IPV6_EXTENSION_HEADERS) & (row_lengths >= offset + 2)
+        fragment = active & (next_header == _IPV6_FRAGMENT) & (row_lengths >= offset + 8)
+        beyond |= (extension & (offset + 2 > width)) | (fragment & (offset + 8 > width))
+        active = (extension | fragment) & ~beyond
+        if not active.any():
+            break
+        later = active & fragment & ((((_at(headers, rows, offset + 2) << 8) | _at(headers, rows, offset + 3)) & 0xFFF8) != 0)
+        next_header = np.where(active, _at(headers, rows, offset), next_header)
+        offset = np.where(active & extension, offset + ((_at(headers, rows, offset + 1) + 1) << 3), np.where(active & ~later, offset + 8, offset))
+        upper &= ~later
+        active &= ~later
+    return next_header, offset, upper, beyond
+
+
+def decode_headers(headers, lengths, timestamps=None, fetch=None):
+    # headers: (n, HEADER_SIZE) uint8 array, returns a PACKET_DTYPE structured array with the fields decode_packet_record
+    # fills with the default layers. frames whose ip options or ipv6 extension headers reach past the header window
+    # are decoded again from fetch(rows, size), the first size bytes of those rows. without fetch they are decoded
+    # as far as the window goes
+    n = len(headers)
+    width = headers.shape[1]
+    lengths = np.asarray(lengths).astype(np.int64)
+    packets = np.zeros(n, dtype=PACKET_DTYPE)
+    if timestamps is not None:
+        packets['ts'] = timestamps
+    packets['length'] = lengths
+    packets['icmp_type'] = -1
+    packets['icmp_code'] = -1
+    ethernet = lengths >= 14
+    packets['dst_mac'] = np.where(ethernet, _be(headers, 0, 6), 0)
+    packets['src_mac'] = np.where(ethernet, _be(headers, 6, 6), 0)
+    eth_proto = _be(headers, 12, 2).astype(np.uint16)
+    packets['eth_proto'] = np.where(ethernet, eth_proto, 0)
+    beyond = np.zeros(n, dtype=bool)
+
+    ipv4 = ethernet & (eth_proto == 0x0800) & (lengths >= 34) & (headers[:, 14] >> 4 == 4)
+    packets['type'][ipv4] = TYPE_IPV4
+    packets['ttl'][ipv4] = headers[ipv4, 22]
+    packets['ip_proto'][ipv4] = headers[ipv4, 23]
+    packets['src_ip'][ipv4] = _be(headers[ipv4], 26, 4)
+    packets['dst_ip'][ipv4] = _be(headers[ipv4], 30, 4)
+    # only the first fragment carries the transport header
+    header_length = (headers[:, 14] & 0x0F).astype(np.int64) << 2
+    first_fragment = ((headers[:, 20] & 0x1F) | headers[:, 21]) == 0
+    icmp_offset = 14 + header_length
+    icmp = ipv4 & (header_length >= 20) & first_fragment & np.isin(headers[:, 23], _ICMP_PROTOCOLS) & (lengths >= icmp_offset + 2)
+    beyond |= icmp & (icmp_offset + 2 > width)
+    rows = np.nonzero(icmp & ~beyond)[0]
+    packets['icmp_type'][rows] = headers[rows, icmp_offset[rows]]
+    packets['icmp_code'][rows] = headers[rows, icmp_offset[rows] + 1]
+
+    ipv6 = ethernet & (eth_proto == 0x86DD) & (lengths >= 54) & (headers[:, 14] >> 4 == 6)
+    packets['type'][ipv6] = TYPE_IPV6
+    packets['ttl'][ipv6] = headers[ipv6, 21]
+    rows = np.nonzero(ipv6)[0]
+    ip_proto, offset, upper, ipv6_beyond = _ipv6_upper_layer(headers, lengths, rows)
+    packets['ip_proto'][rows] = ip_proto
+    icmp6 = upper & np.isin(ip_proto, _ICMP_PROTOCOLS) & (lengths[rows] >= offset + 2)
+    ipv6_beyond |= icmp6 & (offset + 2 > width)
+    beyond[rows] = ipv6_beyond
+    icmp6 &= ~ipv6_beyond
+    packets['icmp_type'][rows[icmp6]] = _at(headers, rows[icmp6], offset[icmp6])
+    packets['icmp_code'][rows[icmp6]] = _at(headers, rows[icmp6], offset[icmp6] + 1)
+
+    arp = ethernet & (eth_proto == 0x0806)
+    packets['type'][arp] = TYPE_ARP
+    arp_opcode = arp & (lengths >= 22)
+    packets['arp_opcode'][arp_opcode] = _be(headers[arp_opcode], 20, 2)
+
+    rows = np.nonzero(beyond)[0]
+    if len(rows) and fetch is not None:
+        packets[rows] = decode_headers(fetch(rows, int(lengths[rows].max())), lengths[rows], packets['ts'][rows])
+    return packets
+
+
+def decode_capture(reader, chunk_size=1 << 18):
+    # yields PACKET_DTYPE arrays of at most chunk_size packets for an open CaptureReader
+    index = reader.index()
+    while True:
+        chunk = list(itertools.islice(index, chunk_size))
+        if not chunk:
+            return
+        timestamps, offsets, lengths = (np.array(column) for column in zip(*chunk))
+        offsets = offsets.astype(np.int64)
+        lengths = lengths.astype(np.int64)
+        headers = gather_headers(reader.buffer, offsets, lengths)
+        yield decode_headers(headers, lengths, timestamps,
+                             fetch=lambda rows, size: gather_headers(reader.buffer, offsets[rows], lengths[rows], size))
+
+
+def _mac_bytes(value):
+    return int(value).to_bytes(6, 'big')
+
+
+class BatchStats:
+    # grouped-array equivalent of PacketStats, accumulated chunk by chunk
+    def __init__(self, mapper=None, map_unknown_to=''):
+        self.mapper = mapper
+        self.map_unknown_to = map_unknown_to
+        self.packets_count = 0
+        self.packet_types = {}
+        self.flows = {}  # (src_mac, dst_mac) as ints -> {'packets_count', 'packet_types', 'src_ip', 'dst_ip'}
+
+    def update(self, packets):
+        self.packets_count += len(packets)
+        types, type_counts = np.unique(packets['type'], return_counts=True)
+        for packet_type, count in zip(types, type_counts):
+            name = TYPE_NAMES[packet_type]
+            self.packet_types[name] = self.packet_types.get(name, 0) + int(count)
+
+        pairs = np.stack([packets['src_mac'], packets['dst_mac']], axis=1)
+        unique_pairs, inverse, counts = np.unique(pairs, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        flows = []
+        for (src_mac, dst_mac), count in zip(unique_pairs.tolist(), counts.tolist()):
+            flow = self.flows.get((src_mac, dst_mac))
+            if flow is None:
+                flow = self.flows[(src_mac, dst_mac)] = {'packets_count': 0, 'packet_types': {}, 'src_ip': None, 'dst_ip': None}
+            flow['packets_count'] += count
+            flows.append(flow)
+
+        # per flow and type counts, unknown types are keyed by ethertype like PacketStats does
+        known = packets['type'] != TYPE_UNKNOWN
+        type_key = np.where(known, packets['type'].astype(np.int64), packets['eth_proto'].astype(np.int64) + len(TYPE_NAMES))
+        grouped, grouped_counts = np.unique(inverse.astype(np.int64) * (0x10000 + len(TYPE_NAMES)) + type_key, return_counts=True)
+        for key, count in zip(grouped.tolist(), grouped_counts.tolist()):
+            flow_idx, type_code = divmod(key, 0x10000 + len(TYPE_NAMES))
+            name = TYPE_NAMES[type_code] if type_code < len(TYPE_NAMES) else f"{type_code - len(TYPE_NAMES):x}"
+            flow_types = flows[flow_idx]['packet_types']
+            flow_types[name] = flow_types.get(name, 0) + count
+
+        # last seen ips: the last ipv4 packet of every flow in this chunk
+        ipv4_rows = np.nonzero(packets['type'] == TYPE_IPV4)[0]
+        if len(ipv4_rows):
+            reversed_rows = ipv4_rows[::-1]
+            flow_ids, first = np.unique(inverse[reversed_rows], return_index=True)
+            last_rows = reversed_rows[first]
+            for flow_idx, row in zip(flow_ids.tolist(), last_rows.tolist()):
+                flows[flow_idx]['src_ip'] = int(packets['src_ip'][row])
+                flows[flow_idx]['dst_ip'] = int(packets['dst_ip'][row])
+
+    def _device(self, mac):
+        if self.mapper is None:
+            return self.map_unknown_to
+        return self.mapper.map_raw_to_name(mac, self.map_unknown_to)
+
+    def top_flows(self, count=None):
+        # flows formatted like PacketStats.top_flows() entries, ordered by packets count
+        ordered = sorted(self.flows.items(), key=lambda item: item[1]['packets_count'], reverse=True)
+        result = []
+        for (src_mac, dst_mac), flow in ordered[:count]:
+            src_raw, dst_raw = _mac_bytes(src_mac), _mac_bytes(dst_mac)
+            result.append({
+                'src_mac': format_mac_addr(src_raw),
+                'src_device': self._device(src_raw),
+                'dst_mac': format_mac_addr(dst_raw),
+                'dst_device': self._device(dst_raw),
+                'packets_count': flow['packets_count'],
+                'packet_types': flow['packet_types'],
+                'src_ip': format_ip_addr(int(flow['src_ip']).to_bytes(4, 'big')) if flow['src_ip'] is not None else '',
+                'dst_ip': format_ip_addr(int(flow['dst_ip']).to_bytes(4, 'big')) if flow['dst_ip'] is not None else '',
+            })
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode a pcap/pcapng capture in bulk and print PacketStats-like aggregates")
+    parser.add_argument("capture", help="pcap or pcapng file, ethernet link type")
+    parser.add_argument("--config", default=None, help="config.json, used to map mac addresses to device names")
+    parser.add_argument("--chunk-size", type=int, default=1 << 18, help="packets decoded per batch")
+    parser.add_argument("--top", type=int, default=20, help="number of flows to print")
+    args = parser.parse_args(argv)
+
+    mapper = None
+    if args.config:
+        config = Config(args.config)
+        config.load()
+        mapper = Mapper(config.mac_address_to_devices())
+
+    stats = BatchStats(mapper)
+    with CaptureReader(args.capture) as reader:
+        for packets in decode_capture(reader, chunk_size=args.chunk_size):
+            stats.update(packets)
+
+    print(json.dumps({
+        "packets_count": stats.packets_count,
+        "packet_types": stats.packet_types,
+        "stats": stats.top_flows(args.top),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# coding: utf-8
+# per-stage benchmarks of the packet pipeline on synthetic traffic:
+#   python -m host.bench --config config-sample.json --output bench.json [--baseline previous.json]
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from config import Config
+from decoder import PacketRecord, decode_packet, decode_packet_record
+from dissectors import Decoder
+from features import FeatureExtractor
+from frame_filter import FrameFilter
+from metrics import Metrics
+from inference import SimpleRuleEngine
+from model_engine import QuantizedModel, QuantizedModelEngine
+
+from host.replay import ReplayClock, build_pipeline
+from host.synthetic import SyntheticTraffic
+from host.train_model import random_model
+
+
+class Stage:
+    def __init__(self, name, fn, items):
+        self.name = name
+        self.fn = fn
+        self.items = items
+
+
+def build_model_engine(config, clock, model=None):
+    return QuantizedModelEngine(QuantizedModel(model or random_model()), config.tracking_devices(), window_sec=60, clock=clock)
+
+
+def build_stages(config, frames, model=None):
+    clock = ReplayClock(1000.0)
+    pipeline = build_pipeline(config, clock)
+    mapper, stats, inference_engine = pipeline.mapper, pipeline.stats, pipeline.inference_engine
+
+    # every stage after decode gets its own, already prepared, records
+    decoded = [decode_packet_record(frame) for frame in frames]
+    mapped = [decode_packet_record(frame) for frame in frames]
+    for record in mapped:
+        mapper.map_record(record, map_unknown_to='')
+
+    def inference_update(record):
+        clock.now += 0.01
+        inference_engine.update(record, clock.now)
+
+    features = FeatureExtractor(devices=config.tracking_devices(), window_sec=60, clock=clock)
+
+    def features_update(record):
+        clock.now += 0.01
+        features.update(record, clock.now)
+
+    model_engine = build_model_engine(config, clock, model)
+
+    def model_update(record):
+        # feature accumulation per packet, plus the window evaluations amortized over the packets of a window
+        clock.now += 0.01
+        model_engine.update(record, clock.now)
+
+    def model_window(_):
+        # one batch evaluation of every tracked device, what a window boundary costs
+        model_engine._batch_count = len(model_engine._batch_devices)
+        model_engine._evaluate(clock.now)
+
+    def inference_tick(_):
+        clock.now += 0.01
+        inference_engine.tick(clock.now)
+
+    loop_state = {'next_tick': clock.now}
+
+    def loop_body(frame):
+        # mirrors the code.py capture and presence tasks for a single frame, without the network i/o
+        clock.now += 0.01
+        now = clock()
+        pipeline.process(frame, now)
+        if now >= loop_state['next_tick']:
+            inference_engine.tick(now)
+            loop_state['next_tick'] = now + 1
+
+    frame_filter = FrameFilter.from_config({'enabled': True}, config.mac_address_to_devices(), config.tracking_devices(field='mac'))
+    filtered_pipeline = build_pipeline(config, clock)
+    filtered_pipeline.frame_filter = frame_filter
+
+    def filtered_loop_body(frame):
+        clock.now += 0.01
+        filtered_pipeline.process(frame, clock.now)
+
+    timed_pipeline = build_pipeline(config, clock, metrics=Metrics())
+
+    def timed_loop_body(frame):
+        clock.now += 0.01
+        timed_pipeline.process(frame, clock.now)
+
+    record = PacketRecord()
+    all_layers = Decoder()
+    return [
+        Stage('decode_packet', decode_packet, frames),
+        Stage('decode_packet_record', lambda frame: decode_packet_record(frame, record), frames),
+        Stage('decode_all_layers', lambda frame: decode_packet_record(frame, record, all_layers), frames),
+        Stage('map_record', lambda r: mapper.map_record(r, map_unknown_to=''), decoded),
+        Stage('stats_update_record', lambda r: stats.update_record(r, clock.now), mapped),
+        Stage('inference_update', inference_update, mapped),
+        Stage('inference_tick', inference_tick, frames),
+        Stage('features_update', features_update, mapped),
+        Stage('model_update', model_update, mapped),
+        Stage('model_window', model_window, frames[:100]),
+        Stage('loop', loop_body, frames),
+        Stage('frame_filter', frame_filter.classify, frames),
+        Stage('filtered_pipeline', filtered_loop_body, frames),
+        Stage('timed_pipeline', timed_loop_body, frames),
+    ]
+
+
+def measure(stage, repeat, memory_sample):
+    fn, items = stage.fn, stage.items
+    for item in items:  # warm up, also brings stateful stages to a steady state
+        fn(item)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            fn(item)
+    elapsed = time.perf_counter() - start
+    packets = repeat * len(items)
+
+    # CPython has no allocation counter, so report the traced peak (transient) and retained bytes per call
+    sample = items[:memory_sample]
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    peak_total = 0
+    for item in sample:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(item)
+        peak_total += tracemalloc.get_traced_memory()[1] - before
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    return {
+        'packets': packets,
+        'seconds': elapsed,
+        'packets_per_sec': packets / elapsed if elapsed > 0 else 0,
+        'ns_per_packet': elapsed * 1e9 / packets if packets else 0,
+        'peak_alloc_bytes_per_packet': peak_total / len(sample) if sample else 0,
+        'retained_bytes_per_packet': retained / len(sample) if sample else 0,
+    }
+
+
+def engine_memory(config, model=None):
+    # bytes retained by a freshly built engine, the model engine includes its weights and preallocated buffers
+    result = {}
+    model = model or random_model()
+    for name, build in (('rules', lambda: SimpleRuleEngine(config.tracking_devices(), debug=False)),
+                        ('model', lambda: build_model_engine(config, ReplayClock(1000.0), model))):
+        tracemalloc.start()
+        engine = build()
+        result[name] = {'retained_bytes': tracemalloc.get_traced_memory()[0]}
+        tracemalloc.stop()
+        if name == 'model':
+            result[name]['weights_bytes'] = engine.model.size_bytes()
+    return result
+
+
+def compare(results, baseline):
+    print(f"{'stage':<24}{'baseline ns':>14}{'current ns':>14}{'speedup':>10}")
+    for name, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if not previous:
+            print(f"{name:<24}{'-':>14}{current['ns_per_packet']:>14.0f}{'-':>10}")
+            continue
+        speedup = previous['ns_per_packet'] / current['ns_per_packet'] if current['ns_per_packet'] else 0
+        print(f"{name:<24}{previous['ns_per_packet']:>14.0f}{current['ns_per_packet']:>14.0f}{speedup:>9.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the home-events pipeline stages on synthetic traffic")
+    parser.add_argument("--config", default="config-sample.json", help="config.json providing tracked and known devices")
+    parser.add_argument("--packets", type=int, default=5000, help="number of distinct synthetic frames")
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the frames per stage")
+    parser.add_argument("--memory-sample", type=int, default=500, help="frames traced for allocation stats")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--stage", action="append", help="only run the given stage(s)")
+    parser.add_argument("--output", help="write results as json to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of a previous run to compare against")
+    parser.add_argument("--model", help="model.json for the model engine stages, a random model of the same shape by default")
+    args = parser.parse_args(argv)
+
+    config = Config(args.config)
+    config.load()
+    with open(args.config) as f:
+        devices = json.load(f)['devices']
+    frames = SyntheticTraffic(devices, seed=args.seed).frames(args.packets)
+    model = None
+    if args.model:
+        with open(args.model) as f:
+            model = json.load(f)
+
+    results = {
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'packets': args.packets,
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'stages': {},
+        'engines': engine_memory(config, model),
+    }
+    for stage in build_stages(config, frames, model):
+        if args.stage and stage.name not in args.stage:
+            continue
+        results['stages'][stage.name] = measure(stage, args.repeat, args.memory_sample)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
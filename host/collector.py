@@ -0,0 +1,556 @@
+# coding: utf-8
+# merges what several sniffers publish into one view. every node publishes its presence events to <node>/<device>
+# and its stats to <node>/stats (or stats/msgpack), the collector keeps the last state of every node and derives
+#   - one presence stream: a device is present while at least one node reports it present. appeared is sent when
+#     the first node sees it, disappeared when the last one lost it
+#   - merged stats in the PacketStats shape, published with the device's StatsSerializer. traffic of a mac seen by
+#     several sniffers counts once (a flow, a device's rates: the node which saw most), the node totals add up
+#   python -m host.collector --nodes '/home-events/+' --output /home-events/all --config src/config.json
+#   mosquitto_sub -v -t '/home-events/+/#' | python -m host.collector --nodes '/home-events/+' --stdin
+import argparse
+import json
+import os
+import select
+import sys
+import time
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from config import Config
+from payload import StatsSerializer, msgpack_loads
+
+# messages are taken from the source and merged in batches of at most this long
+BATCH_SEC = 1.0
+MAX_PAYLOAD_BYTES = 64 * 1024
+STATS_TOPICS = ('stats', 'stats/msgpack')
+EVENT_TYPES = ('appeared', 'disappeared')
+
+
+def topic_matches(pattern, topic):
+    # mqtt subscription matching, + is one level and # the rest
+    levels = topic.split('/')
+    pattern_levels = pattern.split('/')
+    for i, expected in enumerate(pattern_levels):
+        if expected == '#':
+            return True
+        if i >= len(levels) or (expected != '+' and expected != levels[i]):
+            return False
+    return len(levels) == len(pattern_levels)
+
+
+class NodeTopics:
+    # the node topics are those matching pattern, e.g. home/+ for home/sniffer1, home/sniffer2. the node is the part
+    # of a topic matching the pattern, the rest is what the node published
+    def __init__(self, pattern, exclude=()):
+        self.pattern = pattern
+        self.exclude = set(exclude)
+        self._depth = len(pattern.split('/'))
+
+    def subscription(self):
+        return self.pattern + '/#'
+
+    def split(self, topic):
+        levels = topic.split('/')
+        if len(levels) <= self._depth:
+            return None, None
+        node = '/'.join(levels[:self._depth])
+        if node in self.exclude or not topic_matches(self.pattern, node):
+            return None, None
+        return node, '/'.join(levels[self._depth:])
+
+
+class NodeState:
+    def __init__(self, name, now):
+        self.name = name
+        self.last_message = now
+        self.seq = None
+        # a snapshot arrived and no stats message was missed since, deltas only apply to a synced node
+        self.synced = False
+        self.gaps = 0
+        self.packets_count = 0
+        self.filtered_count = 0
+        self.sample_every = 1
+        self.packet_types = {}
+        self.flows = {}  # flow id -> flow
+        self.rates = {'devices': {}, 'packet_types': {}}
+        self.devices = set()  # devices with a sighting of this node
+
+    def status(self):
+        return {'last_message': self.last_message, 'seq': self.seq, 'synced': self.synced, 'gaps': self.gaps,
+                'packets_count': self.packets_count, 'flows': len(self.flows), 'devices': len(self.devices)}
+
+
+class Collector:
+    # ingest() takes the (topic, payload) messages received since its last call. memory is bounded per node
+    # (max_flows, max_devices, max_packet_types) and in nodes (max_nodes). a node silent for node_timeout
+    # seconds is dropped with everything it contributed, 0 keeps the nodes forever (nodes without stats may only
+    # publish on presence changes). it reads like a PacketStats for StatsSerializer
+    def __init__(self, topics, notify_callback=None, clock=time.time, node_timeout=0, max_nodes=1024, max_flows=256, max_devices=256,
+                 max_packet_types=64):
+        self.topics = topics
+        self.notify_callback = notify_callback
+        self.clock = clock
+        self.node_timeout = node_timeout
+        self.max_nodes = max_nodes
+        self.max_flows = max_flows
+        self.max_devices = max_devices
+        self.max_packet_types = max_packet_types
+        self.nodes = {}
+        # device -> {node: (present, since)}, the last state each node reported
+        self._sightings = {}
+        # flow id -> {node: flow}
+        self._flows = {}
+        self.packets_count = 0
+        self.filtered_count = 0
+        self.packet_types = {}
+        # device -> last event of the merged presence stream, replaced on every change
+        self.tracking = {}
+        self.messages = 0
+        self.ignored = 0
+        self.rejected_nodes = 0
+        self.expired_nodes = 0
+
+    @property
+    def sample_every(self):
+        # the coarsest sampling of the nodes
+        return max([state.sample_every for state in self.nodes.values()] or [1])
+
+    def ingest(self, messages, now=None):
+        # a stats snapshot supersedes the earlier stats messages of its node in the batch, and the presence of the
+        # devices the batch touched is decided once, after all of it is applied
+        if now is None:
+            now = self.clock()
+        decoded = []
+        last_snapshot = {}
+        for topic, payload in messages:
+            self.messages += 1
+            node, subtopic = self.topics.split(topic)
+            message = self._decode(subtopic, payload) if node is not None else None
+            if message is None:
+                self.ignored += 1
+                continue
+            if subtopic in STATS_TOPICS and message.get('full'):
+                last_snapshot[node] = len(decoded)
+            decoded.append((node, subtopic, message))
+        touched = set()
+        for index, (node, subtopic, message) in enumerate(decoded):
+            state = self.nodes.get(node)
+            if state is None:
+                if len(self.nodes) >= self.max_nodes:
+                    self.rejected_nodes += 1
+                    continue
+                state = self.nodes[node] = NodeState(node, now)
+            state.last_message = now
+            if subtopic not in STATS_TOPICS:
+                self._apply_event(state, subtopic, message, touched)
+            elif index >= last_snapshot.get(node, index):
+                self._apply_stats(state, message, touched)
+        for device in touched:
+            self._decide(device, now)
+        if self.node_timeout:
+            self.expire(now)
+
+    def _decode(self, subtopic, payload):
+        # stats, and presence events on <node>/<device>. features, metrics and status messages are not merged
+        if len(payload) > MAX_PAYLOAD_BYTES or (subtopic not in STATS_TOPICS and '/' in subtopic):
+            return None
+        try:
+            message = msgpack_loads(payload) if subtopic == 'stats/msgpack' else json.loads(payload)
+        except ValueError:
+            return None
+        if not isinstance(message, dict):
+            return None
+        if subtopic not in STATS_TOPICS and message.get('type') not in EVENT_TYPES:
+            return None
+        return message
+
+    def _apply_event(self, state, device, event, touched):
+        # the last state a node sent wins. nodes publish in order, and their timestamps can not order events as the
+        # board clock starts over when it reboots
+        data = event.get('data') or {}
+        present = event.get('type') == 'appeared'
+        since = data.get('appeared_since' if present else 'disappeared_since') or 0
+        sightings = self._sightings.get(device)
+        if sightings is None:
+            sightings = self._sightings[device] = {}
+        if state.name not in sightings:
+            if len(state.devices) >= self.max_devices:
+                return
+            state.devices.add(device)
+        sightings[state.name] = (present, since)
+        touched.add(device)
+
+    def _forget_sightings(self, state, touched):
+        for device in state.devices:
+            sightings = self._sightings[device]
+            del sightings[state.name]
+            if not sightings:
+                del self._sightings[device]
+            touched.add(device)
+        state.devices = set()
+
+    def _apply_stats(self, state, payload, touched):
+        if payload.get('full'):
+            # a snapshot has every event of the node, none of those before a reboot
+            self._forget_sightings(state, touched)
+        for device, event in (payload.get('events') or {}).items():
+            if event.get('type') in EVENT_TYPES:
+                self._apply_event(state, device, event, touched)
+        seq = payload.get('seq')
+        full = bool(payload.get('full'))
+        if not full and (not state.synced or seq != state.seq + 1):
+            # a message was lost, the node keeps its last merged stats until the next snapshot
+            if state.synced:
+                state.gaps += 1
+                state.synced = False
+            state.seq = seq
+            return
+        state.seq = seq
+        state.synced = True
+        self.packets_count += payload.get('packets_count', 0) - state.packets_count
+        self.filtered_count += payload.get('filtered_count', 0) - state.filtered_count
+        state.packets_count = payload.get('packets_count', 0)
+        state.filtered_count = payload.get('filtered_count', 0)
+        sampling_rate = payload.get('sampling_rate') or 1
+        state.sample_every = max(1, round(1 / sampling_rate))
+        self._set_packet_types(state, payload.get('packet_types') or {}, full)
+        self._set_flows(state, payload.get('stats') or [], payload.get('removed') or [], full)
+        rates = payload.get('rates') or {}
+        state.rates = {kind: dict(list((rates.get(kind) or {}).items())[:self.max_devices]) for kind in ('devices', 'packet_types')}
+
+    def _set_packet_types(self, state, packet_types, full):
+        current = state.packet_types
+        if full:
+            for packet_type in [packet_type for packet_type in current if packet_type not in packet_types]:
+                self._count_type(packet_type, -current.pop(packet_type))
+        for packet_type, count in packet_types.items():
+            previous = current.get(packet_type)
+            if previous is None and len(current) >= self.max_packet_types:
+                continue
+            current[packet_type] = count
+            self._count_type(packet_type, count - (previous or 0))
+
+    def _count_type(self, packet_type, delta):
+        count = self.packet_types.get(packet_type, 0) + delta
+        if count:
+            self.packet_types[packet_type] = count
+        else:
+            self.packet_types.pop(packet_type, None)
+
+    def _set_flows(self, state, flows, removed, full):
+        current = state.flows
+        if full:
+            published = set(flow.get('id') for flow in flows)
+            removed = [flow_id for flow_id in current if flow_id not in published]
+        for flow_id in removed:
+            if current.pop(flow_id, None) is not None:
+                self._merge_flow(flow_id, state.name, None)
+        for flow in flows:
+            flow_id = flow.get('id') or f"{flow.get('src_mac')}>{flow.get('dst_mac')}"
+            if flow_id not in current and len(current) >= self.max_flows:
+                continue
+            current[flow_id] = flow
+            self._merge_flow(flow_id, state.name, flow)
+
+    def _merge_flow(self, flow_id, node, flow):
+        seen = self._flows.get(flow_id)
+        if flow is not None:
+            if seen is None:
+                seen = self._flows[flow_id] = {}
+            seen[node] = flow
+        elif seen is not None:
+            seen.pop(node, None)
+            if not seen:
+                del self._flows[flow_id]
+
+    def _decide(self, device, now):
+        sightings = self._sightings.get(device) or {}
+        present = sorted(node for node, (node_present, _) in sightings.items() if node_present)
+        event = self.tracking.get(device)
+        was_present = event is not None and event['type'] == 'appeared'
+        if present and not was_present:
+            since = min(sightings[node][1] for node in present)
+            self._emit(device, {'type': 'appeared', 'data': {'appeared_since': since, 'disappeared_since': 0, 'nodes': present}})
+        elif was_present and not present:
+            # the last node which lost it, or now when the nodes which saw it went away
+            since = max([since for _, since in sightings.values()] or [now])
+            self._emit(device, {'type': 'disappeared', 'data': {'appeared_since': 0, 'disappeared_since': since, 'nodes': []}})
+
+    def _emit(self, device, event):
+        self.tracking[device] = event
+        if self.notify_callback is not None:
+            self.notify_callback(device, message=json.dumps(event))
+
+    def expire(self, now=None):
+        if now is None:
+            now = self.clock()
+        for node in [node for node, state in self.nodes.items() if now - state.last_message > self.node_timeout]:
+            self.remove_node(node, now)
+            self.expired_nodes += 1
+
+    def remove_node(self, node, now=None):
+        # takes back everything the node contributed, its devices may disappear
+        if now is None:
+            now = self.clock()
+        state = self.nodes.pop(node)
+        self.packets_count -= state.packets_count
+        self.filtered_count -= state.filtered_count
+        for packet_type, count in state.packet_types.items():
+            self._count_type(packet_type, -count)
+        for flow_id in state.flows:
+            self._merge_flow(flow_id, node, None)
+        touched = set()
+        self._forget_sightings(state, touched)
+        for device in touched:
+            self._decide(device, now)
+
+    def top_flows(self, count=None):
+        # a flow seen by several nodes is the flow of the node which counted most packets, with the nodes seeing it
+        result = []
+        for seen in self._flows.values():
+            flow = None
+            for candidate in seen.values():
+                if flow is None or candidate['packets_count'] > flow['packets_count']:
+                    flow = candidate
+            flow = dict(flow)
+            flow['nodes'] = sorted(seen)
+            result.append(flow)
+        result.sort(key=lambda flow: flow['packets_count'], reverse=True)
+        return result[:self.max_flows if count is None else count]
+
+    def rates(self, now=None):
+        # the rates of a device are those of the node which sees most of its traffic, packet type rates add up
+        devices = {}
+        packet_types = {}
+        for state in self.nodes.values():
+            for device, rates in state.rates['devices'].items():
+                merged = devices.setdefault(device, {})
+                for window, rate in rates.items():
+                    merged[window] = max(merged.get(window, 0), rate)
+            for packet_type, rates in state.rates['packet_types'].items():
+                merged = packet_types.setdefault(packet_type, {})
+                for window, rate in rates.items():
+                    merged[window] = round(merged.get(window, 0) + rate, 3)
+        return {'devices': devices, 'packet_types': packet_types}
+
+    def stats(self):
+        return {'nodes': len(self.nodes), 'messages': self.messages, 'ignored': self.ignored, 'rejected_nodes': self.rejected_nodes,
+                'expired_nodes': self.expired_nodes, 'devices': len(self._sightings), 'flows': len(self._flows)}
+
+
+class MqttSource:
+    # subscribes with MiniMQTT in binary mode (msgpack stats), poll() returns the (topic, payload) received meanwhile
+    def __init__(self, client, subscription, reconnect_sec=5):
+        try:
+            from adafruit_minimqtt.adafruit_minimqtt import MMQTTException
+            self._errors = (MMQTTException, OSError, RuntimeError)
+        except ImportError:  # a LocalClient
+            self._errors = (OSError, RuntimeError)
+        self.client = client
+        self.subscription = subscription
+        self.reconnect_sec = reconnect_sec
+        self.eof = False
+        self._messages = []
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+
+    def _on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.subscription, 1)
+
+    def _on_message(self, client, topic, message):
+        self._messages.append((topic, message))
+
+    def start(self):
+        self.client.connect()
+
+    def poll(self, timeout):
+        try:
+            self.client.loop(timeout)
+        except self._errors as e:
+            print(f"MQTT connection lost, reconnecting in {self.reconnect_sec}s: {e}")
+            time.sleep(self.reconnect_sec)
+            try:
+                self.client.reconnect()
+            except self._errors as e:
+                print(f"MQTT reconnect failed: {e}")
+        messages = self._messages
+        self._messages = []
+        return messages
+
+
+class LineSource:
+    # topic and payload per line, as printed by mosquitto_sub -v. with hex_payloads the payload is hex, for
+    # binary (msgpack) payloads: mosquitto_sub -F '%t %x'
+    def __init__(self, stream, hex_payloads=False):
+        self._fd = stream.fileno()
+        self.hex_payloads = hex_payloads
+        self.eof = False
+        self._partial = b''
+
+    def start(self):
+        pass
+
+    def poll(self, timeout):
+        if self.eof or not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self._fd, 1 << 16)
+        if not data:
+            self.eof = True
+            data = b'\n'
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        messages = []
+        for line in lines:
+            topic, _, payload = line.partition(b' ')
+            if not payload:
+                continue
+            try:
+                messages.append((topic.decode('utf-8'), bytes.fromhex(payload.decode('ascii')) if self.hex_payloads else payload))
+            except ValueError:
+                continue
+        return messages
+
+
+class LocalBroker:
+    # an in-process stand-in for the broker in tests and simulations: publish() delivers a message to every client
+    # with a matching subscription, which hands it to on_message in its next loop()
+    def __init__(self):
+        self.clients = []
+
+    def client(self):
+        client = LocalClient(self)
+        self.clients.append(client)
+        return client
+
+    def publish(self, topic, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        for client in self.clients:
+            if client.connected and any(topic_matches(subscription, topic) for subscription in client.subscriptions):
+                client.inbox.append((topic, message))
+
+
+class LocalClient:
+    # the part of the MiniMQTT client used by MqttNotifier and MqttSource
+    keep_alive = 60
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.connected = False
+        self.subscriptions = []
+        self.inbox = []
+        self.on_connect = None
+        self.on_message = None
+
+    def connect(self):
+        self.connected = True
+        if self.on_connect is not None:
+            self.on_connect(self, None, 0, 0)
+
+    def reconnect(self):
+        self.connect()
+
+    def disconnect(self):
+        self.connected = False
+
+    def ping(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self.broker.publish(topic, msg)
+
+    def loop(self, timeout=0):
+        inbox = self.inbox
+        self.inbox = []
+        for topic, message in inbox:
+            self.on_message(self, topic, message)
+
+
+def build_client(mqtt_config, client_id):
+    import socket
+
+    import adafruit_minimqtt.adafruit_minimqtt as MQTT
+    return MQTT.MQTT(broker=mqtt_config['host'], port=mqtt_config.get('port', 1883), username=mqtt_config['username'], password=mqtt_config['password'],
+                     client_id=client_id, socket_pool=socket, use_binary_mode=True, connect_retries=1)
+
+
+def _print_event(device, message):
+    # stdout carries the json summary
+    print(f"{device}: {message}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the events and stats of several home-events sniffers")
+    parser.add_argument("--nodes", required=True, help="topic pattern of the sniffers, e.g. home/+ for home/sniffer1, home/sniffer2")
+    parser.add_argument("--config", default="src/config.json", help="config.json with the mqtt broker")
+    parser.add_argument("--output", help="publish the merged presence events and stats under this topic")
+    parser.add_argument("--client-id", default="home-net-collector")
+    parser.add_argument("--stdin", action="store_true", help="read 'topic payload' lines (mosquitto_sub -v) from stdin instead of subscribing")
+    parser.add_argument("--hex", action="store_true", help="the payloads read from stdin are hex (mosquitto_sub -F '%%t %%x')")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between merged stats messages or status lines")
+    parser.add_argument("--node-timeout", type=float, default=0, help="drop a node silent for this long, 0 to keep it")
+    parser.add_argument("--max-nodes", type=int, default=1024)
+    parser.add_argument("--quiet", action="store_true", help="do not print events as they are merged")
+    args = parser.parse_args(argv)
+
+    mqtt_config = None
+    if not args.stdin or args.output:
+        config = Config(args.config)
+        config.load()
+        mqtt_config = config.mqtt_config()
+    notifier = None
+    if args.output:
+        from notifier import MqttNotifier  # adafruit_minimqtt is only needed with mqtt
+        notifier = MqttNotifier(eth=None, host=mqtt_config['host'], port=mqtt_config.get('port', 1883), topic=args.output, mqtt_user=mqtt_config['username'],
+                                mqtt_password=mqtt_config['password'], client_id=args.client_id + '-output', max_queued=256, max_queued_bytes=256 * 1024)
+        notify_callback = notifier.notify
+    else:
+        notify_callback = None if args.quiet else _print_event
+    topics = NodeTopics(args.nodes, exclude=[args.output] if args.output else ())
+    collector = Collector(topics, notify_callback=notify_callback, node_timeout=args.node_timeout, max_nodes=args.max_nodes)
+    if args.stdin:
+        source = LineSource(sys.stdin.buffer, hex_payloads=args.hex)
+    else:
+        source = MqttSource(build_client(mqtt_config, args.client_id), topics.subscription())
+    serializer = StatsSerializer(collector) if notifier is not None else None
+
+    source.start()
+    if notifier is not None:
+        notifier.start()
+    next_report = time.monotonic() + args.interval
+    try:
+        while not source.eof:
+            collector.ingest(source.poll(BATCH_SEC))
+            now = time.monotonic()
+            if now >= next_report:
+                next_report = now + args.interval
+                if serializer is not None:
+                    notifier.notify('stats', serializer.dumps(time.time(), full=notifier.is_queued('stats')), message_class='stats')
+                else:
+                    print(json.dumps(collector.stats()), file=sys.stderr)
+            if notifier is not None:
+                notifier.flush(0.05)
+    except KeyboardInterrupt:
+        pass
+    if notifier is not None:
+        deadline = time.monotonic() + 5
+        while notifier.queued() and time.monotonic() < deadline:
+            if not notifier.flush(1):
+                time.sleep(notifier.publish_interval)
+        notifier.stop()
+
+    print(json.dumps({
+        "collector": collector.stats(),
+        "nodes": {node: state.status() for node, state in collector.nodes.items()},
+        "packets_count": collector.packets_count,
+        "packet_types": collector.packet_types,
+        "rates": collector.rates(),
+        "stats": collector.top_flows(),
+        "events": collector.tracking,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
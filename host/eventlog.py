@@ -0,0 +1,168 @@
+# coding: utf-8
+# reads the binary event logs written by src/eventlog.py and exports them for model training:
+#   python -m host.eventlog logs/events.bin --keep 3 --format csv --output events.csv
+#   python -m host.eventlog logs/events.bin --format parquet --output events.parquet  (requires numpy and pyarrow)
+import argparse
+import csv
+import mmap
+import os
+import struct
+import sys
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from decoder import format_ip_addr, format_mac_addr
+from eventlog import HEADER_FORMAT, HEADER_SIZE, KIND_NAMES, KIND_PACKET, LOG_MAGIC, RECORD_FORMAT, RECORD_SIZE, TYPE_NAMES, log_files
+
+COLUMNS = ('ts', 'kind', 'type', 'ip_proto', 'flags', 'length', 'eth_proto', 'src_mac', 'dst_mac', 'src_ip', 'dst_ip')
+
+
+class LogFormatError(ValueError):
+    pass
+
+
+class EventLogReader:
+    # memory maps one log file, records are read in place without copying the file
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mmap = None
+        self.count = 0
+
+    def open(self):
+        self._file = open(self.path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER_SIZE:
+            self.count = 0
+            return self
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _version, record_size = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if magic != LOG_MAGIC:
+            raise LogFormatError(f"{self.path} is not an event log")
+        if record_size != RECORD_SIZE:
+            raise LogFormatError(f"{self.path} has {record_size} byte records, expected {RECORD_SIZE}")
+        # a partially written last record (power loss) is ignored
+        self.count = (size - HEADER_SIZE) // RECORD_SIZE
+        return self
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:  # a numpy view of the records is still referenced
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def records(self):
+        # raw tuples in RECORD_FORMAT field order
+        if not self.count:
+            return iter(())
+        view = memoryview(self._mmap)[HEADER_SIZE:HEADER_SIZE + self.count * RECORD_SIZE]
+        return struct.iter_unpack(RECORD_FORMAT, view)
+
+    def rows(self):
+        # records with names and formatted addresses, in COLUMNS order
+        for ts, kind, packet_type, ip_proto, flags, length, eth_proto, src_mac, dst_mac, src_ip, dst_ip in self.records():
+            has_ip = src_ip != b'\x00\x00\x00\x00' or dst_ip != b'\x00\x00\x00\x00'
+            if kind != KIND_PACKET:
+                packet_type = ''
+            elif packet_type < len(TYPE_NAMES):
+                packet_type = TYPE_NAMES[packet_type]
+            yield (ts, KIND_NAMES.get(kind, kind), packet_type, ip_proto, flags,
+                   length, eth_proto, format_mac_addr(src_mac), format_mac_addr(dst_mac),
+                   format_ip_addr(src_ip) if has_ip else '', format_ip_addr(dst_ip) if has_ip else '')
+
+    def to_numpy(self):
+        # structured array viewing the mapped file, addresses as uint8 sub-arrays
+        import numpy as np
+        return np.frombuffer(self._mmap, dtype=record_dtype(), count=self.count, offset=HEADER_SIZE) if self.count \
+            else np.zeros(0, dtype=record_dtype())
+
+
+def record_dtype():
+    import numpy as np
+    return np.dtype([
+        ('ts', '<f8'), ('kind', 'u1'), ('type', 'u1'), ('ip_proto', 'u1'), ('flags', 'u1'),
+        ('length', '<u2'), ('eth_proto', '<u2'),
+        ('src_mac', 'u1', (6,)), ('dst_mac', 'u1', (6,)), ('src_ip', 'u1', (4,)), ('dst_ip', 'u1', (4,)),
+    ])
+
+
+def existing_files(path, keep):
+    return [name for name in log_files(path, keep) if os.path.exists(name)]
+
+
+def export_csv(paths, output):
+    count = 0
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    for path in paths:
+        with EventLogReader(path) as reader:
+            writer.writerows(reader.rows())
+            count += reader.count
+    return count
+
+
+def _bytes_to_int(array):
+    # (n, k) uint8 big endian -> n integers
+    import numpy as np
+    result = np.zeros(len(array), dtype=np.uint64)
+    for column in range(array.shape[1]):
+        result = (result << np.uint64(8)) | array[:, column].astype(np.uint64)
+    return result
+
+
+def export_parquet(paths, output_path):
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = []
+    for path in paths:
+        with EventLogReader(path) as reader:
+            records = reader.to_numpy()
+            columns = {name: records[name].copy() for name in ('ts', 'kind', 'type', 'ip_proto', 'flags', 'length', 'eth_proto')}
+            columns['src_mac'] = _bytes_to_int(records['src_mac'])
+            columns['dst_mac'] = _bytes_to_int(records['dst_mac'])
+            columns['src_ip'] = _bytes_to_int(records['src_ip']).astype(np.uint32)
+            columns['dst_ip'] = _bytes_to_int(records['dst_ip']).astype(np.uint32)
+            del records
+            tables.append(pa.table(columns))
+    if not tables:
+        return 0
+    table = pa.concat_tables(tables)
+    pq.write_table(table, output_path)
+    return table.num_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export home-events binary event logs")
+    parser.add_argument("path", help="log path as configured in log.path, rotated files path.1 .. path.N are included")
+    parser.add_argument("--keep", type=int, default=3, help="number of rotated files, as configured in log.keep")
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    parser.add_argument("--output", help="output file, csv goes to stdout by default")
+    args = parser.parse_args(argv)
+
+    paths = existing_files(args.path, args.keep)
+    if args.format == "parquet":
+        if not args.output:
+            parser.error("--output is required for parquet")
+        count = export_parquet(paths, args.output)
+    elif args.output:
+        with open(args.output, "w", newline="") as f:
+            count = export_csv(paths, f)
+    else:
+        count = export_csv(paths, sys.stdout)
+    print(f"{count} records from {len(paths)} files", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# coding: utf-8
+# turns replayed traffic into training matrices with the same FeatureExtractor the device runs:
+#   python -m host.features capture.pcapng --config src/config.json --window 60 --output features.npz (requires numpy)
+import argparse
+
+import numpy as np
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from config import Config
+from features import FEATURE_NAMES, FEATURES_COUNT, FeatureExtractor
+
+from host.pcap import CaptureReader
+from host.replay import ReplayClock, build_pipeline, replay
+
+
+class FeatureMatrix:
+    # collects the emitted windows in preallocated blocks of block_rows rows, concatenated once at the end
+    def __init__(self, block_rows=4096):
+        self.block_rows = block_rows
+        self.devices = []
+        self._device_index = {}
+        self._blocks = []
+        self._rows = 0
+        self._new_block()
+
+    def _new_block(self):
+        self._features = np.zeros((self.block_rows, FEATURES_COUNT), dtype=np.float64)
+        self._device = np.zeros(self.block_rows, dtype=np.int32)
+        self._window_start = np.zeros(self.block_rows, dtype=np.float64)
+        self._present = np.zeros(self.block_rows, dtype=np.bool_)
+        self._rows = 0
+
+    def add(self, device, window_start, features, present=False):
+        if self._rows == self.block_rows:
+            self._blocks.append((self._features, self._device, self._window_start, self._present))
+            self._new_block()
+        index = self._device_index.get(device)
+        if index is None:
+            index = self._device_index[device] = len(self.devices)
+            self.devices.append(device)
+        row = self._rows
+        self._features[row] = features
+        self._device[row] = index
+        self._window_start[row] = window_start
+        self._present[row] = present
+        self._rows += 1
+
+    def arrays(self):
+        rows = self._rows
+        blocks = self._blocks + [(self._features[:rows], self._device[:rows], self._window_start[:rows], self._present[:rows])]
+        return {
+            'X': np.concatenate([block[0] for block in blocks]),
+            'device': np.concatenate([block[1] for block in blocks]),
+            'window_start': np.concatenate([block[2] for block in blocks]),
+            'present': np.concatenate([block[3] for block in blocks]),
+            'devices': np.array(self.devices),
+            'feature_names': np.array(FEATURE_NAMES),
+        }
+
+
+def extract(frames, config, window_sec=60, devices=None, block_rows=4096):
+    # replays frames, every emitted window becomes a row. present is the SimpleRuleEngine state of the device
+    # when the window ended, usable as a weak label
+    clock = ReplayClock()
+    matrix = FeatureMatrix(block_rows)
+    seen_devices = {}
+
+    def add_window(device, window_start, features):
+        seen_device = seen_devices.get(device)
+        matrix.add(device, window_start, features, present=seen_device is not None and seen_device['appeared_since'] > 0)
+
+    extractor = FeatureExtractor(devices=config.tracking_devices() if devices is None else devices, window_sec=window_sec,
+                                 emit_callback=add_window, clock=clock)
+    pipeline = build_pipeline(config, clock, features=extractor)
+    seen_devices = pipeline.inference_engine.seen_devices
+    replay(frames, pipeline, clock)
+    return matrix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract per device feature windows from a capture")
+    parser.add_argument("capture", help="pcap or pcapng file, ethernet link type")
+    parser.add_argument("--config", default="src/config.json", help="config.json used on the device")
+    parser.add_argument("--window", type=float, default=60, help="window length in seconds")
+    parser.add_argument("--all-devices", action="store_true", help="every configured device instead of the tracked ones")
+    parser.add_argument("--output", default="features.npz")
+    args = parser.parse_args(argv)
+
+    config = Config(args.config)
+    config.load()
+    devices = list(config.mac_address_to_devices().values()) if args.all_devices else None
+    with CaptureReader(args.capture) as reader:
+        matrix = extract(reader.frames(), config, window_sec=args.window, devices=devices)
+    arrays = matrix.arrays()
+    np.savez_compressed(args.output, **arrays)
+    print(f"{arrays['X'].shape[0]} windows x {arrays['X'].shape[1]} features for {len(matrix.devices)} devices written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# coding: utf-8
+# runs the device pipeline on a linux host (raspberry pi, router) from a live interface or a pcap stream, with
+# the same rule engine and mqtt output as the board:
+#   sudo python -m host.live --interface eth0 --config src/config.json
+#   tcpdump -i eth0 -U -w - | python -m host.live --pcap - --config src/config.json
+import argparse
+import json
+import os
+import sys
+import time
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from capture import PcapStreamCapture
+from config import Config
+from payload import StatsSerializer
+from scheduler import Scheduler
+
+from host.afpacket import AfPacketCapture
+from host.replay import build_pipeline
+
+# frames processed per capture step, a TPACKET_V3 block is handed over whole anyway
+CAPTURE_BUDGET = 256
+IDLE_SEC = 0.01
+
+
+def open_capture(args):
+    if args.interface:
+        return AfPacketCapture(args.interface, block_size=args.block_kb * 1024, block_count=args.blocks, promiscuous=not args.no_promisc)
+    if args.pcap == '-':
+        fd = sys.stdin.fileno()
+    else:
+        fd = os.open(args.pcap, os.O_RDONLY)  # blocks until a fifo has a writer
+    os.set_blocking(fd, False)
+    return PcapStreamCapture(open(fd, 'rb', buffering=0, closefd=args.pcap != '-'))
+
+
+def build_notifier(config):
+    from notifier import MqttNotifier  # adafruit_minimqtt is only needed with mqtt
+    mqtt_config = config.mqtt_config()
+    return MqttNotifier(eth=None, host=mqtt_config['host'], port=mqtt_config.get('port', 1883), topic=mqtt_config['topic'],
+                        mqtt_user=mqtt_config['username'], mqtt_password=mqtt_config['password'], client_id=mqtt_config.get('client_id', 'home-net-events'))
+
+
+def _print_event(device, message):
+    # stdout carries the json summary
+    print(f"{device}: {message}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the home-events pipeline on a Linux host")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--interface", help="capture from this interface with an AF_PACKET ring (needs CAP_NET_RAW)")
+    source.add_argument("--pcap", help="read a pcap stream from this file or fifo, - for stdin (tcpdump -U -w -)")
+    parser.add_argument("--config", default="src/config.json", help="config.json used on the device")
+    parser.add_argument("--block-kb", type=int, default=1024, help="AF_PACKET ring block size")
+    parser.add_argument("--blocks", type=int, default=64, help="AF_PACKET ring block count")
+    parser.add_argument("--no-promisc", action="store_true", help="do not put the interface in promiscuous mode")
+    parser.add_argument("--no-mqtt", action="store_true", help="print events instead of publishing them, even if notify is enabled")
+    parser.add_argument("--status-interval", type=float, default=10, help="seconds between status lines, 0 for none")
+    parser.add_argument("--quiet", action="store_true", help="do not print events as they are detected")
+    args = parser.parse_args(argv)
+
+    config = Config(args.config)
+    config.load()
+    notifier = build_notifier(config) if config.notify_enabled() and not args.no_mqtt else None
+    if notifier is not None:
+        notify_callback = notifier.notify
+    else:
+        notify_callback = None if args.quiet else _print_event
+    pipeline = build_pipeline(config, time.time, notify_callback=notify_callback)
+    capture = open_capture(args)
+    state = {'finished': False, 'frames': 0, 'status_frames': 0, 'status_at': time.monotonic()}
+
+    def capture_step(now, budget):
+        processed = 0
+        process = pipeline.process
+        while processed < budget:
+            count = capture.next_burst()
+            if count < 1:
+                state['finished'] = capture.eof
+                break
+            frames = capture.frames
+            wall_now = time.time()  # one clock read per burst
+            for i in range(count):
+                process(frames[i], wall_now)
+            processed += count
+        state['frames'] += processed
+        return processed
+
+    def presence_step(now, budget):
+        pipeline.inference_engine.tick(time.time())
+
+    def status_step(now, budget):
+        elapsed = now - state['status_at']
+        print(json.dumps({'frames': state['frames'], 'frames_per_sec': (state['frames'] - state['status_frames']) / elapsed if elapsed > 0 else 0,
+                          'dropped_frames': capture.dropped_frames, 'full_bursts': capture.full_bursts, 'backlog_bytes': capture.backlog_bytes}), file=sys.stderr)
+        state['status_frames'] = state['frames']
+        state['status_at'] = now
+
+    scheduler = Scheduler()
+    scheduler.add('capture', capture_step, budget=CAPTURE_BUDGET, priority=True)
+    scheduler.add('presence', presence_step, interval=1)
+    if args.status_interval > 0:
+        scheduler.add('status', status_step, interval=args.status_interval, delay=args.status_interval)
+    if notifier is not None:
+        stats_config = config.stats_config()
+        stats_serializer = StatsSerializer(pipeline.stats, full_every=stats_config.get('full_every', 10), encoding=stats_config.get('encoding', 'json'))
+        stats_topic = 'stats' if stats_serializer.encoding == 'json' else 'stats/' + stats_serializer.encoding
+
+        def stats_step(now, budget):
+            notifier.notify(stats_topic, stats_serializer.dumps(time.time(), full=notifier.is_queued(stats_topic)), message_class='stats')
+
+        scheduler.add('mqtt', lambda now, budget: notifier.flush(budget), interval=0.1, budget=0.05)
+        if stats_config.get('notify'):
+            scheduler.add('stats', stats_step, interval=stats_config['interval'], delay=stats_config['interval'])
+        notifier.start()
+
+    capture.start()
+    started = time.monotonic()
+    try:
+        while not state['finished']:
+            if not scheduler.run_once():
+                capture.wait(IDLE_SEC)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.stop()
+    wall_sec = time.monotonic() - started
+    if notifier is not None:
+        # what is still queued, the final presence events included
+        deadline = time.monotonic() + 5
+        while notifier.queued() and time.monotonic() < deadline:
+            if not notifier.flush(1):
+                time.sleep(notifier.publish_interval)
+        notifier.stop()
+
+    stats = pipeline.stats
+    print(json.dumps({
+        "frames": state['frames'],
+        "wall_sec": wall_sec,
+        "frames_per_sec": state['frames'] / wall_sec if wall_sec > 0 else 0,
+        "dropped_frames": capture.dropped_frames,
+        "oversized_frames": capture.oversized_frames,
+        "filter": pipeline.frame_filter.stats() if pipeline.frame_filter is not None else None,
+        "packet_types": stats.packet_types,
+        "stats": stats.top_flows(),
+        "events": stats.tracking,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# coding: utf-8
+# mmap backed pcap/pcapng reader, frames are yielded as memoryviews into the mapped file (no copies)
+import mmap
+import struct
+
+LINKTYPE_ETHERNET = 1
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_OPT_IF_TSRESOL = 9
+
+
+class CaptureFormatError(Exception):
+    pass
+
+
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mmap = None
+        self._view = None
+
+    def open(self):
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        return self
+
+    def close(self):
+        # frames handed out by frames() must not be used after the reader is closed
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # frames are still referenced, the mapping is released with the last of them
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def frames(self):
+        # yields (timestamp_sec, frame) tuples, frame is a memoryview into the mapped capture
+        view = self._view
+        for ts, offset, length in self.index():
+            yield ts, view[offset:offset + length]
+
+    def index(self):
+        # yields (timestamp_sec, offset, length) of every ethernet frame in the mapped file
+        if len(self._mmap) < 4:
+            raise CaptureFormatError(f"{self.path}: file too short")
+        magic_le, = struct.unpack_from('<I', self._mmap, 0)
+        magic_be, = struct.unpack_from('>I', self._mmap, 0)
+        if magic_le == PCAPNG_SHB:
+            return self._pcapng_index()
+        if magic_le in (PCAP_MAGIC_US, PCAP_MAGIC_NS) or magic_be in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            return self._pcap_index()
+        raise CaptureFormatError(f"{self.path}: not a pcap or pcapng file")
+
+    @property
+    def buffer(self):
+        return self._mmap
+
+    def _pcap_index(self):
+        data = self._mmap
+        magic, = struct.unpack_from('<I', data, 0)
+        endian = '<' if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS) else '>'
+        magic, _, _, _, _, _, linktype = struct.unpack_from(endian + 'IHHiIII', data, 0)
+        if linktype != LINKTYPE_ETHERNET:
+            raise CaptureFormatError(f"{self.path}: unsupported link type {linktype}")
+        ts_scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        record_header = struct.Struct(endian + 'IIII')
+        offset = 24
+        size = len(data)
+        while offset + 16 <= size:
+            ts_sec, ts_frac, incl_len, _ = record_header.unpack_from(data, offset)
+            offset += 16
+            if offset + incl_len > size:
+                break  # truncated capture
+            yield ts_sec + ts_frac * ts_scale, offset, incl_len
+            offset += incl_len
+
+    def _pcapng_index(self):
+        data = self._mmap
+        size = len(data)
+        offset = 0
+        endian = '<'
+        interfaces = []  # (linktype, seconds per timestamp unit) per interface id of the current section
+        last_ts = 0.0
+        while offset + 12 <= size:
+            block_type, = struct.unpack_from(endian + 'I', data, offset)
+            if block_type == PCAPNG_SHB:
+                byte_order, = struct.unpack_from('<I', data, offset + 8)
+                endian = '<' if byte_order == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+            block_len, = struct.unpack_from(endian + 'I', data, offset + 4)
+            if block_len < 12 or offset + block_len > size:
+                break  # truncated capture
+            body = offset + 8
+            if block_type == PCAPNG_IDB:
+                linktype, = struct.unpack_from(endian + 'H', data, body)
+                interfaces.append((linktype, self._pcapng_ts_resolution(data, endian, body + 8, offset + block_len - 4)))
+            elif block_type == PCAPNG_EPB and block_len >= 32:
+                if_id, ts_high, ts_low, cap_len, _ = struct.unpack_from(endian + 'IIIII', data, body)
+                # a packet of an interface without description is skipped, a corrupt length stays in its block
+                if if_id < len(interfaces) and interfaces[if_id][0] == LINKTYPE_ETHERNET:
+                    last_ts = ((ts_high << 32) | ts_low) * interfaces[if_id][1]
+                    yield last_ts, body + 20, min(cap_len, block_len - 32)
+            elif block_type == PCAPNG_SPB and interfaces:
+                orig_len, = struct.unpack_from(endian + 'I', data, body)
+                cap_len = min(orig_len, block_len - 16)
+                if interfaces[0][0] == LINKTYPE_ETHERNET:
+                    # simple packet blocks carry no timestamp, reuse the previous one
+                    yield last_ts, body + 4, cap_len
+            offset += block_len
+
+    @staticmethod
+    def _pcapng_ts_resolution(data, endian, offset, end):
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(endian + 'HH', data, offset)
+            if code == 0:
+                break
+            if code == PCAPNG_OPT_IF_TSRESOL and length >= 1:
+                resolution = data[offset + 4]
+                if resolution & 0x80:
+                    return 2.0 ** -(resolution & 0x7F)
+                return 10.0 ** -resolution
+            offset += 4 + ((length + 3) & ~3)
+        return 1e-6
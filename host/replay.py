@@ -0,0 +1,119 @@
+# coding: utf-8
+# replays a pcap/pcapng capture through the same pipeline code.py runs on the device:
+#   python -m host.replay capture.pcapng --config src/config.json --speed 0
+import argparse
+import json
+import sys
+import time
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from config import Config
+from decoder import parse_mac_addr
+from dissectors import Decoder
+from eventlog import EventLog
+from frame_filter import FrameFilter
+from engines import build_engine
+from mapper import Mapper
+from pipeline import Pipeline
+from stats import MAX_FLOWS, PacketStats
+
+from host.pcap import CaptureReader
+
+
+class ReplayClock:
+    # stands in for time.time(), driven by the capture timestamps
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def build_pipeline(config, clock, notify_callback=None, event_log=None, features=None, metrics=None):
+    mapper = Mapper(config.mac_address_to_devices())
+    stats_config = config.stats_config()
+    stats = PacketStats(mapper, notify_every_seconds=stats_config['interval'], max_flows=stats_config.get('max_flows', MAX_FLOWS), clock=clock)
+
+    def track(device, event):
+        stats.track(device, event)
+        if event_log is not None:
+            event_log.record_event(device, event, clock())
+
+    inference_engine = build_engine(config.inference_config(), config.tracking_devices(), notify_callback=notify_callback,
+                                    track_callback=track, clock=clock, debug=False)
+    layers = config.decoder_config().get('layers')
+    decoder = Decoder(layers=layers) if layers is not None else None
+    filter_config = config.filter_config()
+    frame_filter = None
+    if filter_config['enabled']:
+        frame_filter = FrameFilter.from_config(filter_config, config.mac_address_to_devices(), config.tracking_devices(field='mac'))
+    return Pipeline(mapper, stats, inference_engine, event_log=event_log, features=features, decoder=decoder, frame_filter=frame_filter, metrics=metrics)
+
+
+def build_event_log(config, path, packets=True):
+    device_macs = {name: parse_mac_addr(mac) for mac, name in config.mac_address_to_devices().items()}
+    log_config = config.log_config()
+    return EventLog(path, max_bytes=log_config.get('max_bytes', 256 * 1024), keep=log_config.get('keep', 3),
+                    batch_records=1024, device_macs=device_macs, packets=packets)
+
+
+def replay(frames, pipeline, clock, speed=0.0):
+    # speed: 0 replays as fast as possible, 1 at the original pace, N at N times the original pace
+    first_ts = None
+    start = time.monotonic()
+    count = 0
+    for ts, frame in frames:
+        clock.now = ts
+        if first_ts is None:
+            first_ts = ts
+        if speed > 0:
+            delay = (ts - first_ts) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        pipeline.inference_engine.tick(ts)
+        pipeline.process(frame, ts)
+        count += 1
+    return count, (clock.now - first_ts) if first_ts is not None else 0.0, time.monotonic() - start
+
+
+def _print_event(device, message):
+    # stdout carries the json summary
+    print(f"{device}: {message}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a pcap/pcapng capture through the home-events pipeline")
+    parser.add_argument("capture", help="pcap or pcapng file, ethernet link type")
+    parser.add_argument("--config", default="src/config.json", help="config.json used on the device")
+    parser.add_argument("--speed", type=float, default=0.0, help="0: as fast as possible, 1: original speed, N: N times faster")
+    parser.add_argument("--quiet", action="store_true", help="do not print events as they are detected")
+    parser.add_argument("--log", help="also write the binary event log (packet summaries and events) to this path")
+    args = parser.parse_args(argv)
+
+    config = Config(args.config)
+    config.load()
+    clock = ReplayClock()
+    event_log = build_event_log(config, args.log) if args.log else None
+    pipeline = build_pipeline(config, clock, notify_callback=None if args.quiet else _print_event, event_log=event_log)
+
+    with CaptureReader(args.capture) as reader:
+        count, capture_sec, wall_sec = replay(reader.frames(), pipeline, clock, speed=args.speed)
+    if event_log is not None:
+        event_log.close()
+
+    stats = pipeline.stats
+    print(json.dumps({
+        "frames": count,
+        "capture_sec": capture_sec,
+        "wall_sec": wall_sec,
+        "frames_per_sec": count / wall_sec if wall_sec > 0 else 0,
+        "filter": pipeline.frame_filter.stats() if pipeline.frame_filter is not None else None,
+        "packet_types": stats.packet_types,
+        "rates": stats.rates(clock()),
+        "stats": stats.top_flows(),
+        "events": stats.tracking,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+# coding: utf-8
+# the replay pipeline sharded over worker processes, for captures and busy segments one core cannot keep up with:
+#   python -m host.shard capture.pcapng --config src/config.json --workers 4
+#   sudo python -m host.shard --interface eth0 --config src/config.json --workers 4
+#
+# the parent process routes every frame to one worker: the worker owning the tracked device SimpleRuleEngine
+# credits the frame to (destination first), else a hash of the mac pair. a flow and a tracked device therefore
+# live in one worker, each worker owns a partition of the PacketStats and engine state. the model engine credits
+# both ends of a frame, a frame between tracked devices of two workers also goes to the other one for inference.
+# frames travel in batches through a shared memory ring per worker, only small control tuples are pickled. the
+# timestamps of every frame of a batch are shared by all workers, so each one applies the ticks the single process
+# loop makes before every frame (InferenceEngine.due() skips the idle ones) and fires events at the same times.
+# events carry their position in the capture and are emitted in that order once every worker finished the batch,
+# the stats partitions are merged into one PacketStats on request. both match host.replay for the same capture,
+# except the flows once the flow table evicted, and the rates beyond RateCounters.max_keys
+import argparse
+import json
+import sys
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from config import Config
+from decoder import parse_mac_addr
+from mapper import Mapper
+from rates import RateCounter
+from stats import MAX_FLOWS, PacketStats
+
+from host.afpacket import AfPacketCapture
+from host.pcap import CaptureReader
+from host.replay import ReplayClock, build_pipeline
+
+BATCH_FRAMES = 1024
+SLOTS = 4  # batches in flight per worker
+SLOT_BYTES = 4 * 1024 * 1024  # a whole batch can go to one worker
+# every worker slot starts with its frames count, then (frame index in the batch, length) and the frame per frame
+SLOT_HEADER = struct.Struct('I')
+RECORD = struct.Struct('II')
+INFERENCE_ONLY = 0x80000000  # flag of the frame index, the frame is counted by another worker
+IDLE_SEC = 0.01
+
+
+class ShardRouter:
+    def __init__(self, workers, owners, both_ends=False):
+        # owners: mac -> worker, for the macs of the tracked devices. both_ends: the engine credits a frame to its
+        # source and destination device
+        self.workers = workers
+        self.owners = owners
+        self.both_ends = both_ends
+
+    def route(self, frame):
+        # (worker, the other worker for inference or -1)
+        dst_owner = self.owners.get(bytes(frame[0:6]))
+        src_owner = self.owners.get(bytes(frame[6:12]))
+        if dst_owner is not None:
+            if self.both_ends and src_owner is not None and src_owner != dst_owner:
+                return dst_owner, src_owner
+            return dst_owner, -1
+        if src_owner is not None:
+            return src_owner, -1
+        return zlib.crc32(frame[0:12]) % self.workers, -1
+
+
+def _tick_order(engine, now, device_first):
+    # SimpleRuleEngine fires the devices of one tick in the order of its deadline heap, the model engine in the
+    # order the devices got their first frame
+    deadlines = getattr(engine, '_deadlines', None)
+    if deadlines is None:
+        return device_first
+    return {device: deadline for deadline, device in deadlines if deadline < now}
+
+
+def _rates_state(rate_counters):
+    return {key: [(counter.counts, counter.epochs) for counter in rate_counter.counters] for key, rate_counter in rate_counters.counters.items()}
+
+
+def _worker(index, config_path, devices, frames_memory, times_memory, slot_bytes, batch_frames, conn):
+    config = Config(config_path)
+    config.load()
+    clock = ReplayClock()
+    events = []
+    # position of the running tick or packet in the capture, the tick order of its devices
+    context = [0, 0, None]
+    first_event = {}
+
+    def notify(device, message):
+        phase = context[1]
+        key = (context[0], phase, context[2].get(device, 0) if phase == 0 else 0, device)
+        events.append((key, device, message))
+        if device not in first_event:
+            first_event[device] = key
+
+    pipeline = build_pipeline(config, clock, notify_callback=notify)
+    engine = pipeline.inference_engine
+    engine.set_devices_to_track(devices)
+    tracked = set(devices)
+    device_first = {} if getattr(engine, '_deadlines', None) is None else None
+    stats = pipeline.stats
+    process = pipeline.process
+    process_inference = pipeline.process_inference
+    packet_types = stats.packet_types
+    type_first = {}
+    flow_last = {}
+    frames_count = 0
+    view = frames_memory.buf
+    times = times_memory.buf.cast('d')
+    timestamps = highest = frame = None
+    while True:
+        message = conn.recv()
+        if message[0] == 'batch':
+            _, batch, slot, count = message
+            position = batch * batch_frames
+            # timestamps of the batch, then their running maximum
+            t = slot * batch_frames * 2
+            timestamps = times[t:t + count]
+            highest = times[t + batch_frames:t + batch_frames + count]
+            offset = (index * SLOTS + slot) * slot_bytes
+            records = SLOT_HEADER.unpack_from(view, offset)[0]
+            offset += SLOT_HEADER.size
+            done = -1
+            for _ in range(records + 1):
+                if records:
+                    frame_index, length = RECORD.unpack_from(view, offset)
+                    inference_only = frame_index & INFERENCE_ONLY
+                    frame_index &= ~INFERENCE_ONLY
+                    records -= 1
+                else:
+                    frame_index, length = count - 1, -1  # the ticks after the last frame of the worker
+                # the ticks the single process loop made since the previous frame of this worker
+                if frame_index > done and engine.due(highest[frame_index]):
+                    for i in range(done + 1, frame_index + 1):
+                        now = timestamps[i]
+                        if engine.due(now):
+                            context[0] = position + i
+                            context[1] = 0
+                            context[2] = _tick_order(engine, now, device_first)
+                            clock.now = now
+                            engine.tick(now)
+                done = frame_index
+                if length < 0:
+                    break
+                frame = view[offset + RECORD.size:offset + RECORD.size + length]
+                offset += RECORD.size + length
+                now = timestamps[frame_index]
+                clock.now = now
+                context[0] = position + frame_index
+                context[1] = 1
+                if inference_only:
+                    packet = process_inference(frame, now)
+                else:
+                    types_count = len(packet_types)
+                    packet = process(frame, now)
+                if device_first is not None and packet is not None:
+                    # the source gets its accumulator before the destination
+                    for end, device in ((0, packet.src_device), (1, packet.dst_device)):
+                        if device in tracked and device not in device_first:
+                            device_first[device] = (position + frame_index) * 2 + end
+                if inference_only:
+                    continue
+                if packet is not None:
+                    flow_last[(packet.src_mac, packet.dst_mac)] = position + frame_index
+                    if len(packet_types) != types_count:
+                        type_first[next(reversed(packet_types))] = position + frame_index
+                frames_count += 1
+            frame = None
+            if len(flow_last) > 4 * stats.flows.capacity:
+                flow_last = {key: flow_last[key] for key in stats.flows.entries if key in flow_last}
+            conn.send((batch, events[:]))
+            del events[:]
+        elif message[0] == 'snapshot':
+            conn.send({
+                'frames': frames_count,
+                'packets_count': stats.packets_count,
+                'filtered_count': stats.filtered_count,
+                'packet_types': [(packet_type, count, type_first[packet_type]) for packet_type, count in packet_types.items()],
+                'flows': [(key, entry, stats._flow_ips.get(key), flow_last.get(key, 0)) for key, entry in stats.flows.entries.items()],
+                'flows_total': stats.flows.total,
+                'flows_lost': stats.flows.lost_count,
+                'device_rates': _rates_state(stats.device_rates),
+                'packet_type_rates': _rates_state(stats.packet_type_rates),
+                'tracking': [(device, event, first_event[device]) for device, event in stats.tracking.items()],
+                'filter': list(pipeline.frame_filter.counts) if pipeline.frame_filter is not None else None,
+            })
+        else:
+            break
+    # the views must go before the shared memory is closed
+    del view, times, timestamps, highest, frame
+    conn.close()
+
+
+def _merge_rates(rate_counters, states):
+    # a ring slot holds the latest bucket any worker wrote to it, the workers which wrote that bucket add up
+    for state in states:
+        for key, windows in state.items():
+            rate_counter = rate_counters.counters.get(key)
+            if rate_counter is None:
+                if len(rate_counters.counters) >= rate_counters.max_keys:
+                    continue
+                rate_counter = rate_counters.counters[key] = RateCounter(rate_counters.windows)
+            for counter, (counts, epochs) in zip(rate_counter.counters, windows):
+                for slot in range(len(counts)):
+                    if epochs[slot] > counter.epochs[slot]:
+                        counter.epochs[slot] = epochs[slot]
+                        counter.counts[slot] = counts[slot]
+                    elif epochs[slot] == counter.epochs[slot] and epochs[slot] >= 0:
+                        counter.counts[slot] += counts[slot]
+
+
+def merge_snapshots(stats, snapshots):
+    # fills a fresh PacketStats with the partitions of the workers, in the order the single process saw things first
+    stats.packets_count = sum(snapshot['packets_count'] for snapshot in snapshots)
+    stats.filtered_count = sum(snapshot['filtered_count'] for snapshot in snapshots)
+    packet_types = {}
+    for snapshot in snapshots:
+        for packet_type, count, first in snapshot['packet_types']:
+            if packet_type in packet_types:
+                merged = packet_types[packet_type]
+                packet_types[packet_type] = (merged[0] + count, min(merged[1], first))
+            else:
+                packet_types[packet_type] = (count, first)
+    for packet_type, (count, _) in sorted(packet_types.items(), key=lambda item: item[1][1]):
+        stats.packet_types[packet_type] = count
+
+    # a flow lives in one worker. flows of equal count are listed in the order they reached it, their last packet
+    flows = [flow for snapshot in snapshots for flow in snapshot['flows']]
+    lost_count = max([snapshot['flows_lost'] for snapshot in snapshots] or [0])
+    if len(flows) > stats.flows.capacity:
+        flows.sort(key=lambda flow: (flow[1]['error'] - flow[1]['packets_count'], -flow[1]['packets_count'], flow[3]))
+        lost_count = max([lost_count] + [flow[1]['packets_count'] for flow in flows[stats.flows.capacity:]])
+        del flows[stats.flows.capacity:]
+    flows.sort(key=lambda flow: flow[3])
+    for key, entry, ips, _ in flows:
+        error = entry['error']
+        stats.flows.insert(key, entry, entry['packets_count'])
+        entry['error'] = error
+        if ips is not None:
+            stats._flow_ips[key] = ips
+    stats.flows.total = sum(snapshot['flows_total'] for snapshot in snapshots)
+    stats.flows.lost_count = lost_count
+
+    _merge_rates(stats.device_rates, [snapshot['device_rates'] for snapshot in snapshots])
+    _merge_rates(stats.packet_type_rates, [snapshot['packet_type_rates'] for snapshot in snapshots])
+    tracking = [item for snapshot in snapshots for item in snapshot['tracking']]
+    for device, event, _ in sorted(tracking, key=lambda item: item[2]):
+        stats.track(device, event)
+    return stats
+
+
+class ShardedPipeline:
+    def __init__(self, config, config_path, workers=4, batch_frames=BATCH_FRAMES, slot_bytes=SLOT_BYTES, notify_callback=None):
+        self.config = config
+        self.config_path = config_path
+        self.workers = workers
+        self.batch_frames = batch_frames
+        self.slot_bytes = slot_bytes
+        self.notify_callback = notify_callback
+        # tracked devices round robin over the workers
+        tracked = config.tracking_devices()
+        self.devices = [tracked[i::workers] for i in range(workers)]
+        owners = {device: i for i, devices in enumerate(self.devices) for device in devices}
+        self.router = ShardRouter(workers, {bytes(parse_mac_addr(mac)): owners[device]
+                                            for mac, device in config.mac_address_to_devices().items() if device in owners},
+                                  both_ends=config.inference_config().get('engine', 'rules') != 'rules')
+        self.frames_count = 0
+        self.now = 0.0  # timestamp of the last frame or tick
+        self._processes = []
+        self._connections = []
+        self._frames_memory = None
+        self._times_memory = None
+        self._batch = 0
+        self._count = 0  # frames and ticks in the current batch
+        self._highest = float('-inf')
+        self._offsets = [0] * workers
+        self._records = [0] * workers
+        self._acked = [0] * workers  # batches each worker finished
+        self._events = {}  # batch -> [events], until every worker finished it
+        self._emitted = 0
+
+    def start(self):
+        from multiprocessing import shared_memory
+        # fork hands the shared memory to the workers without registering it again
+        context = multiprocessing.get_context('fork')
+        self._frames_memory = shared_memory.SharedMemory(create=True, size=self.workers * SLOTS * self.slot_bytes)
+        self._times_memory = shared_memory.SharedMemory(create=True, size=SLOTS * self.batch_frames * 2 * 8)
+        self._view = self._frames_memory.buf
+        self._times = self._times_memory.buf.cast('d')
+        for index in range(self.workers):
+            parent, child = context.Pipe()
+            process = context.Process(target=_worker, args=(index, self.config_path, self.devices[index], self._frames_memory,
+                                                             self._times_memory, self.slot_bytes, self.batch_frames, child), daemon=True)
+            process.start()
+            child.close()
+            self._processes.append(process)
+            self._connections.append(parent)
+        self._begin()
+
+    def stop(self):
+        for connection in self._connections:
+            connection.send(('stop',))
+        for process in self._processes:
+            process.join()
+        self._view.release()
+        self._times.release()
+        for memory in (self._frames_memory, self._times_memory):
+            memory.close()
+            memory.unlink()
+
+    def _begin(self):
+        # the slot of the next batch must have been processed by every worker
+        slot = self._batch % SLOTS
+        self._wait(self._batch - SLOTS + 1)
+        for worker in range(self.workers):
+            self._offsets[worker] = (worker * SLOTS + slot) * self.slot_bytes + SLOT_HEADER.size
+            self._records[worker] = 0
+        self._count = 0
+        self._highest = float('-inf')
+
+    def _time(self, ts):
+        slot = self._batch % SLOTS
+        index = slot * self.batch_frames * 2 + self._count
+        self._times[index] = ts
+        if ts > self._highest:
+            self._highest = ts
+        self._times[index + self.batch_frames] = self._highest
+        self.now = ts
+        self._count += 1
+        if self._count == self.batch_frames:
+            self.flush()
+
+    def _fits(self, worker, length):
+        return self._offsets[worker] + RECORD.size + length <= (worker * SLOTS + self._batch % SLOTS + 1) * self.slot_bytes
+
+    def _write(self, worker, index, frame):
+        offset = self._offsets[worker]
+        end = offset + RECORD.size + len(frame)
+        RECORD.pack_into(self._view, offset, index, len(frame))
+        self._view[offset + RECORD.size:end] = frame
+        self._offsets[worker] = end
+        self._records[worker] += 1
+
+    def feed(self, ts, frame):
+        worker, other = self.router.route(frame)
+        length = len(frame)
+        if not self._fits(worker, length) or (other >= 0 and not self._fits(other, length)):
+            if not self._count:
+                raise ValueError(f"frame of {length} bytes larger than a batch slot")
+            self.flush()
+        self._write(worker, self._count, frame)
+        if other >= 0:
+            self._write(other, self._count | INFERENCE_ONLY, frame)
+        self.frames_count += 1
+        self._time(ts)
+
+    def tick(self, now):
+        # a live capture without traffic still has to fire the engine deadlines
+        self._time(now)
+
+    def flush(self):
+        # hands the current batch to every worker, also the ones without frames in it as they need its ticks
+        if not self._count:
+            return
+        slot = self._batch % SLOTS
+        for worker, connection in enumerate(self._connections):
+            SLOT_HEADER.pack_into(self._view, (worker * SLOTS + slot) * self.slot_bytes, self._records[worker])
+            connection.send(('batch', self._batch, slot, self._count))
+        self._events[self._batch] = []
+        self._batch += 1
+        self._begin()
+
+    def _wait(self, batches):
+        # collects the results of the workers until each one finished that many batches, emits the completed ones
+        for worker, connection in enumerate(self._connections):
+            while self._acked[worker] < batches:
+                batch, events = connection.recv()
+                self._events[batch].extend(events)
+                self._acked[worker] = batch + 1
+        completed = min(self._acked) if self._acked else 0
+        while self._emitted < completed:
+            events = self._events.pop(self._emitted)
+            self._emitted += 1
+            if self.notify_callback is not None:
+                events.sort(key=lambda event: event[0])
+                for _, device, message in events:
+                    self.notify_callback(device, message=message)
+
+    def snapshot(self):
+        # a PacketStats of everything fed so far
+        self.flush()
+        self._wait(self._batch)
+        for connection in self._connections:
+            connection.send(('snapshot',))
+        snapshots = [connection.recv() for connection in self._connections]
+        stats_config = self.config.stats_config()
+        stats = PacketStats(Mapper(self.config.mac_address_to_devices()), notify_every_seconds=stats_config['interval'],
+                            max_flows=stats_config.get('max_flows', MAX_FLOWS))
+        merge_snapshots(stats, snapshots)
+        filters = [snapshot['filter'] for snapshot in snapshots if snapshot['filter'] is not None]
+        self.filter_counts = [sum(counts) for counts in zip(*filters)] if filters else None
+        return stats
+
+
+def live_frames(capture, pipeline, tick_sec=1.0):
+    # (timestamp, frame) of a CaptureBackend, the idle periods flush the batch and tick the engines
+    next_tick = 0
+    while True:
+        count = capture.next_burst()
+        if count < 1:
+            if capture.eof:
+                return
+            now = time.time()
+            if now >= next_tick:
+                pipeline.tick(now)
+                pipeline.flush()
+                next_tick = now + tick_sec
+            capture.wait(IDLE_SEC)
+            continue
+        timestamps = capture.timestamps
+        frames = capture.frames
+        for i in range(count):
+            yield timestamps[i], frames[i]
+
+
+def _print_event(device, message):
+    # stdout carries the json summary
+    print(f"{device}: {message}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the home-events pipeline sharded over worker processes")
+    parser.add_argument("capture", nargs='?', help="pcap or pcapng file, ethernet link type")
+    parser.add_argument("--interface", help="capture from this interface with an AF_PACKET ring instead (needs CAP_NET_RAW), until interrupted")
+    parser.add_argument("--config", default="src/config.json", help="config.json used on the device")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch", type=int, default=BATCH_FRAMES, help="frames per batch handed to the workers")
+    parser.add_argument("--quiet", action="store_true", help="do not print events as they are detected")
+    args = parser.parse_args(argv)
+    if not args.capture and not args.interface:
+        parser.error("a capture file or --interface is required")
+
+    config = Config(args.config)
+    config.load()
+    pipeline = ShardedPipeline(config, args.config, workers=args.workers, batch_frames=args.batch,
+                               notify_callback=None if args.quiet else _print_event)
+    pipeline.start()
+    start = time.monotonic()
+    first_ts = None
+    try:
+        if args.interface:
+            capture = AfPacketCapture(args.interface)
+            capture.start()
+            try:
+                for ts, frame in live_frames(capture, pipeline):
+                    if first_ts is None:
+                        first_ts = ts
+                    pipeline.feed(ts, frame)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                capture.stop()
+        else:
+            with CaptureReader(args.capture) as reader:
+                for ts, frame in reader.frames():
+                    if first_ts is None:
+                        first_ts = ts
+                    pipeline.feed(ts, frame)
+        stats = pipeline.snapshot()
+    finally:
+        pipeline.stop()
+    wall_sec = time.monotonic() - start
+
+    count = pipeline.frames_count
+    print(json.dumps({
+        "frames": count,
+        "workers": args.workers,
+        "capture_sec": pipeline.now - first_ts if first_ts is not None else 0.0,
+        "wall_sec": wall_sec,
+        "frames_per_sec": count / wall_sec if wall_sec > 0 else 0,
+        "filter": dict(zip(('dropped', 'counted', 'processed'), pipeline.filter_counts)) if pipeline.filter_counts is not None else None,
+        "packet_types": stats.packet_types,
+        "rates": stats.rates(pipeline.now),
+        "stats": stats.top_flows(),
+        "events": stats.tracking,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# coding: utf-8
+# synthetic ethernet frames for benchmarks, mixing the traffic classes seen on a home LAN
+import random
+import struct
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from decoder import parse_mac_addr
+
+BROADCAST_MAC = b'\xff' * 6
+IPV6_MULTICAST_MAC = b'\x33\x33\x00\x00\x00\x01'
+
+# relative weight of each traffic class
+DEFAULT_MIX = {
+    'arp': 20,
+    'ipv4_icmp': 10,
+    'ipv4_udp': 25,
+    'ipv4_tcp': 20,
+    'ipv6_icmpv6': 15,
+    'unknown': 10,
+}
+
+
+def _ethernet(dst_mac, src_mac, eth_proto, payload):
+    return dst_mac + src_mac + struct.pack('!H', eth_proto) + payload
+
+
+def _ipv4(src_ip, dst_ip, proto, payload):
+    total_length = 20 + len(payload)
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, total_length, 0, 0, 64, proto, 0, src_ip, dst_ip) + payload
+
+
+def _ipv6(src_ip, dst_ip, next_header, payload):
+    return struct.pack('!IHBB16s16s', 0x60000000, len(payload), next_header, 255, src_ip, dst_ip) + payload
+
+
+class SyntheticTraffic:
+    def __init__(self, devices, seed=1, mix=None, untracked_hosts=40, tracked_share=0.3):
+        # devices: the 'devices' list of config.json
+        self.random = random.Random(seed)
+        self.mix = mix or DEFAULT_MIX
+        self.tracked = [parse_mac_addr(d['mac']) for d in devices if d.get('track')]
+        self.known = [parse_mac_addr(d['mac']) for d in devices if not d.get('track')]
+        self.untracked = [bytes([0x02] + [self.random.randrange(256) for _ in range(5)]) for _ in range(untracked_hosts)]
+        self.tracked_share = tracked_share
+        self._ips = {}
+        self._classes = list(self.mix)
+        self._weights = [self.mix[c] for c in self._classes]
+
+    def _host(self):
+        r = self.random.random()
+        if self.tracked and r < self.tracked_share:
+            return self.random.choice(self.tracked)
+        if self.known and r < self.tracked_share * 2:
+            return self.random.choice(self.known)
+        return self.random.choice(self.untracked)
+
+    def _ip(self, mac):
+        ip = self._ips.get(mac)
+        if ip is None:
+            ip = self._ips[mac] = bytes([192, 168, 0, 10 + len(self._ips) % 240])
+        return ip
+
+    def _ip_v6(self, mac):
+        return b'\xfe\x80' + b'\x00' * 6 + bytes([mac[0] ^ 0x02]) + mac[1:3] + b'\xff\xfe' + mac[3:6]
+
+    def frame(self):
+        kind = self.random.choices(self._classes, self._weights)[0]
+        src = self._host()
+        dst = self._host()
+        while dst == src:
+            dst = self._host()
+        if kind == 'arp':
+            opcode = self.random.choice((1, 2))
+            arp = struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, opcode, src, self._ip(src), b'\x00' * 6 if opcode == 1 else dst, self._ip(dst))
+            return _ethernet(BROADCAST_MAC if opcode == 1 else dst, src, 0x0806, arp + b'\x00' * 18)
+        if kind == 'ipv4_icmp':
+            icmp = struct.pack('!BBHHH', self.random.choice((0, 8)), 0, 0, 1, 1) + b'\x00' * 32
+            return _ethernet(dst, src, 0x0800, _ipv4(self._ip(src), self._ip(dst), 1, icmp))
+        if kind == 'ipv4_udp':
+            payload = b'\x00' * self.random.randrange(16, 512)
+            udp = struct.pack('!HHHH', self.random.randrange(1024, 65535), self.random.choice((53, 123, 1900, 5353)), 8 + len(payload), 0) + payload
+            return _ethernet(dst, src, 0x0800, _ipv4(self._ip(src), self._ip(dst), 17, udp))
+        if kind == 'ipv4_tcp':
+            payload = b'\x00' * self.random.choice((0, 0, 64, 1200, 1460))
+            tcp = struct.pack('!HHIIBBHHH', self.random.randrange(1024, 65535), self.random.choice((80, 443, 8080)), 0, 0, 0x50, 0x10, 1024, 0, 0) + payload
+            return _ethernet(dst, src, 0x0800, _ipv4(self._ip(src), self._ip(dst), 6, tcp))
+        if kind == 'ipv6_icmpv6':
+            icmp = struct.pack('!BBH', self.random.choice((133, 134, 135, 136)), 0, 0) + b'\x00' * 20
+            return _ethernet(IPV6_MULTICAST_MAC, src, 0x86DD, _ipv6(self._ip_v6(src), b'\xff\x02' + b'\x00' * 13 + b'\x01', 0x3A, icmp))
+        eth_proto = self.random.choice((0x88CC, 0x893A, 0x8899, 0x888E))
+        return _ethernet(dst, src, eth_proto, b'\x00' * 46)
+
+    def frames(self, count):
+        return [self.frame() for _ in range(count)]
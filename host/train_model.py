@@ -0,0 +1,138 @@
+# coding: utf-8
+# trains the presence MLP on host.features output and writes the int8 model run by QuantizedModelEngine:
+#   python -m host.train_model features.npz --hidden 8 --output src/model.json (requires numpy)
+#
+# model.json: {"features": [...], "input_offset": [F floats], "input_scale": [F floats], "threshold": int,
+#              "layers": [{"inputs": n, "outputs": m, "weights": [m * n int8, row major], "bias": [m int32],
+#                          "multiplier": int, "shift": int}, ...]}
+# inputs are quantized as clamp(int((x - offset) * scale), -127, 127). hidden layers carry multiplier and shift
+# (relu, then (acc * multiplier) >> shift clamped to 127), the last layer has none and returns its accumulator
+import argparse
+import json
+from array import array
+
+import numpy as np
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from features import FEATURE_NAMES, FEATURES_COUNT
+from model_engine import QuantizedModel
+
+INPUT_RANGE = 4.0  # standard deviations mapped to the int8 range
+MAX_SHIFT = 16
+# CircuitPython small ints are 31 bit signed, acc * multiplier must stay below that to avoid long ints
+SMALL_INT_LIMIT = 1 << 30
+
+
+def train_mlp(X, y, hidden=8, epochs=500, learning_rate=0.05, seed=1):
+    # full batch adam on the logistic loss, X is standardized
+    rng = np.random.default_rng(seed)
+    params = {
+        'w1': rng.normal(0, 1 / np.sqrt(X.shape[1]), (hidden, X.shape[1])),
+        'b1': np.zeros(hidden),
+        'w2': rng.normal(0, 1 / np.sqrt(hidden), (1, hidden)),
+        'b2': np.zeros(1),
+    }
+    moments = {name: (np.zeros_like(value), np.zeros_like(value)) for name, value in params.items()}
+    positive = max(y.mean(), 1e-3)
+    weights = np.where(y > 0, 0.5 / positive, 0.5 / max(1 - positive, 1e-3))  # balanced classes
+    for step in range(1, epochs + 1):
+        pre = X @ params['w1'].T + params['b1']
+        h = np.maximum(pre, 0)
+        logit = h @ params['w2'].T + params['b2']
+        p = 1 / (1 + np.exp(-logit[:, 0]))
+        d_logit = ((p - y) * weights / len(y))[:, None]
+        d_h = d_logit @ params['w2'] * (pre > 0)
+        grads = {'w2': d_logit.T @ h, 'b2': d_logit.sum(0), 'w1': d_h.T @ X, 'b1': d_h.sum(0)}
+        for name, grad in grads.items():
+            m, v = moments[name]
+            m[:] = 0.9 * m + 0.1 * grad
+            v[:] = 0.999 * v + 0.001 * grad * grad
+            params[name] -= learning_rate * (m / (1 - 0.9 ** step)) / (np.sqrt(v / (1 - 0.999 ** step)) + 1e-8)
+    return params
+
+
+def _requantize(ratio, max_acc):
+    # multiplier / 2**shift ~ ratio with the largest shift keeping max_acc * multiplier a small int
+    for shift in range(MAX_SHIFT, -1, -1):
+        multiplier = max(1, int(round(ratio * (1 << shift))))
+        if max_acc * multiplier < SMALL_INT_LIMIT:
+            return multiplier, shift
+    return 1, 0
+
+
+def quantize_mlp(params, mean, std, X):
+    # X: standardized training inputs, used to calibrate the hidden activation range
+    input_scale = 127 / INPUT_RANGE
+    w1_scale = 127 / max(np.abs(params['w1']).max(), 1e-9)
+    w1 = np.clip(np.round(params['w1'] * w1_scale), -127, 127).astype(np.int64)
+    b1 = np.round(params['b1'] * w1_scale * input_scale).astype(np.int64)
+    hidden_max = max(np.maximum(X @ params['w1'].T + params['b1'], 0).max(), 1e-9)
+    hidden_scale = 127 / hidden_max
+    max_acc1 = int(127 * np.abs(w1).sum(axis=1).max() + np.abs(b1).max())
+    multiplier, shift = _requantize(hidden_scale / (w1_scale * input_scale), max_acc1)
+
+    w2_scale = 127 / max(np.abs(params['w2']).max(), 1e-9)
+    w2 = np.clip(np.round(params['w2'] * w2_scale), -127, 127).astype(np.int64)
+    b2 = np.round(params['b2'] * w2_scale * hidden_scale).astype(np.int64)
+    return {
+        'features': list(FEATURE_NAMES),
+        'input_offset': [float(value) for value in mean],
+        'input_scale': [float(input_scale / value) for value in std],
+        'threshold': 0,  # logit 0, probability 0.5
+        'layers': [
+            {'inputs': int(w1.shape[1]), 'outputs': int(w1.shape[0]), 'weights': [int(v) for v in w1.ravel()],
+             'bias': [int(v) for v in b1], 'multiplier': multiplier, 'shift': shift},
+            {'inputs': int(w2.shape[1]), 'outputs': 1, 'weights': [int(v) for v in w2.ravel()], 'bias': [int(v) for v in b2]},
+        ],
+    }
+
+
+def random_model(hidden=8, seed=1):
+    # untrained model of the right shape, for benchmarks
+    rng = np.random.default_rng(seed)
+    params = {'w1': rng.normal(0, 0.3, (hidden, FEATURES_COUNT)), 'b1': np.zeros(hidden),
+              'w2': rng.normal(0, 0.3, (1, hidden)), 'b2': np.zeros(1)}
+    X = rng.normal(0, 1, (256, FEATURES_COUNT))
+    return quantize_mlp(params, np.zeros(FEATURES_COUNT), np.ones(FEATURES_COUNT), X)
+
+
+def standardize(X):
+    mean = X.mean(axis=0)
+    std = X.std(axis=0)
+    std[std == 0] = 1
+    return mean, std
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train and quantize the presence model")
+    parser.add_argument("features", help=".npz written by host.features")
+    parser.add_argument("--hidden", type=int, default=8)
+    parser.add_argument("--epochs", type=int, default=500)
+    parser.add_argument("--output", default="src/model.json")
+    args = parser.parse_args(argv)
+
+    data = np.load(args.features)
+    X, y = data['X'], data['present'].astype(np.float64)
+    mean, std = standardize(X)
+    Xs = (X - mean) / std
+    params = train_mlp(Xs, y, hidden=args.hidden, epochs=args.epochs)
+    model = quantize_mlp(params, mean, std, Xs)
+
+    quantized = QuantizedModel(model)
+    row = array('b', [0] * FEATURES_COUNT)
+    float_logit = np.maximum(Xs @ params['w1'].T + params['b1'], 0) @ params['w2'].T + params['b2']
+    agree = 0
+    correct = 0
+    for features, logit, label in zip(X, float_logit[:, 0], y):
+        quantized.quantize(features, row, 0)
+        predicted = quantized.evaluate(row) > quantized.threshold
+        agree += predicted == (logit > 0)
+        correct += predicted == (label > 0)
+    with open(args.output, 'w') as f:
+        json.dump(model, f)
+    print(f"{len(y)} windows, int8 accuracy {correct / max(len(y), 1):.3f}, agreement with float model {agree / max(len(y), 1):.3f}, "
+          f"{quantized.size_bytes()} bytes of weights written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
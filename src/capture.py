@@ -0,0 +1,151 @@
+# coding: utf-8
+import struct
+import time
+
+MAX_FRAME_SIZE = 1518
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+LINKTYPE_ETHERNET = 1
+
+
+class CaptureBackend:
+    # where the pipeline gets its frames from. next_burst() returns the number of frames waiting, available in
+    # self.frames[:count] until the next call. the counters describe the last burst and the losses so far
+    def __init__(self, ring_size):
+        self.frames = [None] * ring_size
+        self.backlog_bytes = 0
+        self.burst_bytes = 0
+        self.burst_frames = 0
+        self.remaining_bytes = 0
+        self.oversized_frames = 0
+        self.dropped_bytes = 0
+        # frames the source reports as lost, e.g. kernel drops
+        self.dropped_frames = 0
+        # bursts which found the buffer without room for another frame
+        self.full_bursts = 0
+        # a finite source (file, closed pipe) has nothing left
+        self.eof = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def next_burst(self):
+        raise NotImplementedError
+
+    def wait(self, timeout):
+        # idle until frames may be waiting, at most timeout seconds
+        time.sleep(timeout)
+
+
+class PcapStreamCapture(CaptureBackend):
+    # classic pcap records read from a file or a pipe (tcpdump -w -), a stand-in for the capture hardware which
+    # needs no privileges. a stream without data (readinto returns None) gives an empty burst, frames are copied
+    # out of the read buffer into the ring so the buffer can be refilled
+    def __init__(self, stream, ring_size=64, frame_size=MAX_FRAME_SIZE, buffer_size=64 * 1024):
+        super().__init__(ring_size)
+        self._stream = stream
+        self._ring_size = ring_size
+        self._frame_size = frame_size
+        self._ring = [memoryview(bytearray(frame_size)) for _ in range(ring_size)]
+        self._buffer = memoryview(bytearray(buffer_size))
+        self._start = 0
+        self._end = 0
+        self._skip = 0  # bytes left of an oversized record
+        self._record_format = None  # set by the file header
+        self._ts_scale = 1e-6
+        # capture timestamp of each frame of the burst
+        self.timestamps = [0.0] * ring_size
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _fill(self):
+        buffer = self._buffer
+        if self._start:
+            # keep the partial record at the start of the buffer
+            waiting = self._end - self._start
+            buffer[:waiting] = buffer[self._start:self._end]
+            self._start = 0
+            self._end = waiting
+        if self.eof or self._end == len(buffer):
+            return
+        read = self._stream.readinto(buffer[self._end:])
+        if read is None:
+            return
+        if read == 0:
+            self.eof = True
+        self._end += read
+
+    def _read_header(self):
+        magic = struct.unpack_from('<I', self._buffer, self._start)[0]
+        endian = '<'
+        if magic not in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            magic = struct.unpack_from('>I', self._buffer, self._start)[0]
+            endian = '>'
+            if magic not in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                raise ValueError("not a pcap stream, pcapng is not supported")
+        linktype = struct.unpack_from(endian + 'I', self._buffer, self._start + 20)[0]
+        if linktype != LINKTYPE_ETHERNET:
+            raise ValueError(f"unsupported link type {linktype}")
+        self._ts_scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        self._record_format = endian + 'IIII'
+        self._start += 24
+
+    def next_burst(self):
+        self.burst_frames = 0
+        self.burst_bytes = 0
+        if self._stream is None:
+            return 0
+        self._fill()
+        self.backlog_bytes = self._end - self._start
+        if self._record_format is None:
+            if self._end - self._start < 24:
+                return 0
+            self._read_header()
+        buffer = self._buffer
+        record_format = self._record_format
+        start = self._start
+        end = self._end
+        count = 0
+        while count < self._ring_size:
+            if self._skip:
+                skipped = min(self._skip, end - start)
+                start += skipped
+                self._skip -= skipped
+                if self._skip:
+                    break
+            if end - start < 16:
+                break
+            ts_sec, ts_frac, size, _ = struct.unpack_from(record_format, buffer, start)
+            if size > self._frame_size:
+                self.oversized_frames += 1
+                self._skip = size
+                start += 16
+                continue
+            if end - start < 16 + size:
+                break
+            slot = self._ring[count]
+            slot[:size] = buffer[start + 16:start + 16 + size]
+            self.frames[count] = slot[:size]
+            self.timestamps[count] = ts_sec + ts_frac * self._ts_scale
+            count += 1
+            start += 16 + size
+        if count == self._ring_size and end == len(buffer):
+            self.full_bursts += 1
+        self.burst_frames = count
+        self.burst_bytes = start - self._start
+        self.remaining_bytes = end - start
+        self._start = start
+        return count
@@ -4,13 +4,24 @@ import busio
 import digitalio
 from adafruit_wiznet5k.adafruit_wiznet5k import WIZNET5K
 
-from config import Config
+from config import Config, ConfigReloader
+from decoder import parse_mac_addr
+from dissectors import Decoder
+from eventlog import EventLog
+from features import FEATURE_NAMES, FeatureExtractor
+from frame_filter import FrameFilter
 from mapper import Mapper
+from metrics import Metrics
 from notifier import MqttNotifier
-from decoder import decode_packet
+from payload import StatsSerializer
 from inference import *
+from load_shedder import LoadShedder
+from engines import build_engine, reconfigure_engine
+from pipeline import Pipeline
+from scheduler import Scheduler
 from sniffer import Sniffer
-from stats import PacketStats
+from sockets import SocketBudget
+from stats import MAX_FLOWS, PacketStats
 from web_server import web_server_instance
 
 ##SPI0
@@ -55,25 +66,41 @@ print("MAC:", [hex(i) for i in eth.mac_address])
 print("IP:", eth.pretty_ip(eth.ip_address))
 
 mapper = Mapper(config.mac_address_to_devices())
-sniffer = Sniffer(eth, debug=False)
+# every socket of the chip is handed out by the budget, the sniffer takes socket 0 first
+sockets = SocketBudget(eth)
+sniffer = Sniffer(eth, debug=False, sockets=sockets)
 
 notifier = None
 if config.notify_enabled():
     mqtt_config = config.mqtt_config()
-    notifier = MqttNotifier(eth=eth, host=mqtt_config['host'], topic=mqtt_config['topic'], mqtt_user=mqtt_config['username'], mqtt_password=mqtt_config['password'])
+    notifier = MqttNotifier(eth=eth, host=mqtt_config['host'], topic=mqtt_config['topic'], mqtt_user=mqtt_config['username'], mqtt_password=mqtt_config['password'], sockets=sockets)
 
 
 stats_config = config.stats_config()
 if stats_config['notify'] and notifier:
     print(f"Stats will be sent to MQTT, config: {stats_config}")
 
-stats = PacketStats(mapper, notify_every_seconds=stats_config['interval'])
+stats = PacketStats(mapper, notify_every_seconds=stats_config['interval'], max_flows=stats_config.get('max_flows', MAX_FLOWS))
 
 rules_notify_callback = None
 if notifier:
     rules_notify_callback = notifier.notify
 
-inference_engine = SimpleRuleEngine(devices_to_track=config.tracking_devices(), notify_callback=rules_notify_callback, track_callback=stats.track)
+event_log = None
+log_config = config.log_config()
+if log_config['enabled']:
+    device_macs = {name: parse_mac_addr(mac) for mac, name in config.mac_address_to_devices().items()}
+    event_log = EventLog(log_config.get('path', '/logs/events.bin'), max_bytes=log_config.get('max_bytes', 256 * 1024), keep=log_config.get('keep', 3),
+                         device_macs=device_macs, packets=log_config.get('packets', False))
+
+
+def track(device, event):
+    stats.track(device, event)
+    if event_log is not None:
+        event_log.record_event(device, event, time.time())
+
+
+inference_engine = build_engine(config.inference_config(), config.tracking_devices(), notify_callback=rules_notify_callback, track_callback=track)
 
 web_server = None
 if config.web_server_enabled():
@@ -81,28 +108,222 @@ if config.web_server_enabled():
 
 sniffer.start()
 if web_server:
-    web_server.begin(eth, stats)
+    web_server.begin(eth, stats, sockets=sockets)
 
 if notifier:
     notifier.start()
 
-last_notify_time = time.time()
-
-packet_idx = 0
-while True:
-    size, buf = sniffer.next_packet()
-    if size < 0:
-        continue
-    print("Packet:", packet_idx)
-    packet = decode_packet(buf[2:])  # first 2 bytes are the size of the buffer
-    mapper.map_packet(packet, map_unknown_to='')
-    stats.update(packet)
-    inference_engine.update(packet)
-    now = time.time()
-    if notifier and stats_config['notify'] and last_notify_time < now - stats_config['interval']:
-        notifier.notify('stats', json.dumps({"stats": stats.stats, "packet_types": stats.packet_types, "events": stats.tracking}))
-        last_notify_time = time.time()
+features = None
+features_config = config.features_config()
+if features_config['enabled']:
+    def publish_features(device, window_start, values):
+        if notifier:
+            notifier.notify(f"features/{device}", json.dumps({"window_start": window_start, "features": dict(zip(FEATURE_NAMES, values))}), message_class='stats')
+
+    features = FeatureExtractor(devices=config.tracking_devices(), window_sec=features_config.get('window_sec', 60), emit_callback=publish_features)
+
+decoder = None
+decoder_layers = config.decoder_config().get('layers')
+if decoder_layers is not None:
+    decoder = Decoder(layers=decoder_layers)
+
+metrics = None
+metrics_config = config.metrics_config()
+if metrics_config['enabled']:
+    metrics = Metrics()
+
+frame_filter = None
+filter_config = config.filter_config()
+if filter_config['enabled']:
+    frame_filter = FrameFilter.from_config(filter_config, config.mac_address_to_devices(), config.tracking_devices(field='mac'))
+
+pipeline = Pipeline(mapper, stats, inference_engine, event_log=event_log, features=features, decoder=decoder, frame_filter=frame_filter, metrics=metrics)
+
+# packets processed per capture step, the rx buffer is drained between every other task
+CAPTURE_BUDGET = 32
+
+
+capture_read = metrics.histogram('stage_seconds', labels='stage="capture_read"') if metrics else None
+
+shedder = None
+shedding_config = config.load_shedding_config()
+if shedding_config['enabled']:
+    shedder = LoadShedder(pipeline, tracked_macs=[parse_mac_addr(mac) for mac in config.tracking_devices(field='mac')],
+                          high_backlog=shedding_config.get('high_backlog', 1024), max_lag_sec=shedding_config.get('max_lag_sec', 0.1),
+                          max_sample_every=shedding_config.get('max_sample_every', 32), recover_sec=shedding_config.get('recover_sec', 5))
+
+
+def capture_step(now, budget):
+    processed = 0
+    backlog = -1
+    while processed < budget:
+        if capture_read is None:
+            frames_count = sniffer.next_burst()
+        else:
+            start = metrics.clock_ns()
+            frames_count = sniffer.next_burst()
+            capture_read.observe_ns(metrics.clock_ns() - start)
+        if backlog < 0:
+            backlog = sniffer.backlog_bytes  # what piled up while the other tasks ran
+        if frames_count < 1:
+            break
+        wall_now = time.time()  # one clock read per burst
+        for frame_idx in range(frames_count):
+            pipeline.process(sniffer.frames[frame_idx], wall_now)
+        processed += frames_count
+    if shedder is not None:
+        shedder.update(now, scheduler.clock(), backlog)
+    return processed
+
+
+def presence_step(now, budget):
+    wall_now = time.time()
+    pipeline.inference_engine.tick(wall_now)
+    if features is not None:
+        features.tick(wall_now)
+
+
+stats_serializer = StatsSerializer(stats, full_every=stats_config.get('full_every', 10), encoding=stats_config.get('encoding', 'json'))
+stats_topic = 'stats' if stats_serializer.encoding == 'json' else 'stats/' + stats_serializer.encoding
+stats_full_next = False
+
+
+def stats_step(now, budget):
+    global stats_full_next
+    if not stats_config['notify']:
+        return
+    # a delta still queued is replaced by this message, so it has to be a full one
+    full = stats_full_next or notifier.is_queued(stats_topic)
+    stats_full_next = False
+    notifier.notify(stats_topic, stats_serializer.dumps(time.time(), full=full), message_class='stats')
+
+
+def web_step(now, budget):
+    web_server.loop()
+
+
+def mqtt_step(now, budget):
+    return notifier.flush(budget)
+
+
+def log_step(now, budget):
+    return event_log.flush()
+
 
+frames_rate = {'frames': 0, 'at': time.monotonic(), 'per_sec': 0.0}
+
+
+def frames_total():
+    return pipeline.packets_count + stats.filtered_count + pipeline.skipped_count
+
+
+def metrics_step(now, budget):
+    frames = frames_total()
+    at = time.monotonic()
+    if at > frames_rate['at']:
+        frames_rate['per_sec'] = (frames - frames_rate['frames']) / (at - frames_rate['at'])
+    frames_rate['frames'] = frames
+    frames_rate['at'] = at
+    metrics.collect_garbage()
+    if notifier and metrics_config.get('notify'):
+        notifier.notify('metrics', json.dumps(metrics.summary()), message_class='stats')
+
+
+if metrics:
+    metrics.counter('frames_total', frames_total, help='frames received, processed or counted by the frame filter')
+    metrics.gauge('frames_per_second', lambda: frames_rate['per_sec'], help='over the last metrics interval')
+    metrics.counter('dropped_frames_estimate', lambda: sniffer.full_bursts + sniffer.oversized_frames,
+                    help='lower bound, rx buffer found full plus oversized frames')
+    metrics.counter('dropped_bytes_total', lambda: sniffer.dropped_bytes, help='rx bytes discarded after a corrupted length')
+    metrics.gauge('sample_every', lambda: stats.sample_every, help='1 in N frames counted in the stats, 1 without overload')
+    metrics.counter('filtered_frames_total', lambda: stats.filtered_count, help='frames only counted by the frame filter')
+    if notifier:
+        metrics.counter('mqtt_published_total', lambda: notifier.published)
+        metrics.counter('mqtt_dropped_total', lambda: notifier.dropped)
+        metrics.gauge('mqtt_queued', notifier.queued)
     if web_server:
-        web_server.loop()
-    packet_idx += 1
+        web_server.metrics = metrics
+
+
+# config.json changes applied while running, the other sections need a restart
+def apply_devices(previous):
+    mapper.update(config.mac_address_to_devices())
+    pipeline.inference_engine.set_devices_to_track(config.tracking_devices())
+    if features is not None:
+        features.set_devices(config.tracking_devices())
+    if event_log is not None:
+        event_log.device_macs = {name: parse_mac_addr(mac) for mac, name in config.mac_address_to_devices().items()}
+    if shedder is not None:
+        shedder.set_tracked_macs([parse_mac_addr(mac) for mac in config.tracking_devices(field='mac')])
+    apply_filter(None)
+
+
+def apply_mqtt(previous):
+    if notifier:
+        mqtt_config = config.mqtt_config()
+        notifier.reconfigure(host=mqtt_config['host'], topic=mqtt_config['topic'], mqtt_user=mqtt_config['username'], mqtt_password=mqtt_config['password'])
+
+
+def apply_stats(previous):
+    global stats_config, stats_topic, stats_full_next
+    stats_config = config.stats_config()
+    stats.notify_every_seconds = stats_config['interval']
+    stats.resize_flows(stats_config.get('max_flows', MAX_FLOWS))
+    stats_serializer.full_every = stats_config.get('full_every', 10)
+    encoding = stats_config.get('encoding', 'json')
+    if encoding != stats_serializer.encoding:
+        stats_serializer.encoding = encoding
+        stats_topic = 'stats' if encoding == 'json' else 'stats/' + encoding
+        stats_full_next = True  # nothing was published on the new topic yet
+    if stats_task is not None:
+        stats_task.interval = stats_config['interval']
+
+
+def apply_inference(previous):
+    if not reconfigure_engine(pipeline.inference_engine, config.inference_config(), previous, config.tracking_devices()):
+        print("Inference engine changed, presence state is reset")
+        pipeline.inference_engine = build_engine(config.inference_config(), config.tracking_devices(), notify_callback=rules_notify_callback, track_callback=track)
+
+
+def apply_filter(previous):
+    filter_config = config.filter_config()
+    pipeline.frame_filter = None
+    if filter_config['enabled']:
+        pipeline.frame_filter = FrameFilter.from_config(filter_config, config.mac_address_to_devices(), config.tracking_devices(field='mac'))
+
+
+def apply_decoder(previous):
+    layers = config.decoder_config().get('layers')
+    pipeline.decoder = Decoder(layers=layers) if layers is not None else None
+
+
+reloader = ConfigReloader(config, {'devices': apply_devices, 'mqtt': apply_mqtt, 'stats': apply_stats, 'inference': apply_inference,
+                                   'filter': apply_filter, 'decoder': apply_decoder})
+if web_server:
+    web_server.reload_callback = reloader.reload
+
+
+def config_step(now, budget):
+    reloader.check()
+
+
+scheduler = Scheduler(metrics=metrics)
+scheduler.add('capture', capture_step, budget=CAPTURE_BUDGET, priority=True)
+scheduler.add('presence', presence_step, interval=1)
+scheduler.add('config', config_step, interval=5)
+if metrics:
+    scheduler.add('metrics', metrics_step, interval=metrics_config.get('interval', 10))
+if web_server:
+    web_task = scheduler.add('web', web_step, interval=0.05)
+    if shedder is not None:
+        shedder.defer(web_task, shedding_config.get('web_interval', 1))
+if event_log:
+    scheduler.add('log', log_step, interval=10)
+stats_task = None
+if notifier:
+    scheduler.add('mqtt', mqtt_step, interval=0.1, budget=0.05)
+    stats_task = scheduler.add('stats', stats_step, interval=stats_config['interval'], delay=stats_config['interval'])
+    if shedder is not None:
+        shedder.defer(stats_task, shedding_config.get('stats_interval', 300))
+
+scheduler.run_forever()
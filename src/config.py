@@ -1,19 +1,59 @@
 # coding: utf-8
 import json
+import os
 
 
 class Config:
     def __init__(self, file='config.json'):
         self.__config_file = file
         self.__config = {}
+        self.__mtime = None
 
     def load(self):
         with open(self.__config_file, 'r') as f:
             self.__config = json.load(f)
+        self.__mtime = self._file_mtime()
 
     def save(self):
         with open(self.__config_file, 'w') as f:
             json.dump(self.__config, f)
+        self.__mtime = self._file_mtime()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.__config_file)[8]
+        except OSError:
+            return None
+
+    def modified(self):
+        # one stat call, cheap enough to poll
+        return self._file_mtime() != self.__mtime
+
+    def reload(self):
+        # loads the file again, returns {section: previous value} of the top level sections which changed.
+        # a file which does not parse raises and the current configuration is kept
+        previous = self.__config
+        try:
+            self.load()
+        except (OSError, ValueError):
+            self.__mtime = self._file_mtime()  # not retried until the file changes again
+            raise
+        changed = {}
+        for section in set(previous) | set(self.__config):
+            if previous.get(section) != self.__config.get(section):
+                changed[section] = previous.get(section)
+        return changed
+
+    def restore(self, sections):
+        # puts back the {section: previous value} returned by reload(), the file is not read again until it changes
+        for section, value in sections.items():
+            if value is None:
+                self.__config.pop(section, None)
+            else:
+                self.__config[section] = value
+
+    def section(self, name):
+        return self.__config.get(name)
 
     def mac_address_to_devices(self):
         devices_map = {d['mac']: d['name'] for d in self.__config['devices']}
@@ -35,5 +75,74 @@ class Config:
     def notify_enabled(self):
         return self.__config.get("notify", {"enabled": False})['enabled']
 
+    def log_config(self):
+        return self.__config.get("log", {"enabled": False})
+
+    def features_config(self):
+        return self.__config.get("features", {"enabled": False, "window_sec": 60})
+
+    def load_shedding_config(self):
+        return self.__config.get("load_shedding", {"enabled": False})
+
+    def metrics_config(self):
+        return self.__config.get("metrics", {"enabled": False})
+
+    def filter_config(self):
+        return self.__config.get("filter", {"enabled": False})
+
+    def decoder_config(self):
+        return self.__config.get("decoder", {"layers": None})
+
+    def inference_config(self):
+        return self.__config.get("inference", {"engine": "rules"})
+
     def web_server_enabled(self):
-        return self.__config.get("web", {"enabled": False})['enabled']
\ No newline at end of file
+        return self.__config.get("web", {"enabled": False})['enabled']
+
+
+class ConfigReloader:
+    # applies config.json changes to the running objects instead of restarting the board, so capture keeps
+    # running and the presence state survives. handlers: {section: callable(previous value)}, sections without
+    # a handler are only read at boot and reported as needing a restart
+    def __init__(self, config, handlers):
+        self.config = config
+        self.handlers = handlers
+        self.reloads = 0
+
+    def check(self):
+        if self.config.modified():
+            return self.reload()
+        return None
+
+    def reload(self):
+        try:
+            changed = self.config.reload()
+        except (OSError, ValueError) as e:
+            print(f"Config reload failed, keeping the current config: {e}")
+            return {'error': str(e)}
+        applied = []
+        restart_required = []
+        section = None
+        try:
+            for section, previous in changed.items():
+                handler = self.handlers.get(section)
+                if handler is None:
+                    restart_required.append(section)
+                    continue
+                handler(previous)
+                applied.append(section)
+        except Exception as e:  # a mistake in config.json must not stop the board
+            print(f"Config section {section} can not be applied, keeping the current config: {e!r}")
+            self._roll_back(changed, applied + [section])
+            return {'error': f"{section}: {e!r}"}
+        self.reloads += 1
+        print(f"Config reloaded, applied: {applied}, restart required: {restart_required}")
+        return {'applied': applied, 'restart_required': restart_required}
+
+    def _roll_back(self, changed, sections):
+        # the previous values go back into the config and the sections touched are applied again with them,
+        # each handler gets the value which failed as its previous one
+        failed = {section: self.config.section(section) for section in sections}
+        self.config.restore(changed)
+        for section in sections:
+            self.handlers[section](failed[section])
@@ -1,4 +1,4 @@
-import struct
+from dissectors import DEFAULT_LAYERS, Decoder
 
 ethernet_proto_map = {
     0x0800: 'IPv4',
@@ -31,108 +31,127 @@ def _format_mac_addr(addr):
     return ':'.join(map('{:02x}'.format, addr))
 
 
-def _unpack_ethernet_frame(data):
-    try:
-        dst_mac, src_mac, proto = struct.unpack('!6s6sH', data[:14])
-        return _format_mac_addr(dst_mac), _format_mac_addr(src_mac), proto, data[14:]
-    except Exception as e:
-        print(e)
-        return None, None, None, []
-
-
-def _decode_ip_packet(data):
-    try:
-        version_header_length = data[0]
-        version = version_header_length >> 4
-        header_length = (version_header_length & 0x0F) << 2
-        ttl, proto, src_ip, dst_ip = struct.unpack('!8xBB2x4s4s', data[:20])
-        return _format_ip_addr(src_ip), _format_ip_addr(dst_ip), proto, ttl, header_length, version, data[header_length:]
-    except Exception as e:
-        print(e)
-        return None, None, None, None, None, []
-
-
-def _decode_ip_v6_packet(data):
-    try:
-        # unpack IPv6 header using struct
-        # todo fixme, getting error 'buffer size must match format'
-        version, traffic_class, flow_label, payload_length, next_header, hop_limit, src_ip, dst_ip = struct.unpack('!6xBBHHBB16s16s', data[:40])
-        #
-        # b = bytearray(data.read(4))
-        #
-        # version = (b[0] >> 4) & 0x0F
-        # traffic_class = ((b[0] & 0x0F) << 4) | ((b[1] >> 4) & 0x0F)
-        # flow_label = ((b[1] & 0x0F) << 16) | (b[2] << 8) | b[3]
-        #
-        #
-        # payload_length = struct.unpack(">H", data.read(2))[0]
-        # next_header = ord(data.read(1))
-        # hop_limit = ord(data.read(1))
-        # src_ip = bytearray(data.read(16))
-        # dst_ip = bytearray(data.read(16))
-
-        return _format_ip_addr(src_ip), _format_ip_addr(dst_ip), version, traffic_class, flow_label, hop_limit, next_header, payload_length, data[40:]
-    except Exception as e:
-        print(e)
-        return None, None, None, None, None, None, None, None, []
-
-
-def _decode_arp_packet(data):
-    try:
-        htype, ptype, hlen, plen, opcode = struct.unpack('!HHBBH', data[:8])
-        return htype, ptype, hlen, plen, opcode, data[8:]
-    except Exception as e:
-        print(e)
-        return None
+def _format_ip_v6_addr(addr):
+    return ':'.join('{:x}'.format((addr[i] << 8) | addr[i + 1]) for i in range(0, 16, 2))
+
+
+def format_mac_addr(addr):
+    return _format_mac_addr(addr) if addr is not None else None
 
 
-def _decode_icmp_packet(data):
-    try:
-        icmp_type, code, checksum = struct.unpack('!BBH', data[:4])
-        return icmp_type, code, checksum, data[4:]
-    except Exception as e:
-        print(e)
+def format_ip_addr(addr):
+    if addr is None:
         return None
+    if len(addr) == 16:
+        return _format_ip_v6_addr(addr)
+    return _format_ip_addr(addr)
+
+
+def parse_mac_addr(mac_address):
+    return bytes(int(e, 16) for e in mac_address.split(':'))
 
 
 def decode_packet(data):
-    dst_mac, src_mac, eth_proto, payload = _unpack_ethernet_frame(data)
-    packet = {'dst_mac': dst_mac, 'src_mac': src_mac, 'eth_proto': eth_proto, 'type': 'unknown'}
-
-    if eth_proto == 0x0800:  # IPv4
-        try:
-            src_ip, dst_ip, ip_proto, ttl, header_length, version, payload = _decode_ip_packet(payload)
-            packet['ip_packet'] = {'src_ip': src_ip, 'dst_ip': dst_ip, 'ip_proto': ip_proto, 'ttl': ttl, 'header_length': header_length, 'version': version}
-            packet['type'] = 'ipv4'
-            if ip_proto == 1:  # ICMP
-                icmp_type, code, checksum, payload = _decode_icmp_packet(payload)
-                packet['ip_packet']['icmp_packet'] = {'type': icmp_type, 'code': code, 'checksum': checksum}
-        except Exception as e:
-            print(e)
-            packet['ip_packet'] = {'error': 'IPv4 packet decode error'}
-    elif eth_proto == 0x86DD:  # IPv6
-        packet['type'] = 'ipv6'
-        src_ip, dst_ip, version, traffic_class, flow_label, hop_limit, next_header, payload_length, payload = _decode_ip_v6_packet(payload)
-        packet['ip_v6_packet'] = {'src_ip': src_ip, 'dst_ip': dst_ip, 'version': version, 'traffic_class': traffic_class, 'hop_limit': hop_limit,
-                                  'payload_length': payload_length}
-        if next_header == 0x3A:  # ICMPv6
-            icmp_type, code, checksum, payload = _decode_icmp_packet(payload) # todo: check this
-            packet['ip_v6_packet']['icmp_packet'] = {'type': icmp_type, 'code': code, 'checksum': checksum}
-    elif eth_proto == 0x0806:  # ARP
-        try:
-            htype, ptype, hlen, plen, opcode, payload = _decode_arp_packet(payload)
-            packet['type'] = 'arp'
-            packet['arp_packet'] = {'htype': htype, 'ptype': ptype, 'hlen': hlen, 'plen': plen, 'opcode': opcode}
-        except Exception as e:
-            print(e)
-            packet['arp_packet'] = {'error': 'ARP packet decode error'}
-    elif eth_proto == 0x01:  # ICMP
-        try:
-            icmp_type, code, checksum, payload = _decode_icmp_packet(payload)
-            packet['type'] = 'icmp'
-            packet['icmp_packet'] = {'icmp_type': icmp_type, 'code': code, 'checksum': checksum}
-        except Exception as e:
-            print(e)
-            packet['icmp_packet'] = {'error': 'ICMP packet decode error'}
-
-    return packet
+    # every registered layer, as a dict. convenient for debugging, use decode_packet_record in the packet path
+    return _FULL_DECODER.decode(data, PacketRecord()).to_dict()
+
+
+class PacketRecord:
+    # compact, allocation-light alternative to the dict returned by decode_packet.
+    # addresses are kept as raw bytes and only formatted when a consumer asks for them.
+    # fields beyond the ethernet header are filled by the dissectors the decoder enabled, None otherwise
+    __slots__ = ('length', 'dst_mac', 'src_mac', 'eth_proto', 'type',
+                 'src_ip', 'dst_ip', 'ip_proto', 'ttl', 'icmp_type', 'icmp_code',
+                 'arp_opcode', 'arp_sender_mac', 'arp_sender_ip', 'arp_target_ip',
+                 'src_port', 'dst_port', 'app', 'dhcp_message_type', 'dhcp_hostname', 'mdns_response', 'mdns_name',
+                 'src_device', 'dst_device')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.length = 0
+        self.dst_mac = None
+        self.src_mac = None
+        self.eth_proto = None
+        self.type = 'unknown'
+        self.src_ip = None
+        self.dst_ip = None
+        self.ip_proto = None
+        self.ttl = None
+        self.icmp_type = None
+        self.icmp_code = None
+        self.arp_opcode = None
+        self.arp_sender_mac = None
+        self.arp_sender_ip = None
+        self.arp_target_ip = None
+        self.src_port = None
+        self.dst_port = None
+        self.app = None
+        self.dhcp_message_type = None
+        self.dhcp_hostname = None
+        self.mdns_response = None
+        self.mdns_name = None
+        self.src_device = None
+        self.dst_device = None
+
+    # dict-style read access, so consumers written against decode_packet keep working
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def src_mac_str(self):
+        return format_mac_addr(self.src_mac)
+
+    @property
+    def dst_mac_str(self):
+        return format_mac_addr(self.dst_mac)
+
+    @property
+    def src_ip_str(self):
+        return format_ip_addr(self.src_ip)
+
+    @property
+    def dst_ip_str(self):
+        return format_ip_addr(self.dst_ip)
+
+    def to_dict(self):
+        packet = {'dst_mac': self.dst_mac_str, 'src_mac': self.src_mac_str, 'eth_proto': self.eth_proto, 'type': self.type}
+        ip_packet = None
+        if self.type == 'ipv4':
+            ip_packet = packet['ip_packet'] = {'src_ip': self.src_ip_str, 'dst_ip': self.dst_ip_str, 'ip_proto': self.ip_proto, 'ttl': self.ttl}
+        elif self.type == 'ipv6':
+            ip_packet = packet['ip_v6_packet'] = {'src_ip': self.src_ip_str, 'dst_ip': self.dst_ip_str, 'next_header': self.ip_proto, 'hop_limit': self.ttl}
+        elif self.type == 'arp':
+            packet['arp_packet'] = {'opcode': self.arp_opcode}
+            if self.arp_sender_mac is not None:
+                packet['arp_packet'].update({'sender_mac': format_mac_addr(self.arp_sender_mac), 'sender_ip': format_ip_addr(self.arp_sender_ip),
+                                             'target_ip': format_ip_addr(self.arp_target_ip)})
+        if ip_packet is not None:
+            if self.icmp_type is not None:
+                ip_packet['icmp_packet'] = {'type': self.icmp_type, 'code': self.icmp_code}
+            if self.src_port is not None:
+                ip_packet['src_port'] = self.src_port
+                ip_packet['dst_port'] = self.dst_port
+            if self.app == 'dhcp':
+                ip_packet['dhcp_packet'] = {'message_type': self.dhcp_message_type, 'hostname': self.dhcp_hostname}
+            elif self.app == 'mdns':
+                ip_packet['mdns_packet'] = {'response': self.mdns_response, 'name': self.mdns_name}
+        if self.src_device is not None:
+            packet['src_device'] = self.src_device
+            packet['dst_device'] = self.dst_device
+        return packet
+
+
+def decode_packet_record(data, record=None, decoder=None):
+    # decodes over a memoryview of the receive buffer, without slicing the payload at each layer.
+    # pass a preallocated record to reuse it for every frame, and a Decoder to choose the parsed layers
+    if record is None:
+        record = PacketRecord()
+    else:
+        record.clear()
+    return (decoder or _DEFAULT_DECODER).decode(data, record)
+
+
+_DEFAULT_DECODER = Decoder(layers=DEFAULT_LAYERS)
+_FULL_DECODER = Decoder()
@@ -0,0 +1,253 @@
+# coding: utf-8
+
+# the tables a dissector can be registered in, looked up with the key found by the previous layer
+ETHERTYPE = 'ethertype'
+IP_PROTOCOL = 'ip_proto'
+UDP_PORT = 'udp_port'
+
+_IPV6_EXTENSION_HEADERS = (0, 43, 60)  # hop-by-hop, routing, destination options: (length + 1) * 8 bytes
+_IPV6_FRAGMENT = 44
+
+
+class Dissector:
+    # decode(decoder, view, offset, length, record) fills the declared fields of record from the layer at offset,
+    # and returns (next table, key, payload offset) to continue with the next layer, or None. the next table is
+    # one of the decoder's ethertypes, ip_protocols or udp_ports dicts
+    def __init__(self, name, table, keys, fields, decode):
+        self.name = name
+        self.table = table
+        self.keys = keys
+        self.fields = fields
+        self.decode = decode
+
+
+DISSECTORS = {}
+# the dissectors looking up each table
+_PARENTS = {IP_PROTOCOL: ('ipv4', 'ipv6'), UDP_PORT: ('udp',)}
+
+
+def register(dissector):
+    DISSECTORS[dissector.name] = dissector
+    return dissector
+
+
+def _text(data):
+    try:
+        return str(bytes(data), 'utf-8')
+    except UnicodeError:
+        return None
+
+
+def _vlan(decoder, view, offset, length, record):
+    if length < offset + 4:
+        return None
+    return decoder.ethertypes, (view[offset + 2] << 8) | view[offset + 3], offset + 4
+
+
+def _ipv4(decoder, view, offset, length, record):
+    if length < offset + 20 or view[offset] >> 4 != 4:
+        return None
+    record.type = 'ipv4'
+    header_length = (view[offset] & 0x0F) << 2
+    record.ttl = view[offset + 8]
+    ip_proto = view[offset + 9]
+    record.ip_proto = ip_proto
+    record.src_ip = bytes(view[offset + 12:offset + 16])
+    record.dst_ip = bytes(view[offset + 16:offset + 20])
+    # only the first fragment carries the transport header
+    if header_length < 20 or ((view[offset + 6] & 0x1F) | view[offset + 7]):
+        return None
+    return decoder.ip_protocols, ip_proto, offset + header_length
+
+
+def _ipv6(decoder, view, offset, length, record):
+    if length < offset + 40 or view[offset] >> 4 != 6:
+        return None
+    record.type = 'ipv6'
+    next_header = view[offset + 6]
+    record.ttl = view[offset + 7]  # hop limit
+    record.src_ip = bytes(view[offset + 8:offset + 24])
+    record.dst_ip = bytes(view[offset + 24:offset + 40])
+    offset += 40
+    # skip extension headers to the upper layer protocol, a non-first fragment has no upper layer header
+    for _ in range(4):
+        if next_header in _IPV6_EXTENSION_HEADERS and length >= offset + 2:
+            next_header, offset = view[offset], offset + ((view[offset + 1] + 1) << 3)
+        elif next_header == _IPV6_FRAGMENT and length >= offset + 8:
+            if ((view[offset + 2] << 8) | view[offset + 3]) & 0xFFF8:
+                record.ip_proto = view[offset]
+                return None
+            next_header, offset = view[offset], offset + 8
+        else:
+            break
+    record.ip_proto = next_header
+    return decoder.ip_protocols, next_header, offset
+
+
+def _arp(decoder, view, offset, length, record):
+    record.type = 'arp'
+    if length < offset + 8:
+        return None
+    record.arp_opcode = (view[offset + 6] << 8) | view[offset + 7]
+    # ethernet / ipv4 only
+    if length >= offset + 28 and view[offset + 4] == 6 and view[offset + 5] == 4:
+        record.arp_sender_mac = bytes(view[offset + 8:offset + 14])
+        record.arp_sender_ip = bytes(view[offset + 14:offset + 18])
+        record.arp_target_ip = bytes(view[offset + 24:offset + 28])
+    return None
+
+
+def _icmp(decoder, view, offset, length, record):
+    if length >= offset + 2:
+        record.icmp_type = view[offset]
+        record.icmp_code = view[offset + 1]
+    return None
+
+
+def _tcp(decoder, view, offset, length, record):
+    if length >= offset + 4:
+        record.src_port = (view[offset] << 8) | view[offset + 1]
+        record.dst_port = (view[offset + 2] << 8) | view[offset + 3]
+    return None
+
+
+def _udp(decoder, view, offset, length, record):
+    if length < offset + 8:
+        return None
+    src_port = (view[offset] << 8) | view[offset + 1]
+    dst_port = (view[offset + 2] << 8) | view[offset + 3]
+    record.src_port = src_port
+    record.dst_port = dst_port
+    ports = decoder.udp_ports
+    if dst_port in ports:
+        return ports, dst_port, offset + 8
+    if src_port in ports:
+        return ports, src_port, offset + 8
+    return None
+
+
+def _dhcp(decoder, view, offset, length, record):
+    # bootp header (236 bytes) and magic cookie, then the options: 53 message type, 12 host name
+    options = offset + 240
+    if length < options or bytes(view[offset + 236:options]) != b'\x63\x82\x53\x63':
+        return None
+    record.app = 'dhcp'
+    position = options
+    while position < length:
+        option = view[position]
+        if option == 255:
+            break
+        if option == 0:
+            position += 1
+            continue
+        if position + 2 > length:
+            break
+        size = view[position + 1]
+        value = position + 2
+        if value + size > length:
+            break
+        if option == 53 and size == 1:
+            record.dhcp_message_type = view[value]
+        elif option == 12:
+            record.dhcp_hostname = _text(view[value:value + size])
+        position = value + size
+    return None
+
+
+def _mdns(decoder, view, offset, length, record):
+    # dns header then the first question or answer name, uncompressed as the first name always is
+    if length < offset + 12:
+        return None
+    record.app = 'mdns'
+    record.mdns_response = bool(view[offset + 2] & 0x80)
+    position = offset + 12
+    start = position
+    labels = 0
+    while position < length and labels < 8:
+        size = view[position]
+        if size == 0 or size & 0xC0 or position + 1 + size > length:
+            break
+        position += 1 + size
+        labels += 1
+    if labels:
+        # length prefixed labels to a dotted name
+        name = bytearray(view[start + 1:position])
+        position = view[start]
+        while position < len(name):
+            size = name[position]
+            name[position] = 0x2E
+            position += 1 + size
+        record.mdns_name = _text(name)
+    return None
+
+
+register(Dissector('vlan', ETHERTYPE, (0x8100,), (), _vlan))
+register(Dissector('ipv4', ETHERTYPE, (0x0800,), ('type', 'ttl', 'ip_proto', 'src_ip', 'dst_ip'), _ipv4))
+register(Dissector('ipv6', ETHERTYPE, (0x86DD,), ('type', 'ttl', 'ip_proto', 'src_ip', 'dst_ip'), _ipv6))
+register(Dissector('arp', ETHERTYPE, (0x0806,), ('type', 'arp_opcode', 'arp_sender_mac', 'arp_sender_ip', 'arp_target_ip'), _arp))
+register(Dissector('icmp', IP_PROTOCOL, (1, 58), ('icmp_type', 'icmp_code'), _icmp))  # ICMP and ICMPv6
+register(Dissector('tcp', IP_PROTOCOL, (6,), ('src_port', 'dst_port'), _tcp))
+register(Dissector('udp', IP_PROTOCOL, (17,), ('src_port', 'dst_port'), _udp))
+register(Dissector('dhcp', UDP_PORT, (67, 68), ('app', 'dhcp_message_type', 'dhcp_hostname'), _dhcp))
+register(Dissector('mdns', UDP_PORT, (5353,), ('app', 'mdns_response', 'mdns_name'), _mdns))
+
+# what decode_packet_record parsed before the registry existed
+DEFAULT_LAYERS = ('ipv4', 'ipv6', 'arp', 'icmp')
+
+
+class Decoder:
+    # decodes only the requested layers: a dissector which is not enabled is never called, and the layers
+    # above it are not parsed either. layers are dissector names, fields select every dissector producing them
+    def __init__(self, layers=None, fields=None):
+        names = set(DISSECTORS) if layers is None and fields is None else set(layers or ())
+        for name in names:
+            if name not in DISSECTORS:
+                raise ValueError(f"unknown decoder layer {name}")
+        if fields is not None:
+            for dissector in DISSECTORS.values():
+                for field in dissector.fields:
+                    if field in fields:
+                        names.add(dissector.name)
+        # a layer needs a layer it is reached through, udp for the application layers, then ipv4 and ipv6 if
+        # neither was requested
+        for table in (UDP_PORT, IP_PROTOCOL):
+            parents = _PARENTS[table]
+            if any(DISSECTORS[name].table == table for name in names) and not any(parent in names for parent in parents):
+                names.update(parents)
+        self.layers = names
+        # key -> decode function of the enabled dissectors
+        self.ethertypes = {}
+        self.ip_protocols = {}
+        self.udp_ports = {}
+        tables = {ETHERTYPE: self.ethertypes, IP_PROTOCOL: self.ip_protocols, UDP_PORT: self.udp_ports}
+        for name in names:
+            dissector = DISSECTORS[name]
+            for key in dissector.keys:
+                tables[dissector.table][key] = dissector.decode
+        self.fields = set()
+        for name in names:
+            self.fields.update(DISSECTORS[name].fields)
+
+    def decode(self, data, record):
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        length = len(view)
+        record.length = length
+        if length < 14:
+            return record
+        record.dst_mac = bytes(view[0:6])
+        record.src_mac = bytes(view[6:12])
+        key = (view[12] << 8) | view[13]
+        record.eth_proto = key
+        ethertypes = self.ethertypes
+        table = ethertypes
+        offset = 14
+        while True:
+            decode = table.get(key)
+            if decode is None:
+                return record
+            next_layer = decode(self, view, offset, length, record)
+            if next_layer is None:
+                return record
+            table, key, offset = next_layer
+            if table is ethertypes:
+                record.eth_proto = key
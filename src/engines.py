@@ -0,0 +1,41 @@
+# coding: utf-8
+import time
+
+from inference import SimpleRuleEngine
+from model_engine import QuantizedModel, QuantizedModelEngine
+
+
+def build_engine(inference_config, devices_to_track, notify_callback=None, track_callback=None, clock=time.time, debug=True):
+    # "engine": "rules" (default) or "model", the model engine needs the file written by host/train_model.py
+    if inference_config.get('engine', 'rules') == 'model':
+        return QuantizedModelEngine(QuantizedModel.load(inference_config.get('model', 'model.json')), devices_to_track,
+                                    notify_callback=notify_callback, track_callback=track_callback,
+                                    window_sec=inference_config.get('window_sec', 60),
+                                    appear_windows=inference_config.get('appear_windows', 1),
+                                    disappear_windows=inference_config.get('disappear_windows', 3),
+                                    clock=clock, debug=debug)
+    return SimpleRuleEngine(devices_to_track=devices_to_track, notify_callback=notify_callback, track_callback=track_callback,
+                            clock=clock, debug=debug, **_thresholds(inference_config))
+
+
+def _thresholds(inference_config):
+    # the tunables of the configured engine, both engines have defaults for the missing ones
+    if inference_config.get('engine', 'rules') == 'model':
+        names = ('appear_windows', 'disappear_windows')
+    else:
+        names = ('consecutive_packet_delay_sec', 'max_no_packet_sec', 'min_seen_count')
+    return {name: inference_config[name] for name in names if name in inference_config}
+
+
+def reconfigure_engine(engine, inference_config, previous_config, devices_to_track):
+    # applies a changed "inference" section to the running engine, keeping what it learned.
+    # returns False when the engine must be rebuilt: another engine, model file or window length
+    previous_config = previous_config or {}
+    kind = inference_config.get('engine', 'rules')
+    if kind != previous_config.get('engine', 'rules'):
+        return False
+    if kind == 'model' and any(inference_config.get(name) != previous_config.get(name) for name in ('model', 'window_sec')):
+        return False
+    engine.set_devices_to_track(devices_to_track)
+    engine.configure(**_thresholds(inference_config))
+    return True
@@ -0,0 +1,156 @@
+# coding: utf-8
+import os
+import struct
+
+# file header: magic, format version, record size
+LOG_MAGIC = b'HEVL'
+LOG_VERSION = 1
+HEADER_FORMAT = '<4sHH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# one fixed width record per packet summary or presence event, little endian:
+# ts, kind, type, ip_proto, flags, length, eth_proto, src_mac, dst_mac, src_ip, dst_ip (ipv4 only, zeros otherwise).
+# for events src_mac is the device mac and length its seen_count
+RECORD_FORMAT = '<dBBBBHH6s6s4s4s'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+KIND_PACKET = 1
+KIND_APPEARED = 2
+KIND_DISAPPEARED = 3
+KIND_NAMES = {KIND_PACKET: 'packet', KIND_APPEARED: 'appeared', KIND_DISAPPEARED: 'disappeared'}
+EVENT_KINDS = {'appeared': KIND_APPEARED, 'disappeared': KIND_DISAPPEARED}
+
+# same codes as host/batch_decoder.py
+TYPE_CODES = {'unknown': 0, 'ipv4': 1, 'ipv6': 2, 'arp': 3}
+TYPE_NAMES = ('unknown', 'ipv4', 'ipv6', 'arp')
+
+FLAG_SRC_KNOWN = 0x01  # src_mac is a configured device
+FLAG_DST_KNOWN = 0x02
+
+_NO_MAC = bytes(6)
+_NO_IP = bytes(4)
+
+
+class EventLog:
+    # append-only log of fixed width records. records are packed into a preallocated buffer and written
+    # batch_records at a time (or on flush), the file is rotated to path.1 .. path.<keep> past max_bytes.
+    # on the board the filesystem must be writable by CircuitPython (storage.remount in boot.py) or on an sd card
+    def __init__(self, path, max_bytes=256 * 1024, keep=3, batch_records=64, device_macs=None, packets=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.packets = packets
+        # device name -> raw mac, events only carry the device name
+        self.device_macs = device_macs or {}
+        self._buffer = bytearray(batch_records * RECORD_SIZE)
+        self._batch_records = batch_records
+        self._count = 0
+        self._make_dir(path)
+        self._size = self._file_size(path)
+        self.records_written = 0
+        self.records_dropped = 0
+        self.rotations = 0
+        self.write_errors = 0
+
+    @staticmethod
+    def _make_dir(path):
+        # no os.path nor os.makedirs on CircuitPython, only the parent directory is created
+        directory = path.rsplit('/', 1)[0] if '/' in path else ''
+        if directory:
+            try:
+                os.mkdir(directory)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _file_size(path):
+        try:
+            return os.stat(path)[6]
+        except OSError:
+            return 0
+
+    def record_packet(self, record, now):
+        if not self.packets:
+            return
+        flags = 0
+        if record.src_device:
+            flags |= FLAG_SRC_KNOWN
+        if record.dst_device:
+            flags |= FLAG_DST_KNOWN
+        src_ip = record.src_ip
+        dst_ip = record.dst_ip
+        if src_ip is None or len(src_ip) != 4:
+            src_ip = dst_ip = _NO_IP
+        self._append(now, KIND_PACKET, TYPE_CODES.get(record.type, 0), record.ip_proto or 0, flags,
+                     record.length or 0, record.eth_proto or 0, record.src_mac or _NO_MAC, record.dst_mac or _NO_MAC, src_ip, dst_ip)
+
+    def record_event(self, device, event, now):
+        kind = EVENT_KINDS.get(event['type'])
+        if kind is None:
+            return
+        seen_count = min(event['data'].get('seen_count', 0), 0xffff)
+        self._append(now, kind, 0, 0, FLAG_SRC_KNOWN, seen_count, 0, self.device_macs.get(device, _NO_MAC), _NO_MAC, _NO_IP, _NO_IP)
+
+    def _append(self, *fields):
+        struct.pack_into(RECORD_FORMAT, self._buffer, self._count * RECORD_SIZE, *fields)
+        self._count += 1
+        if self._count >= self._batch_records:
+            self.flush()
+
+    def flush(self):
+        # returns the number of records written
+        count = self._count
+        if not count:
+            return 0
+        self._count = 0
+        used = count * RECORD_SIZE
+        try:
+            if self._size and self._size + used > self.max_bytes:
+                self._rotate()
+            with open(self.path, 'ab') as f:
+                if not self._size:
+                    f.write(struct.pack(HEADER_FORMAT, LOG_MAGIC, LOG_VERSION, RECORD_SIZE))
+                    self._size = HEADER_SIZE
+                f.write(memoryview(self._buffer)[:used])
+        except OSError as e:
+            if not self.write_errors:
+                print(f"event log {self.path} not writable: {e}")
+            self.write_errors += 1
+            self.records_dropped += count
+            return 0
+        self._size += used
+        self.records_written += count
+        return count
+
+    def _rotate(self):
+        # path.<keep> is dropped, os.rename does not replace an existing file on CircuitPython
+        if self.keep < 1:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        for index in range(self.keep, 0, -1):
+            source = self.path if index == 1 else f"{self.path}.{index - 1}"
+            target = f"{self.path}.{index}"
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+            try:
+                os.rename(source, target)
+            except OSError:
+                pass
+        self._size = 0
+        self.rotations += 1
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        return {'size': self._size, 'written': self.records_written, 'dropped': self.records_dropped,
+                'rotations': self.rotations, 'write_errors': self.write_errors}
+
+
+def log_files(path, keep):
+    # oldest first
+    return [f"{path}.{index}" for index in range(keep, 0, -1)] + [path]
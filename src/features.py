@@ -0,0 +1,138 @@
+# coding: utf-8
+import time
+
+# feature vector emitted per device and window, in this order
+FEATURE_NAMES = ('packets', 'bytes', 'tx_packets', 'ipv4', 'ipv6', 'arp', 'unknown', 'icmp',
+                 'arp_ratio', 'icmp_ratio', 'tx_ratio', 'iat_mean', 'iat_std', 'iat_min', 'iat_max')
+FEATURES_COUNT = len(FEATURE_NAMES)
+
+# accumulator slots, the first eight are the raw counters of FEATURE_NAMES
+_PACKETS = 0
+_BYTES = 1
+_TX = 2
+_TYPE_SLOTS = {'ipv4': 3, 'ipv6': 4, 'arp': 5, 'unknown': 6}
+_UNKNOWN = 6
+_ICMP = 7
+_IAT_COUNT = 8
+_IAT_MEAN = 9
+_IAT_M2 = 10
+_IAT_MIN = 11
+_IAT_MAX = 12
+_LAST_SEEN = 13
+_SLOTS = 14
+
+
+class FeatureExtractor:
+    # per device features over fixed windows, updated with O(1) work per packet. inter-arrival times use
+    # Welford's running mean/variance so no packet timestamps are stored. at every window boundary
+    # emit_callback(device, window_start, features) is called for every device seen since it was selected,
+    # with an all zero window when it was silent. a device never seen has no windows; features is a list
+    # reused for the next window, the callback copies what it keeps.
+    # window_callback(window_start) follows once every device of the window was emitted
+    def __init__(self, devices=None, window_sec=60, emit_callback=None, max_devices=32, clock=time.time, window_callback=None):
+        # devices: names to extract features for, None for every mapped device up to max_devices
+        self.devices = set(devices) if devices is not None else None
+        self.window_sec = window_sec
+        self.emit_callback = emit_callback
+        self.window_callback = window_callback
+        self.max_devices = max_devices
+        self.clock = clock
+        self.window_start = None
+        self.windows_count = 0
+        self._accumulators = {}
+        self._features = [0.0] * FEATURES_COUNT
+
+    def set_devices(self, devices):
+        # accumulators of the devices still selected are kept, their current window is not lost
+        self.devices = set(devices) if devices is not None else None
+        if self.devices is not None:
+            for device in list(self._accumulators):
+                if device not in self.devices:
+                    del self._accumulators[device]
+
+    def _accumulator(self, device):
+        accumulator = self._accumulators.get(device)
+        if accumulator is None:
+            if self.devices is not None and device not in self.devices:
+                return None
+            if len(self._accumulators) >= self.max_devices:
+                return None
+            accumulator = [0] * _SLOTS
+            accumulator[_LAST_SEEN] = None
+            self._accumulators[device] = accumulator
+        return accumulator
+
+    def update(self, packet, now=None):
+        if now is None:
+            now = self.clock()
+        self.tick(now)
+        src_device = packet.src_device
+        dst_device = packet.dst_device
+        if src_device:
+            self._add(src_device, packet, now, 1)
+        if dst_device and dst_device != src_device:
+            self._add(dst_device, packet, now, 0)
+
+    def _add(self, device, packet, now, tx):
+        accumulator = self._accumulator(device)
+        if accumulator is None:
+            return
+        accumulator[_PACKETS] += 1
+        accumulator[_BYTES] += packet.length or 0
+        accumulator[_TX] += tx
+        accumulator[_TYPE_SLOTS.get(packet.type, _UNKNOWN)] += 1
+        if packet.icmp_type is not None:
+            accumulator[_ICMP] += 1
+        last_seen = accumulator[_LAST_SEEN]
+        accumulator[_LAST_SEEN] = now
+        if last_seen is None:
+            return
+        iat = now - last_seen
+        count = accumulator[_IAT_COUNT] + 1
+        accumulator[_IAT_COUNT] = count
+        delta = iat - accumulator[_IAT_MEAN]
+        accumulator[_IAT_MEAN] += delta / count
+        accumulator[_IAT_M2] += delta * (iat - accumulator[_IAT_MEAN])
+        if count == 1 or iat < accumulator[_IAT_MIN]:
+            accumulator[_IAT_MIN] = iat
+        if iat > accumulator[_IAT_MAX]:
+            accumulator[_IAT_MAX] = iat
+
+    def due(self, now):
+        # whether tick(now) starts or ends a window
+        return self.window_start is None or now >= self.window_start + self.window_sec
+
+    def tick(self, now=None):
+        # emits the windows which ended before now, call it periodically so silent windows are emitted too
+        if now is None:
+            now = self.clock()
+        if self.window_start is None:
+            self.window_start = now - now % self.window_sec
+            return
+        while now >= self.window_start + self.window_sec:
+            self._emit(self.window_start)
+            self.window_start += self.window_sec
+
+    def _emit(self, window_start):
+        self.windows_count += 1
+        features = self._features
+        for device, accumulator in self._accumulators.items():
+            packets = accumulator[_PACKETS]
+            for slot in range(_ICMP + 1):
+                features[slot] = accumulator[slot]
+            # ratios and inter-arrival statistics, FEATURE_NAMES[8:]
+            features[8] = accumulator[_TYPE_SLOTS['arp']] / packets if packets else 0.0
+            features[9] = accumulator[_ICMP] / packets if packets else 0.0
+            features[10] = accumulator[_TX] / packets if packets else 0.0
+            iat_count = accumulator[_IAT_COUNT]
+            features[11] = accumulator[_IAT_MEAN]
+            features[12] = (accumulator[_IAT_M2] / iat_count) ** 0.5 if iat_count > 1 else 0.0
+            features[13] = accumulator[_IAT_MIN]
+            features[14] = accumulator[_IAT_MAX]
+            if self.emit_callback is not None:
+                self.emit_callback(device, window_start, features)
+            # reset in place, the last seen time carries over so the first gap of the next window is measured
+            for slot in range(_LAST_SEEN):
+                accumulator[slot] = 0
+        if self.window_callback is not None:
+            self.window_callback(window_start)
@@ -0,0 +1,87 @@
+# coding: utf-8
+from decoder import parse_mac_addr
+
+# what a frame costs, decided before it is decoded
+DROP = 0  # ignored
+COUNT = 1  # only counted, PacketStats.count_frame
+PROCESS = 2  # decode, map, stats, inference
+
+ACTIONS = {'drop': DROP, 'count': COUNT, 'process': PROCESS}
+
+
+def _mac_key(frame, offset):
+    # the last three (nic specific) bytes as a small int, hashed without allocating
+    return (frame[offset + 3] << 16) | (frame[offset + 4] << 8) | frame[offset + 5]
+
+
+class FrameFilter:
+    # classifies raw frames from the ethernet header only. a frame from or to a tracked mac is always processed,
+    # from or to another known mac it gets the known action. other frames get the action of their ethertype
+    # if one is configured, else the broadcast or multicast action by destination, else the unknown action
+    def __init__(self, known_macs=(), tracked_macs=(), known=PROCESS, unknown=COUNT, broadcast=COUNT, multicast=COUNT, ethertypes=None):
+        self.known = known
+        self.unknown = unknown
+        self.broadcast = broadcast
+        self.multicast = multicast
+        self.ethertypes = ethertypes or {}
+        # _mac_key -> [(first three bytes, action)], a list as different vendors can share the key
+        self._macs = {}
+        for mac in known_macs:
+            self._add(mac, known)
+        for mac in tracked_macs:
+            self._add(mac, PROCESS)
+        self.counts = [0, 0, 0]  # frames per action
+
+    @classmethod
+    def from_config(cls, filter_config, mac_address_to_devices, tracking_macs):
+        ethertypes = {int(ethertype, 16): ACTIONS[action] for ethertype, action in filter_config.get('ethertypes', {}).items()}
+        return cls(known_macs=[parse_mac_addr(mac) for mac in mac_address_to_devices], tracked_macs=[parse_mac_addr(mac) for mac in tracking_macs],
+                   known=ACTIONS[filter_config.get('known', 'process')], unknown=ACTIONS[filter_config.get('unknown', 'count')],
+                   broadcast=ACTIONS[filter_config.get('broadcast', 'count')], multicast=ACTIONS[filter_config.get('multicast', 'count')],
+                   ethertypes=ethertypes)
+
+    def _add(self, mac, action):
+        candidates = self._macs.setdefault(_mac_key(mac, 0), [])
+        for i, (prefix, _) in enumerate(candidates):
+            if prefix == mac[:3]:
+                candidates[i] = (prefix, max(action, candidates[i][1]))
+                return
+        candidates.append((bytes(mac[:3]), action))
+
+    def _match(self, frame, offset, candidates):
+        for prefix, action in candidates:
+            if frame[offset] == prefix[0] and frame[offset + 1] == prefix[1] and frame[offset + 2] == prefix[2]:
+                return action
+        return -1
+
+    def classify(self, frame):
+        action = self._classify(frame)
+        self.counts[action] += 1
+        return action
+
+    def _classify(self, frame):
+        if len(frame) < 14:
+            return self.unknown
+        macs = self._macs
+        action = -1
+        candidates = macs.get((frame[3] << 16) | (frame[4] << 8) | frame[5])
+        if candidates is not None:
+            action = self._match(frame, 0, candidates)
+        candidates = macs.get((frame[9] << 16) | (frame[10] << 8) | frame[11])
+        if candidates is not None:
+            src_action = self._match(frame, 6, candidates)
+            if src_action > action:
+                action = src_action
+        if action >= 0:
+            return action
+        action = self.ethertypes.get((frame[12] << 8) | frame[13])
+        if action is not None:
+            return action
+        if frame[0] & 0x01:
+            if frame[0] == 0xFF and frame[1] == 0xFF and frame[2] == 0xFF and frame[3] == 0xFF and frame[4] == 0xFF and frame[5] == 0xFF:
+                return self.broadcast
+            return self.multicast
+        return self.unknown
+
+    def stats(self):
+        return {'dropped': self.counts[DROP], 'counted': self.counts[COUNT], 'processed': self.counts[PROCESS]}
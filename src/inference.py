@@ -3,22 +3,116 @@ import json
 import time
 
 
-class SimpleRuleEngine:
+def _heap_push(heap, item):
+    # minimal heapq.heappush, heapq is not available on CircuitPython
+    heap.append(item)
+    pos = len(heap) - 1
+    while pos > 0:
+        parent = (pos - 1) >> 1
+        if heap[parent] <= item:
+            break
+        heap[pos] = heap[parent]
+        pos = parent
+    heap[pos] = item
+
+
+def _heap_pop(heap):
+    last = heap.pop()
+    if not heap:
+        return last
+    top = heap[0]
+    size = len(heap)
+    pos = 0
+    child = 1
+    while child < size:
+        if child + 1 < size and heap[child + 1] < heap[child]:
+            child += 1
+        if last <= heap[child]:
+            break
+        heap[pos] = heap[child]
+        pos = child
+        child = 2 * pos + 1
+    heap[pos] = last
+    return top
+
+
+class InferenceEngine:
+    # what code.py and the pipeline expect from an engine: update() for every mapped packet, tick() periodically
+    # (also without traffic), and {'type': 'appeared' | 'disappeared', 'data': {...}} events passed to
+    # notify_callback(device, message=<json>) and track_callback(device, event)
+    def __init__(self, devices_to_track, notify_callback=None, track_callback=None, clock=time.time, debug=False):
+        self.devices_to_track = set(devices_to_track)
+        self.seen_devices = {}
+        self.notify_callback = notify_callback
+        self.track_callback = track_callback
+        # replaceable so captures can be replayed with their own timestamps
+        self.clock = clock
+        self.debug = debug
+
+    def update(self, packet, now=None):
+        pass
+
+    def tick(self, now=None):
+        pass
+
+    def due(self, now):
+        # whether tick(now) would change anything, lets a caller driving many engines skip the other ticks
+        return True
+
+    def set_devices_to_track(self, devices_to_track):
+        # in place, devices still tracked keep their state, the state of the others is dropped
+        self.devices_to_track.clear()
+        self.devices_to_track.update(devices_to_track)
+        for device in list(self.seen_devices):
+            if device not in self.devices_to_track:
+                del self.seen_devices[device]
+
+    def configure(self, **thresholds):
+        # adjusts the engine thresholds without losing state, unknown names are ignored
+        for name, value in thresholds.items():
+            if hasattr(self, name):
+                setattr(self, name, value)
+
+    def _emit(self, device, event):
+        if self.notify_callback is not None:
+            self.notify_callback(device, message=json.dumps(event))
+        if self.track_callback is not None:
+            self.track_callback(device, event)
+
+
+class SimpleRuleEngine(InferenceEngine):
     def __init__(self, devices_to_track,
                  notify_callback=None,
                  track_callback=None,
                  consecutive_packet_delay_sec=2,
                  max_no_packet_sec=300,
-                 min_seen_count=3):
-        self.devices_to_track = devices_to_track
-        self.seen_devices = {}
+                 min_seen_count=3,
+                 clock=time.time,
+                 debug=True):
+        super().__init__(devices_to_track, notify_callback=notify_callback, track_callback=track_callback, clock=clock, debug=debug)
         self.consecutive_packet_delay_sec = consecutive_packet_delay_sec
         self.min_seen_count = min_seen_count
         self.max_no_packet_sec = max_no_packet_sec
-        self.notify_callback = notify_callback
-        self.track_callback = track_callback
+        # min-heap of (deadline, device) for appeared devices. deadlines are refreshed lazily in tick(),
+        # so a packet never touches the heap and the per-packet cost does not depend on the number of devices
+        self._deadlines = []
+        self._scheduled = set()
+
+    def configure(self, **thresholds):
+        max_no_packet_sec = self.max_no_packet_sec
+        super().configure(**thresholds)
+        if self.max_no_packet_sec != max_no_packet_sec:
+            # the scheduled deadlines used the previous timeout, a shorter one must not wait for them
+            deadlines = []
+            for device in list(self._scheduled):
+                seen_device = self.seen_devices.get(device)
+                if seen_device is None:
+                    self._scheduled.discard(device)
+                else:
+                    _heap_push(deadlines, (seen_device['last_seen'] + self.max_no_packet_sec, device))
+            self._deadlines = deadlines
 
-    def update(self, packet):
+    def update(self, packet, now=None):
         device = None
         if packet['src_device'] in self.devices_to_track:
             device = packet['src_device']
@@ -29,7 +123,8 @@ class SimpleRuleEngine:
 
         seen_device = self.seen_devices.get(device, {'last_seen': 0, 'seen_count': 0, 'first_seen': 0, 'appeared_since': 0, 'disappeared_since': 0})
         prev_last_seen = seen_device['last_seen']
-        now = time.time()
+        if now is None:
+            now = self.clock()
         seen_device['last_seen'] = now
         first_seen = seen_device['first_seen']
         if first_seen == 0:
@@ -41,7 +136,8 @@ class SimpleRuleEngine:
         if since_last_seen >= self.consecutive_packet_delay_sec:
             seen_device['seen_count'] += 1
         seen_device['previous_seen'] = prev_last_seen
-        print(f"{device}: {seen_device}")
+        if self.debug:
+            print(f"{device}: {seen_device}")
         # if there is a wide gap between first seen and last seen
         # and at least 3 packets from device, then consider device as "appearing"
         if first_seen >= 0 and seen_device['appeared_since'] == 0 \
@@ -49,33 +145,41 @@ class SimpleRuleEngine:
                 and seen_device['seen_count'] >= self.min_seen_count:
             seen_device['appeared_since'] = now
             seen_device['disappeared_since'] = 0
-            print(f"{device} appearing: {seen_device}")
-            event = {'type': 'appeared', 'data': seen_device}
-            if self.notify_callback is not None:
-                self.notify_callback(device, message=json.dumps(event))
-            if self.track_callback is not None:
-                self.track_callback(device, event)
+            if self.debug:
+                print(f"{device} appearing: {seen_device}")
+            self._emit(device, {'type': 'appeared', 'data': seen_device})
 
         self.seen_devices[device] = seen_device
 
-        self._check_disappeared()
+        if seen_device['appeared_since'] > 0 and device not in self._scheduled:
+            self._scheduled.add(device)
+            _heap_push(self._deadlines, (now + self.max_no_packet_sec, device))
+
+    def due(self, now):
+        return bool(self._deadlines) and self._deadlines[0][0] < now
 
-    def _check_disappeared(self):
-        # check other tracked devices, if no packet received from a dvice for a while, mark it as disappeared
-        for tracked_device in self.devices_to_track:
-            if tracked_device not in self.seen_devices or self.seen_devices[tracked_device]['appeared_since'] <= 0:
+    def tick(self, now=None):
+        # cheap enough to call on every loop iteration, fires 'disappeared' even when no traffic arrives
+        deadlines = self._deadlines
+        if not deadlines:
+            return
+        if now is None:
+            now = self.clock()
+        while deadlines and deadlines[0][0] < now:
+            _, device = _heap_pop(deadlines)
+            seen_device = self.seen_devices.get(device)
+            if seen_device is None or seen_device['appeared_since'] <= 0:
+                self._scheduled.discard(device)
+                continue
+            deadline = seen_device['last_seen'] + self.max_no_packet_sec
+            if deadline >= now:
+                # seen again since it was scheduled, check back at its current deadline
+                _heap_push(deadlines, (deadline, device))
                 continue
-            seen_device = self.seen_devices[tracked_device]
-            now = time.time()
-            since_last_seen = now - seen_device['last_seen']
-            if since_last_seen > self.max_no_packet_sec and seen_device['disappeared_since'] == 0:
+            self._scheduled.discard(device)
+            if seen_device['disappeared_since'] == 0:
                 seen_device['appeared_since'] = 0
                 seen_device['disappeared_since'] = now
-                print(f"{tracked_device} disappeared: {seen_device}")
-                event = {'type': 'disappeared', 'data': seen_device}
-                if self.notify_callback is not None:
-                    self.notify_callback(tracked_device, message=json.dumps(event))
-                if self.track_callback is not None:
-                    self.track_callback(tracked_device, event)
-
-                self.seen_devices[tracked_device] = seen_device
+                if self.debug:
+                    print(f"{device} disappeared: {seen_device}")
+                self._emit(device, {'type': 'disappeared', 'data': seen_device})
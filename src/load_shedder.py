@@ -0,0 +1,73 @@
+# coding: utf-8
+from frame_filter import DROP, FrameFilter
+
+
+class LoadShedder:
+    # watches the rx backlog found by each capture step and the time the loop spent elsewhere between two
+    # capture steps. while either is too high the pipeline samples 1 in sample_every frames, doubled every
+    # step_sec up to max_sample_every, and the deferred tasks run at their overload interval. frames of tracked
+    # devices are always decoded for presence. once calm for recover_sec the sampling is halved, step by step
+    def __init__(self, pipeline, tracked_macs=(), high_backlog=1024, max_lag_sec=0.1, max_sample_every=32, step_sec=0.5, recover_sec=5):
+        self.pipeline = pipeline
+        self.high_backlog = high_backlog
+        self.max_lag_sec = max_lag_sec
+        self.max_sample_every = max_sample_every
+        self.step_sec = step_sec
+        self.recover_sec = recover_sec
+        self.sample_every = 1
+        self.tracked_filter = None
+        self.set_tracked_macs(tracked_macs)
+        self._deferred = []  # [task, overload interval, interval before the overload]
+        self._last_finished = None
+        self._next_change = 0
+        self._calm_since = None
+        self.overloads = 0
+
+    @property
+    def overloaded(self):
+        return self.sample_every > 1
+
+    def set_tracked_macs(self, tracked_macs):
+        # a frame filter passing only the frames from or to a tracked mac
+        self.tracked_filter = FrameFilter(tracked_macs=tracked_macs, unknown=DROP, broadcast=DROP, multicast=DROP)
+        if self.overloaded:
+            self.pipeline.set_sampling(self.sample_every, self.tracked_filter)
+
+    def defer(self, task, overload_interval):
+        # a scheduler task which runs at most every overload_interval seconds while overloaded
+        self._deferred.append([task, overload_interval, task.interval])
+
+    def update(self, started, finished, backlog_bytes):
+        # after every capture step: its start and end time, and the rx backlog it found
+        lag = started - self._last_finished if self._last_finished is not None else 0
+        self._last_finished = finished
+        if backlog_bytes > self.high_backlog or lag > self.max_lag_sec:
+            self._calm_since = None
+            if self.sample_every < self.max_sample_every and finished >= self._next_change:
+                self._set(self.sample_every * 2, finished)
+        elif self.overloaded:
+            if self._calm_since is None:
+                self._calm_since = finished
+            elif finished - self._calm_since >= self.recover_sec:
+                self._calm_since = finished
+                self._set(self.sample_every // 2, finished)
+
+    def _set(self, sample_every, now):
+        entering = not self.overloaded
+        self.sample_every = sample_every
+        self._next_change = now + self.step_sec
+        self.pipeline.set_sampling(sample_every, self.tracked_filter)
+        if entering:
+            self.overloads += 1
+            for deferred in self._deferred:
+                task, overload_interval = deferred[0], deferred[1]
+                deferred[2] = task.interval
+                task.interval = max(task.interval, overload_interval)
+        elif not self.overloaded:
+            for task, overload_interval, interval in self._deferred:
+                if task.interval == max(interval, overload_interval):  # not changed by a config reload meanwhile
+                    task.interval = interval
+        print(f"Load shedding: sampling 1 in {sample_every}")
+
+    def stats(self):
+        return {'sample_every': self.sample_every, 'overloads': self.overloads, 'skipped': self.pipeline.skipped_count}
@@ -1,9 +1,22 @@
 # coding: utf-8
+from decoder import format_mac_addr, parse_mac_addr
+
 
 class Mapper:
     def __init__(self, mac_address_to_name_map, filter_unknown_mac_addresses=True):
-        self.mac_address_to_name_map = mac_address_to_name_map
+        self.mac_address_to_name_map = {}
+        # same table keyed by raw mac bytes, used for PacketRecord lookups
+        self.raw_mac_address_to_name_map = {}
         self.filter_unknown_mac_addresses = filter_unknown_mac_addresses
+        self.update(mac_address_to_name_map)
+
+    def update(self, mac_address_to_name_map):
+        # replaces the tables in place, holders of a reference to them see the new devices
+        self.mac_address_to_name_map.clear()
+        self.mac_address_to_name_map.update(mac_address_to_name_map)
+        self.raw_mac_address_to_name_map.clear()
+        for mac, name in mac_address_to_name_map.items():
+            self.raw_mac_address_to_name_map[parse_mac_addr(mac)] = name
 
     def map_to_name(self, mac_address, map_unknown_to=None):
         if mac_address in self.mac_address_to_name_map:
@@ -13,6 +26,19 @@ class Mapper:
         else:
             return map_unknown_to
 
+    def map_raw_to_name(self, raw_mac_address, map_unknown_to=None):
+        name = self.raw_mac_address_to_name_map.get(raw_mac_address)
+        if name is not None:
+            return name
+        elif not self.filter_unknown_mac_addresses:
+            return format_mac_addr(raw_mac_address)
+        else:
+            return map_unknown_to
+
     def map_packet(self, packet, map_unknown_to=None):
         packet['src_device'] = self.map_to_name(packet['src_mac'], map_unknown_to)
         packet['dst_device'] = self.map_to_name(packet['dst_mac'], map_unknown_to)
+
+    def map_record(self, record, map_unknown_to=None):
+        record.src_device = self.map_raw_to_name(record.src_mac, map_unknown_to)
+        record.dst_device = self.map_raw_to_name(record.dst_mac, map_unknown_to)
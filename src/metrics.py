@@ -0,0 +1,123 @@
+# coding: utf-8
+import gc
+
+from scheduler import _monotonic_ns
+
+PREFIX = 'home_events_'
+# histogram buckets are powers of two microseconds, 1us .. 2**(BUCKETS - 1)us (about 33s) and +Inf
+BUCKETS = 26
+
+
+class Histogram:
+    # fixed log2 buckets, observing is a few integer operations and never allocates a list
+    def __init__(self, name, labels=''):
+        self.name = name
+        self.labels = labels  # prometheus labels without the braces, e.g. 'stage="decode"'
+        self.buckets = [0] * (BUCKETS + 1)
+        self.count = 0
+        self.sum_us = 0
+
+    def observe_ns(self, ns):
+        # observe_us inlined, this is the per packet probe
+        us = ns // 1000
+        self.count += 1
+        self.sum_us += us
+        bucket = 0
+        while us and bucket < BUCKETS:
+            us >>= 1
+            bucket += 1
+        self.buckets[bucket] += 1
+
+    def observe_us(self, us):
+        self.count += 1
+        self.sum_us += us
+        bucket = 0
+        while us and bucket < BUCKETS:
+            us >>= 1
+            bucket += 1
+        self.buckets[bucket] += 1
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the fraction-th observation, in seconds
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return (1 << bucket) / 1000000
+        return (1 << BUCKETS) / 1000000
+
+
+class Metrics:
+    # timing histograms, plus counters and gauges read from the objects already counting them when rendered
+    def __init__(self, clock_ns=_monotonic_ns):
+        self.clock_ns = clock_ns
+        self.histograms = {}  # metric name -> [Histogram]
+        self.values = {}  # metric name -> (type, [(labels, callable)])
+        self.help = {}
+        self.gc = self.histogram('gc_seconds', help='duration of gc.collect()')
+        self.gauge('mem_free_bytes', getattr(gc, 'mem_free', lambda: 0), help='gc.mem_free(), 0 on CPython')
+
+    def histogram(self, name, labels='', help=''):
+        histogram = Histogram(name, labels)
+        self.histograms.setdefault(name, []).append(histogram)
+        if help:
+            self.help[name] = help
+        return histogram
+
+    def gauge(self, name, read, labels='', help='', kind='gauge'):
+        # kind 'counter' for running totals
+        self.values.setdefault(name, (kind, []))[1].append((labels, read))
+        if help:
+            self.help[name] = help
+
+    def counter(self, name, read, labels='', help=''):
+        self.gauge(name, read, labels=labels, help=help, kind='counter')
+
+    def collect_garbage(self):
+        # a timed gc.collect(), run periodically so the collection time is known and the heap stays compact
+        start = self.clock_ns()
+        gc.collect()
+        self.gc.observe_ns(self.clock_ns() - start)
+
+    def render(self):
+        # prometheus text exposition format, line by line so the document is never held in memory
+        for name, histograms in self.histograms.items():
+            yield from self._header(name, 'histogram')
+            for histogram in histograms:
+                separator = ',' if histogram.labels else ''
+                cumulative = 0
+                for bucket in range(BUCKETS):
+                    cumulative += histogram.buckets[bucket]
+                    yield '%s%s_bucket{%s%sle="%s"} %d\n' % (PREFIX, name, histogram.labels, separator, _seconds(1 << bucket), cumulative)
+                yield '%s%s_bucket{%s%sle="+Inf"} %d\n' % (PREFIX, name, histogram.labels, separator, histogram.count)
+                labels = '{%s}' % histogram.labels if histogram.labels else ''
+                yield '%s%s_sum%s %s\n' % (PREFIX, name, labels, _seconds(histogram.sum_us))
+                yield '%s%s_count%s %d\n' % (PREFIX, name, labels, histogram.count)
+        for name, (kind, values) in self.values.items():
+            yield from self._header(name, kind)
+            for labels, read in values:
+                yield '%s%s%s %s\n' % (PREFIX, name, '{%s}' % labels if labels else '', read())
+
+    def _header(self, name, kind):
+        if name in self.help:
+            yield '# HELP %s%s %s\n' % (PREFIX, name, self.help[name])
+        yield '# TYPE %s%s %s\n' % (PREFIX, name, kind)
+
+    def summary(self):
+        # the figures published over mqtt, percentiles instead of buckets
+        result = {}
+        for name, histograms in self.histograms.items():
+            for histogram in histograms:
+                key = name if not histogram.labels else name + ':' + histogram.labels.split('"')[1]
+                result[key] = {'count': histogram.count, 'p50': histogram.percentile(0.5), 'p99': histogram.percentile(0.99)}
+        for name, (_, values) in self.values.items():
+            for labels, read in values:
+                result[name if not labels else name + ':' + labels.split('"')[1]] = read()
+        return result
+
+
+def _seconds(us):
+    return '%g' % (us / 1000000)
@@ -0,0 +1,161 @@
+# coding: utf-8
+import json
+import time
+from array import array
+
+from features import FEATURE_NAMES, FEATURES_COUNT, FeatureExtractor
+from inference import InferenceEngine
+
+
+class QuantizedModel:
+    # int8 multi layer perceptron, see host/train_model.py for the file format. weights and activations are
+    # int8, accumulators int32. hidden layers apply relu then requantize with (acc * multiplier) >> shift,
+    # the last layer returns its accumulator which is compared to an integer threshold
+    def __init__(self, model):
+        if model.get('features', list(FEATURE_NAMES)) != list(FEATURE_NAMES):
+            raise ValueError("model was trained on other features")
+        self.input_offset = model['input_offset']
+        self.input_scale = model['input_scale']
+        self.threshold = model['threshold']
+        self.layers = []
+        width = FEATURES_COUNT
+        for layer in model['layers']:
+            if layer['inputs'] != width:
+                raise ValueError(f"layer expects {layer['inputs']} inputs, previous layer has {width} outputs")
+            width = layer['outputs']
+            self.layers.append((array('b', layer['weights']), array('l', layer['bias']), layer['inputs'], layer['outputs'],
+                                layer.get('multiplier', 0), layer.get('shift', 0)))
+        if width != 1:
+            raise ValueError("the last layer must have a single output")
+        max_width = max(layer[3] for layer in self.layers)
+        self._buffers = (array('l', [0] * max_width), array('l', [0] * max_width))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def size_bytes(self):
+        return sum(len(layer[0]) + 4 * len(layer[1]) for layer in self.layers)
+
+    def quantize(self, features, target, offset):
+        # the only float step, FEATURES_COUNT multiplications per device and window
+        input_offset = self.input_offset
+        input_scale = self.input_scale
+        for i in range(FEATURES_COUNT):
+            value = int((features[i] - input_offset[i]) * input_scale[i])
+            if value > 127:
+                value = 127
+            elif value < -127:
+                value = -127
+            target[offset + i] = value
+
+    def evaluate(self, inputs, offset=0):
+        source = inputs
+        source_offset = offset
+        layer_index = 0
+        for weights, bias, inputs_count, outputs_count, multiplier, shift in self.layers:
+            target = self._buffers[layer_index & 1]
+            weight = 0
+            for output in range(outputs_count):
+                acc = bias[output]
+                for i in range(inputs_count):
+                    acc += weights[weight + i] * source[source_offset + i]
+                weight += inputs_count
+                if multiplier:
+                    if acc < 0:
+                        acc = 0
+                    acc = (acc * multiplier) >> shift
+                    if acc > 127:
+                        acc = 127
+                target[output] = acc
+            source = target
+            source_offset = 0
+            layer_index += 1
+        return source[0]
+
+
+class QuantizedModelEngine(InferenceEngine):
+    # presence from a QuantizedModel evaluated once per feature window for all tracked devices together.
+    # a packet only updates the feature accumulators, the model never runs in the packet path
+    def __init__(self, model, devices_to_track,
+                 notify_callback=None,
+                 track_callback=None,
+                 window_sec=60,
+                 appear_windows=1,
+                 disappear_windows=3,
+                 clock=time.time,
+                 debug=False):
+        super().__init__(devices_to_track, notify_callback=notify_callback, track_callback=track_callback, clock=clock, debug=debug)
+        self.model = model
+        self.window_sec = window_sec
+        # consecutive windows with the same prediction before the state changes
+        self.appear_windows = appear_windows
+        self.disappear_windows = disappear_windows
+        self.features = FeatureExtractor(devices=self.devices_to_track, window_sec=window_sec, emit_callback=self._collect,
+                                         max_devices=len(self.devices_to_track), clock=clock, window_callback=self._evaluate)
+        # quantized inputs of one window, a row per tracked device
+        batch_size = max(1, len(self.devices_to_track))
+        self._batch = array('b', [0] * (batch_size * FEATURES_COUNT))
+        self._batch_devices = [None] * batch_size
+        self._batch_count = 0
+        self.windows_evaluated = 0
+
+    def set_devices_to_track(self, devices_to_track):
+        super().set_devices_to_track(devices_to_track)
+        self.features.max_devices = len(self.devices_to_track)
+        self.features.set_devices(self.devices_to_track)
+        batch_size = max(1, len(self.devices_to_track))
+        if batch_size > len(self._batch_devices):
+            self._batch = array('b', [0] * (batch_size * FEATURES_COUNT))
+            self._batch_devices = [None] * batch_size
+
+    def update(self, packet, now=None):
+        self.features.update(packet, now)
+
+    def tick(self, now=None):
+        self.features.tick(now)
+
+    def due(self, now):
+        return self.features.due(now)
+
+    def _collect(self, device, window_start, features):
+        row = self._batch_count
+        self.model.quantize(features, self._batch, row * FEATURES_COUNT)
+        self._batch_devices[row] = device
+        self._batch_count = row + 1
+
+    def _evaluate(self, window_start):
+        now = window_start + self.window_sec
+        model = self.model
+        for row in range(self._batch_count):
+            score = model.evaluate(self._batch, row * FEATURES_COUNT)
+            self._decide(self._batch_devices[row], score > model.threshold, score, now)
+        self._batch_count = 0
+        self.windows_evaluated += 1
+
+    def _decide(self, device, present, score, now):
+        seen_device = self.seen_devices.get(device)
+        if seen_device is None:
+            seen_device = self.seen_devices[device] = {'appeared_since': 0, 'disappeared_since': 0, 'score': 0, 'streak': 0, 'last_window': 0}
+        seen_device['score'] = score
+        seen_device['last_window'] = now
+        currently_present = seen_device['appeared_since'] > 0
+        if present == currently_present:
+            seen_device['streak'] = 0
+            return
+        seen_device['streak'] += 1
+        if present and seen_device['streak'] >= self.appear_windows:
+            seen_device['streak'] = 0
+            seen_device['appeared_since'] = now
+            seen_device['disappeared_since'] = 0
+            if self.debug:
+                print(f"{device} appearing: {seen_device}")
+            self._emit(device, {'type': 'appeared', 'data': seen_device})
+        elif not present and seen_device['streak'] >= self.disappear_windows:
+            seen_device['streak'] = 0
+            seen_device['appeared_since'] = 0
+            seen_device['disappeared_since'] = now
+            if self.debug:
+                print(f"{device} disappeared: {seen_device}")
+            self._emit(device, {'type': 'disappeared', 'data': seen_device})
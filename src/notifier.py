@@ -1,29 +1,187 @@
 # coding: utf-8
+import time
+from collections import OrderedDict
 
 import adafruit_minimqtt.adafruit_minimqtt as MQTT
-import adafruit_wiznet5k.adafruit_wiznet5k_socket as socket
+
+# presence events must reach the broker, stats and status messages are superseded by the next ones anyway
+DEFAULT_QOS = {'event': 1, 'stats': 0, 'status': 0}
 
 
 class MqttNotifier(object):
-    def __init__(self, eth, host: str, mqtt_user: str, mqtt_password: str, port: int = 1883, topic: str = "notifications", client_id: str = "home-net-events"):
-        MQTT.set_socket(socket, eth)
-        self.mqtt_client = MQTT.MQTT(broker=host, username=mqtt_user, password=mqtt_password, port=port, client_id=client_id)
-        self.mqtt_client.on_connect = self._on_connect
-        self.mqtt_client.on_publish = self._on_publish
+    def __init__(self, eth, host: str, mqtt_user: str, mqtt_password: str, port: int = 1883, topic: str = "notifications", client_id: str = "home-net-events",
+                 qos=None, max_queued=16, max_queued_bytes=8 * 1024, publish_interval=0.2, reconnect_min_sec=1, reconnect_max_sec=60, sockets=None):
+        # eth is the WIZnet interface on the board, None on a host (host.live) which uses its own network stack
+        self._socket_pool = None
+        if eth is not None:
+            import adafruit_wiznet5k.adafruit_wiznet5k_socket as socket
+            MQTT.set_socket(socket, eth)
+        else:
+            import socket
+            self._socket_pool = socket
+        self._broker = (host, port, mqtt_user, mqtt_password, client_id)
+        self.mqtt_client = self._create_client()
         self.topic = topic
+        # SocketBudget, the connection is only attempted when a socket is available for it
+        self.sockets = sockets
+        self.qos = dict(DEFAULT_QOS)
+        if qos:
+            self.qos.update(qos)
+        # topic -> (message, qos), only the latest message of a topic is kept, oldest topic first
+        self._queue = OrderedDict()
+        self._queued_bytes = 0
+        self.max_queued = max_queued
+        self.max_queued_bytes = max_queued_bytes
+        self.publish_interval = publish_interval
+        self.reconnect_min_sec = reconnect_min_sec
+        self.reconnect_max_sec = reconnect_max_sec
+        self._reconnect_delay = reconnect_min_sec
+        self._next_connect = 0
+        self._next_publish = 0
+        self.connected = False
+        self.last_sent = time.monotonic()
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def _create_client(self):
+        host, port, mqtt_user, mqtt_password, client_id = self._broker
+        # a single connect attempt, retries are driven by flush() so a broker outage never blocks the caller
+        if self._socket_pool is None:
+            client = MQTT.MQTT(broker=host, username=mqtt_user, password=mqtt_password, port=port, client_id=client_id, connect_retries=1)
+        else:
+            client = MQTT.MQTT(broker=host, username=mqtt_user, password=mqtt_password, port=port, client_id=client_id, connect_retries=1,
+                               socket_pool=self._socket_pool)
+        client.on_connect = self._on_connect
+        return client
+
+    def reconfigure(self, host, mqtt_user, mqtt_password, port=1883, topic="notifications", client_id="home-net-events"):
+        # queued messages move to the new topic prefix, other broker settings reconnect on the next flush()
+        if topic != self.topic:
+            prefix_length = len(self.topic)
+            queue = OrderedDict()
+            for queued_topic, queued in self._queue.items():
+                queue[topic + queued_topic[prefix_length:]] = queued
+            self._queue = queue
+            self.topic = topic
+        broker = (host, port, mqtt_user, mqtt_password, client_id)
+        if broker != self._broker:
+            self.stop()
+            self._broker = broker
+            self.mqtt_client = self._create_client()
+            self._reconnect_delay = self.reconnect_min_sec
+            self._next_connect = 0
 
     def start(self):
-        self.mqtt_client.connect()
+        self._connect(time.monotonic())
 
     def stop(self):
-        self.mqtt_client.disconnect()
+        if self.connected:
+            self.connected = False
+            try:
+                self.mqtt_client.disconnect()
+            except (MQTT.MMQTTException, OSError, RuntimeError):
+                pass
+            self._release_socket()
 
-    def notify(self, device, message):
-        self.mqtt_client.publish(topic=f"{self.topic}/{device}", msg=message, retain=False, qos=1)
+    def queued(self):
+        return len(self._queue)
 
-    def _on_connect(self, client, userdata, flags, rc):
-        self.notify("_mqtt_notifier", '{"message": "connected to MQTT broker."}')
+    def is_queued(self, device):
+        return f"{self.topic}/{device}" in self._queue
+
+    def notify(self, device, message, message_class='event'):
+        # only queues the message, it is published by flush()
+        topic = f"{self.topic}/{device}"
+        previous = self._queue.pop(topic, None)
+        if previous is not None:
+            self._queued_bytes -= len(previous[0])
+            self.coalesced += 1
+        self._queue[topic] = (message, self.qos.get(message_class, 1))
+        self._queued_bytes += len(message)
+        while len(self._queue) > 1 and (len(self._queue) > self.max_queued or self._queued_bytes > self.max_queued_bytes):
+            self._queued_bytes -= len(self._queue.pop(self._drop_candidate())[0])
+            self.dropped += 1
+
+    def _drop_candidate(self):
+        # the oldest qos 0 message goes first, events are dropped only when nothing else is left
+        for topic, (_, qos) in self._queue.items():
+            if qos == 0:
+                return topic
+        return next(iter(self._queue))
 
-    def _on_publish(self, client, _user_data, topic, _pid):
-        print(f"published to MQTT topic: {topic}, data: {_user_data}, pid: {_pid}, client: {client}")
+    def flush(self, budget=0.05):
+        # publishes queued messages for at most budget seconds and one message per publish_interval,
+        # reconnects with an exponential backoff while the broker is unreachable. returns the messages sent
+        now = time.monotonic()
+        if not self.connected and not self._connect(now):
+            return 0
+        deadline = now + budget
+        sent = 0
+        while self._queue and now >= self._next_publish and now < deadline:
+            topic = next(iter(self._queue))
+            message, qos = self._queue.pop(topic)
+            self._queued_bytes -= len(message)
+            try:
+                self.mqtt_client.publish(topic=topic, msg=message, retain=False, qos=qos)
+            except (MQTT.MMQTTException, OSError, RuntimeError) as e:
+                if topic not in self._queue:
+                    self._queue[topic] = (message, qos)
+                    self._queued_bytes += len(message)
+                self._disconnected(now, e)
+                return sent
+            sent += 1
+            self.published += 1
+            now = time.monotonic()
+            self.last_sent = now
+            self._next_publish = now + self.publish_interval
+        if not sent:
+            self._keepalive(now)
+        return sent
 
+    def _keepalive(self, now):
+        # MiniMQTT only pings from loop(), which blocks for at least a second. the broker drops clients
+        # silent for 1.5 keep alive periods, so ping after half of one without publishing
+        if now - self.last_sent < self.mqtt_client.keep_alive / 2:
+            return
+        try:
+            self.mqtt_client.ping()
+            self.last_sent = time.monotonic()
+        except (MQTT.MMQTTException, OSError, RuntimeError) as e:
+            self._disconnected(now, e)
+
+    def _connect(self, now):
+        if now < self._next_connect:
+            return False
+        if self.sockets is not None and not self.sockets.acquire('mqtt'):
+            # queued for the next free socket, not a broker failure so no backoff
+            return False
+        try:
+            self.mqtt_client.connect()
+        except (MQTT.MMQTTException, OSError, RuntimeError) as e:
+            self._release_socket()
+            print(f"MQTT connect failed, retry in {self._reconnect_delay}s: {e}")
+            self._next_connect = now + self._reconnect_delay
+            self._reconnect_delay = min(self._reconnect_delay * 2, self.reconnect_max_sec)
+            return False
+        self.connected = True
+        self._reconnect_delay = self.reconnect_min_sec
+        self.last_sent = time.monotonic()
+        return True
+
+    def _disconnected(self, now, error):
+        print(f"MQTT connection lost: {error}")
+        self.connected = False
+        self._next_connect = now + self._reconnect_delay
+        try:
+            self.mqtt_client.disconnect()
+        except (MQTT.MMQTTException, OSError, RuntimeError):
+            pass
+        self._release_socket()
+
+    def _release_socket(self):
+        if self.sockets is not None:
+            self.sockets.release('mqtt')
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.notify("_mqtt_notifier", '{"message": "connected to MQTT broker."}', message_class='status')
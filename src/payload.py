@@ -0,0 +1,208 @@
+# coding: utf-8
+import json
+import struct
+
+
+class StatsSerializer:
+    # builds the periodic stats message. every message has a sequence number and only carries what changed since
+    # the previous one, every full_every-th message is a full snapshot. a consumer which sees a gap in seq
+    # (e.g. a dropped qos 0 message) waits for the next message with "full": true
+    def __init__(self, stats, full_every=10, encoding='json'):
+        self.stats = stats
+        self.full_every = full_every
+        self.encoding = encoding
+        self.seq = 0
+        # what the previous message contained
+        self._flows = {}  # flow id -> packets_count
+        self._packet_types = {}
+        self._events = {}  # device -> event, events are replaced (not mutated) when a device changes state
+
+    def build(self, now=None, full=False):
+        self.seq += 1
+        full = full or self.full_every <= 1 or (self.seq - 1) % self.full_every == 0
+        stats = self.stats
+
+        flows = []
+        published_flows = {}
+        for flow in stats.top_flows():
+            flow_id = f"{flow['src_mac']}>{flow['dst_mac']}"
+            packets_count = flow['packets_count']
+            published_flows[flow_id] = packets_count
+            if full or self._flows.get(flow_id) != packets_count:
+                item = dict(flow)
+                item['id'] = flow_id
+                flows.append(item)
+        removed = [] if full else [flow_id for flow_id in self._flows if flow_id not in published_flows]
+        self._flows = published_flows
+
+        packet_types = {}
+        for packet_type, count in stats.packet_types.items():
+            if full or self._packet_types.get(packet_type) != count:
+                packet_types[packet_type] = count
+        self._packet_types = dict(stats.packet_types)
+
+        events = {}
+        for device, event in stats.tracking.items():
+            if full or self._events.get(device) is not event:
+                events[device] = event
+        self._events = dict(stats.tracking)
+
+        payload = {
+            'seq': self.seq,
+            'full': full,
+            'packets_count': stats.packets_count,
+            'filtered_count': stats.filtered_count,
+            'sampling_rate': 1 / stats.sample_every,
+            'packet_types': packet_types,
+            'rates': stats.rates(now),
+            'stats': flows,
+            'events': events,
+        }
+        if removed:
+            payload['removed'] = removed
+        return payload
+
+    def dumps(self, now=None, full=False):
+        payload = self.build(now, full)
+        if self.encoding == 'msgpack':
+            return msgpack_dumps(payload)
+        return json.dumps(payload)
+
+
+# minimal MessagePack, there is no msgpack module on CircuitPython
+def msgpack_dumps(obj):
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _pack_length(out, length, fix_tag, fix_max, tags):
+    # tags: 8, 16 and 32 bit length tags, None when the type has no 8 bit form
+    if length <= fix_max:
+        out.append(fix_tag | length)
+    elif tags[0] is not None and length <= 0xff:
+        out.append(tags[0])
+        out.append(length)
+    elif length <= 0xffff:
+        out.append(tags[1])
+        out.extend(struct.pack('>H', length))
+    else:
+        out.append(tags[2])
+        out.extend(struct.pack('>I', length))
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xff:
+            out.append(0xcc)
+            out.append(obj)
+        elif 0 <= obj <= 0xffff:
+            out.append(0xcd)
+            out.extend(struct.pack('>H', obj))
+        elif 0 <= obj <= 0xffffffff:
+            out.append(0xce)
+            out.extend(struct.pack('>I', obj))
+        elif obj > 0:
+            out.append(0xcf)
+            out.extend(struct.pack('>Q', obj))
+        elif obj >= -0x80:
+            out.append(0xd0)
+            out.extend(struct.pack('>b', obj))
+        elif obj >= -0x8000:
+            out.append(0xd1)
+            out.extend(struct.pack('>h', obj))
+        elif obj >= -0x80000000:
+            out.append(0xd2)
+            out.extend(struct.pack('>i', obj))
+        else:
+            out.append(0xd3)
+            out.extend(struct.pack('>q', obj))
+    elif isinstance(obj, float):
+        # doubles, timestamps do not fit a float32
+        out.append(0xcb)
+        out.extend(struct.pack('>d', obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        _pack_length(out, len(data), 0xa0, 31, (0xd9, 0xda, 0xdb))
+        out.extend(data)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _pack_length(out, len(obj), 0xc4, -1, (0xc4, 0xc5, 0xc6))
+        out.extend(obj)
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(out, len(obj), 0x90, 15, (None, 0xdc, 0xdd))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        _pack_length(out, len(obj), 0x80, 15, (None, 0xde, 0xdf))
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"can not pack {type(obj)}")
+
+
+def msgpack_loads(data):
+    value, _ = _unpack(memoryview(data), 0)
+    return value
+
+
+_UNPACK_FIXED = {
+    0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+    0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8),
+    0xca: ('>f', 4), 0xcb: ('>d', 8),
+}
+_UNPACK_LENGTH = {0xd9: ('str', 1), 0xda: ('str', 2), 0xdb: ('str', 4), 0xc4: ('bin', 1), 0xc5: ('bin', 2), 0xc6: ('bin', 4),
+                  0xdc: ('array', 2), 0xdd: ('array', 4), 0xde: ('map', 2), 0xdf: ('map', 4)}
+
+
+def _unpack(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag < 0x80:
+        return tag, pos
+    if tag >= 0xe0:
+        return tag - 0x100, pos
+    if tag == 0xc0:
+        return None, pos
+    if tag == 0xc2 or tag == 0xc3:
+        return tag == 0xc3, pos
+    if tag in _UNPACK_FIXED:
+        fmt, size = _UNPACK_FIXED[tag]
+        return struct.unpack(fmt, data[pos:pos + size])[0], pos + size
+    if 0xa0 <= tag <= 0xbf:
+        kind, length = 'str', tag & 0x1f
+    elif 0x90 <= tag <= 0x9f:
+        kind, length = 'array', tag & 0x0f
+    elif 0x80 <= tag <= 0x8f:
+        kind, length = 'map', tag & 0x0f
+    elif tag in _UNPACK_LENGTH:
+        kind, size = _UNPACK_LENGTH[tag]
+        length = int.from_bytes(data[pos:pos + size], 'big')
+        pos += size
+    else:
+        raise ValueError(f"unsupported msgpack tag {tag:#x}")
+    if kind == 'str':
+        return str(data[pos:pos + length], 'utf-8'), pos + length
+    if kind == 'bin':
+        return bytes(data[pos:pos + length]), pos + length
+    if kind == 'array':
+        items = []
+        for _ in range(length):
+            item, pos = _unpack(data, pos)
+            items.append(item)
+        return items, pos
+    result = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        result[key], pos = _unpack(data, pos)
+    return result, pos
@@ -0,0 +1,126 @@
+# coding: utf-8
+from decoder import PacketRecord, decode_packet_record
+from frame_filter import COUNT, PROCESS
+
+
+class Pipeline:
+    # decode -> map -> stats -> inference for a single frame, shared by code.py and the host tools
+    def __init__(self, mapper, stats, inference_engine, map_unknown_to='', event_log=None, features=None, decoder=None, frame_filter=None, metrics=None):
+        self.mapper = mapper
+        self.stats = stats
+        self.inference_engine = inference_engine
+        self.event_log = event_log  # EventLog receiving a summary of every packet, optional
+        self.features = features  # FeatureExtractor, optional
+        self.map_unknown_to = map_unknown_to
+        self.decoder = decoder  # dissectors.Decoder choosing the parsed layers, None for the default ones
+        self.frame_filter = frame_filter  # FrameFilter deciding from the raw header which frames are decoded, optional
+        self.packet = PacketRecord()  # reused for every frame to avoid per-packet allocations
+        self.packets_count = 0
+        # load shedding, see set_sampling
+        self.sample_every = 1
+        self.tracked_filter = None
+        self._sample_count = 0
+        self.skipped_count = 0
+        if metrics is not None:
+            # the timed variant replaces process, without metrics the packet path has no probe at all
+            self._clock_ns = metrics.clock_ns
+            self._timings = [metrics.histogram('stage_seconds', labels=f'stage="{stage}"') for stage in
+                             ('filter', 'decode', 'map', 'stats', 'features', 'inference', 'event_log')]
+            self.process = self._process_timed
+
+    def process(self, frame, now=None):
+        # returns the decoded packet, or None when the frame filter skipped the frame
+        if self.frame_filter is not None:
+            action = self.frame_filter.classify(frame)
+            if action != PROCESS:
+                if action == COUNT:
+                    self.stats.count_frame()
+                return None
+        if self.sample_every > 1:
+            return self._process_sampled(frame, now)
+        packet = decode_packet_record(frame, self.packet, self.decoder)
+        self.mapper.map_record(packet, map_unknown_to=self.map_unknown_to)
+        self.stats.update_record(packet, now)
+        if self.features is not None:
+            self.features.update(packet, now)
+        self.inference_engine.update(packet, now)
+        if self.event_log is not None:
+            self.event_log.record_packet(packet, now)
+        self.packets_count += 1
+        return packet
+
+    def set_sampling(self, sample_every, tracked_filter=None):
+        # 1 in sample_every frames goes through the whole pipeline and is counted sample_every times in the stats.
+        # of the others only the frames tracked_filter passes (tracked devices) are decoded, for presence only
+        self.sample_every = sample_every
+        self.tracked_filter = tracked_filter
+        self.stats.sample_every = sample_every
+        self._sample_count = 0
+
+    def process_inference(self, frame, now=None):
+        # decoded for presence only, the stats count the frame elsewhere or not at all
+        packet = decode_packet_record(frame, self.packet, self.decoder)
+        self.mapper.map_record(packet, map_unknown_to=self.map_unknown_to)
+        if self.features is not None:
+            self.features.update(packet, now)
+        self.inference_engine.update(packet, now)
+        return packet
+
+    def _process_sampled(self, frame, now):
+        self._sample_count += 1
+        if self._sample_count < self.sample_every:
+            if self.tracked_filter is None or self.tracked_filter.classify(frame) != PROCESS:
+                self.skipped_count += 1
+                return None
+            packet = self.process_inference(frame, now)
+            self.packets_count += 1
+            return packet
+        self._sample_count = 0
+        packet = decode_packet_record(frame, self.packet, self.decoder)
+        self.mapper.map_record(packet, map_unknown_to=self.map_unknown_to)
+        self.stats.update_record(packet, now, self.sample_every)
+        if self.features is not None:
+            self.features.update(packet, now)
+        self.inference_engine.update(packet, now)
+        if self.event_log is not None:
+            self.event_log.record_packet(packet, now)
+        self.packets_count += 1
+        return packet
+
+    def _process_timed(self, frame, now=None):
+        clock_ns = self._clock_ns
+        timed_filter, timed_decode, timed_map, timed_stats, timed_features, timed_inference, timed_event_log = self._timings
+        start = clock_ns()
+        if self.frame_filter is not None:
+            action = self.frame_filter.classify(frame)
+            end = clock_ns()
+            timed_filter.observe_ns(end - start)
+            start = end
+            if action != PROCESS:
+                if action == COUNT:
+                    self.stats.count_frame()
+                return None
+        if self.sample_every > 1:
+            return self._process_sampled(frame, now)
+        packet = decode_packet_record(frame, self.packet, self.decoder)
+        end = clock_ns()
+        timed_decode.observe_ns(end - start)
+        self.mapper.map_record(packet, map_unknown_to=self.map_unknown_to)
+        start = clock_ns()
+        timed_map.observe_ns(start - end)
+        self.stats.update_record(packet, now)
+        end = clock_ns()
+        timed_stats.observe_ns(end - start)
+        if self.features is not None:
+            self.features.update(packet, now)
+            start = end
+            end = clock_ns()
+            timed_features.observe_ns(end - start)
+        self.inference_engine.update(packet, now)
+        start = clock_ns()
+        timed_inference.observe_ns(start - end)
+        if self.event_log is not None:
+            self.event_log.record_packet(packet, now)
+            timed_event_log.observe_ns(clock_ns() - start)
+        self.packets_count += 1
+        return packet
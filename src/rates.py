@@ -0,0 +1,90 @@
+# coding: utf-8
+
+# (window seconds, buckets, label)
+RATE_WINDOWS = ((60, 6, '1m'), (300, 5, '5m'), (3600, 12, '1h'))
+
+
+class WindowCounter:
+    # ring of buckets covering the last window_sec seconds, O(1) updates and constant memory
+    def __init__(self, window_sec, buckets):
+        self.window_sec = window_sec
+        self.bucket_sec = window_sec / buckets
+        self.counts = [0] * buckets
+        self.epochs = [-1] * buckets  # absolute bucket number each slot currently holds
+
+    def epoch(self, now):
+        return int(now // self.bucket_sec)
+
+    def add(self, now, count=1, epoch=None):
+        if epoch is None:
+            epoch = int(now // self.bucket_sec)
+        slot = epoch % len(self.counts)
+        if self.epochs[slot] != epoch:
+            self.epochs[slot] = epoch
+            self.counts[slot] = 0
+        self.counts[slot] += count
+
+    def total(self, now):
+        oldest = int(now // self.bucket_sec) - len(self.counts) + 1
+        total = 0
+        for i in range(len(self.counts)):
+            if self.epochs[i] >= oldest:
+                total += self.counts[i]
+        return total
+
+    def rate(self, now):
+        # packets per second over the window, the current bucket only counts for the time elapsed in it
+        covered = self.window_sec - self.bucket_sec + (now - int(now // self.bucket_sec) * self.bucket_sec)
+        return self.total(now) / covered if covered > 0 else 0.0
+
+
+class RateCounter:
+    # the same count tracked over every configured window
+    def __init__(self, windows=RATE_WINDOWS):
+        self.windows = windows
+        self.counters = [WindowCounter(window_sec, buckets) for window_sec, buckets, _ in windows]
+
+    def add(self, now, count=1, epochs=None):
+        if epochs is None:
+            for counter in self.counters:
+                counter.add(now, count)
+            return
+        # WindowCounter.add inlined, this runs up to three times per packet
+        i = 0
+        for counter in self.counters:
+            epoch = epochs[i]
+            i += 1
+            counts = counter.counts
+            slot = epoch % len(counts)
+            if counter.epochs[slot] != epoch:
+                counter.epochs[slot] = epoch
+                counts[slot] = 0
+            counts[slot] += count
+
+    def rates(self, now, digits=3):
+        return {label: round(counter.rate(now), digits) for (_, _, label), counter in zip(self.windows, self.counters)}
+
+
+class RateCounters:
+    # one RateCounter per key (device name, packet type), created on first use
+    def __init__(self, windows=RATE_WINDOWS, max_keys=64):
+        self.windows = windows
+        self.max_keys = max_keys
+        self.counters = {}
+        # bucket numbers of the last timestamp, shared by all counters (frames of a burst share 'now')
+        self._now = None
+        self._epochs = None
+
+    def add(self, key, now, count=1):
+        counter = self.counters.get(key)
+        if counter is None:
+            if len(self.counters) >= self.max_keys:
+                return
+            counter = self.counters[key] = RateCounter(self.windows)
+        if now != self._now:
+            self._now = now
+            self._epochs = [c.epoch(now) for c in counter.counters]
+        counter.add(now, count, self._epochs)
+
+    def rates(self, now):
+        return {key: counter.rates(now) for key, counter in self.counters.items()}
@@ -0,0 +1,103 @@
+# coding: utf-8
+import time
+
+# time.monotonic_ns keeps its resolution on long running boards, time.monotonic (a float) does not
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:
+    def _monotonic_ns():
+        return int(time.monotonic() * 1000000000)
+
+
+def monotonic():
+    return _monotonic_ns() / 1000000000
+
+
+class Task:
+    def __init__(self, name, step, interval=0, budget=None):
+        self.name = name
+        # step(now, budget) does at most budget work (packets, seconds, ... as the task defines it)
+        self.step = step
+        self.interval = interval
+        self.budget = budget
+        self.next_run = 0
+        self.runs = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+        self.histogram = None
+
+    def stats(self):
+        return {'runs': self.runs, 'total_sec': self.total_sec, 'max_sec': self.max_sec}
+
+
+class Scheduler:
+    # cooperative round robin, no asyncio so it runs the same on CircuitPython and CPython.
+    # the priority task (capture) runs before every other task which is due, so a slow
+    # http client or mqtt publish only delays it by one step of that task
+    def __init__(self, clock=monotonic, idle_sleep=0, metrics=None):
+        self.clock = clock
+        self.idle_sleep = idle_sleep
+        self.priority_task = None
+        self.tasks = []
+        # Metrics receiving the duration of every loop iteration and task step, optional
+        self.metrics = metrics
+        self.loop_histogram = metrics.histogram('loop_seconds', help='one pass over every task') if metrics is not None else None
+
+    def add(self, name, step, interval=0, budget=None, priority=False, delay=0):
+        task = Task(name, step, interval=interval, budget=budget)
+        if self.metrics is not None:
+            task.histogram = self.metrics.histogram('task_seconds', labels=f'task="{name}"')
+        if delay:
+            task.next_run = self.clock() + delay
+        if priority:
+            self.priority_task = task
+        else:
+            self.tasks.append(task)
+        return task
+
+    def _run(self, task, now):
+        task.next_run = now + task.interval
+        result = task.step(now, task.budget)
+        elapsed = self.clock() - now
+        task.runs += 1
+        task.total_sec += elapsed
+        if elapsed > task.max_sec:
+            task.max_sec = elapsed
+        if task.histogram is not None:
+            task.histogram.observe_us(int(elapsed * 1000000))
+        return result
+
+    def run_once(self):
+        # returns the amount of work reported by the tasks, 0 when everything was idle
+        work = 0
+        priority_task = self.priority_task
+        if priority_task is not None and not self.tasks:
+            return self._run(priority_task, self.clock()) or 0
+        for task in self.tasks:
+            if priority_task is not None:
+                work += self._run(priority_task, self.clock()) or 0
+            now = self.clock()
+            if now >= task.next_run:
+                work += self._run(task, now) or 0
+        return work
+
+    def run_forever(self):
+        # idle_sleep > 0 lets a host process yield the cpu, on the board capture should poll as fast as it can
+        loop_histogram = self.loop_histogram
+        while True:
+            if loop_histogram is None:
+                work = self.run_once()
+            else:
+                start = _monotonic_ns()
+                work = self.run_once()
+                loop_histogram.observe_ns(_monotonic_ns() - start)
+            if not work and self.idle_sleep:
+                time.sleep(self.idle_sleep)
+
+    def stats(self):
+        result = {}
+        if self.priority_task is not None:
+            result[self.priority_task.name] = self.priority_task.stats()
+        for task in self.tasks:
+            result[task.name] = task.stats()
+        return result
@@ -1,18 +1,30 @@
 from adafruit_wiznet5k.adafruit_wiznet5k import *
 import time
 
+from capture import MAX_FRAME_SIZE, CaptureBackend
 
-class Sniffer:
-    def __init__(self, interface, debug=False):
+
+class Sniffer(CaptureBackend):
+    # capture backend of the board, the MACRAW socket of the WIZnet chip
+    def __init__(self, interface, debug=False, ring_size=8, frame_size=MAX_FRAME_SIZE, sockets=None):
+        super().__init__(ring_size)
         self._the_interface = interface
         self._debug = debug
+        self._sockets = sockets
+        if sockets is not None:
+            assert sockets.acquire('sniffer'), "no socket left for the sniffer"
         self._socknum = self._the_interface.get_socket()
         if self._debug:
             print("Socket number is: ", self._socknum)
         assert self._socknum == 0, "MACRAW socket must be socket 0"
 
-    def __exit__(self):
-        self._close_socket()
+        # receive buffers are allocated once, frames of a burst are memoryviews into them
+        self._ring_size = ring_size
+        self._frame_size = frame_size
+        self._ring = [memoryview(bytearray(frame_size)) for _ in range(ring_size)]
+        self._next_slot = 0
+        self._header = bytearray(2)
+        self._header_view = memoryview(self._header)
 
     def _read_s0cr(self):
         while True:
@@ -32,6 +44,8 @@ class Sniffer:
 
     def _close_socket(self):
         self._the_interface.socket_close(self._socknum)
+        if self._sockets is not None:
+            self._sockets.release('sniffer')
 
     def _listen(self):
         self._the_interface._write_sncr(self._socknum, CMD_SOCK_LISTEN)
@@ -44,11 +58,72 @@ class Sniffer:
     def stop(self):
         self._close_socket()
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop()
-
     def next_packet(self):
         return self._the_interface.socket_read(self._socknum, 65565)
+
+    def _read_rx_into(self, ptr, buffer, length):
+        # same addressing as WIZNET5K.socket_read, but reading into a caller provided buffer
+        interface = self._the_interface
+        if interface._chip_type == "w5500":
+            interface.read(ptr, 0x18 + (self._socknum << 5), length, buffer=buffer)
+            return
+        offset = ptr & SOCK_MASK
+        base_addr = self._socknum * SOCK_SIZE + 0x6000
+        if offset + length > SOCK_SIZE:
+            size = SOCK_SIZE - offset
+            interface.read(base_addr + offset, 0x00, size, buffer=buffer)
+            interface.read(base_addr, 0x00, length - size, buffer=buffer[size:])
+        else:
+            interface.read(base_addr + offset, 0x00, length, buffer=buffer)
+
+    def next_burst(self):
+        # drain every frame waiting in the MACRAW RX buffer (up to the ring size) with a single RECV command.
+        # returns the number of frames, available as memoryviews in self.frames[:count]
+        interface = self._the_interface
+        available = interface._get_rx_rcv_size(self._socknum)
+        self.backlog_bytes = available
+        self.burst_frames = 0
+        self.burst_bytes = 0
+        self.remaining_bytes = available
+        if available < 2:
+            return 0
+        if available > SOCK_SIZE - 62:
+            # no room for another frame, the chip dropped what arrived meanwhile
+            self.full_bursts += 1
+
+        ptr = interface._read_snrx_rd(self._socknum)
+        consumed = 0
+        count = 0
+        while count < self._ring_size and available - consumed >= 2:
+            # each MACRAW frame is prefixed by its length, including the 2 bytes of the length itself
+            self._read_rx_into(ptr, self._header_view, 2)
+            size = ((self._header[0] << 8) | self._header[1]) - 2
+            ptr = (ptr + 2) & 0xFFFF
+            consumed += 2
+            if size <= 0 or size > available - consumed:
+                # corrupted length, drop whatever is left in the buffer
+                self.dropped_bytes += available - consumed
+                ptr = (ptr + available - consumed) & 0xFFFF
+                consumed = available
+                break
+            if size > self._frame_size:
+                self.oversized_frames += 1
+            else:
+                slot = self._ring[self._next_slot]
+                self._next_slot = (self._next_slot + 1) % self._ring_size
+                self._read_rx_into(ptr, slot, size)
+                self.frames[count] = slot[:size]
+                count += 1
+            ptr = (ptr + size) & 0xFFFF
+            consumed += size
+
+        interface._write_snrx_rd(self._socknum, ptr)
+        interface._write_sncr(self._socknum, CMD_SOCK_RECV)
+        interface._read_sncr(self._socknum)
+
+        self.burst_frames = count
+        self.burst_bytes = consumed
+        self.remaining_bytes = available - consumed
+        if self._debug:
+            print(f"Burst: {count} frames, {consumed}/{available} bytes")
+        return count
@@ -0,0 +1,63 @@
+# coding: utf-8
+from adafruit_wiznet5k.adafruit_wiznet5k import SNSR_SOCK_CLOSED, SOCKET_INVALID
+
+
+def default_quotas(max_sockets):
+    # sniffer: socket 0 in MACRAW mode, mqtt: one persistent connection, one socket is left spare for
+    # dns lookups and sockets still closing, the rest listens for http (5 on a w5500, 1 on a w5100s)
+    return {'sniffer': 1, 'mqtt': 1, 'web': max(1, max_sockets - 3)}
+
+
+class SocketBudget:
+    # the W5x00 has 8 (w5500) or 4 (w5100s) hardware sockets shared by everything. each owner gets a quota,
+    # so the web server can no longer take the socket the mqtt client needs to reconnect
+    def __init__(self, interface, quotas=None):
+        self.interface = interface
+        self.max_sockets = interface.max_sockets
+        self.quotas = default_quotas(self.max_sockets) if quotas is None else quotas
+        self.used = {}
+        # owners which asked for a socket while none was available, served first come first served
+        self._waiting = []
+        self.denied = 0
+
+    def acquire(self, owner):
+        # returns False when the owner's quota is used, or queues the owner when the chip has no closed socket
+        # left. the caller retries later and the next released socket goes to the queued owners first
+        if self.used.get(owner, 0) >= self.quotas.get(owner, 0):
+            self.denied += 1
+            return False
+        if self.interface.get_socket() == SOCKET_INVALID:
+            return self._queue(owner)
+        if owner in self._waiting:
+            self._waiting.remove(owner)
+        elif len(self._waiting) >= self.free():
+            return self._queue(owner)
+        self.used[owner] = self.used.get(owner, 0) + 1
+        return True
+
+    def release(self, owner):
+        count = self.used.get(owner, 0)
+        if count > 0:
+            self.used[owner] = count - 1
+
+    def _queue(self, owner):
+        self.denied += 1
+        if owner not in self._waiting:
+            self._waiting.append(owner)
+        return False
+
+    def free(self):
+        return self.max_sockets - self.in_use()
+
+    def in_use(self):
+        # what the chip reports, sockets still closing count as used
+        interface = self.interface
+        count = 0
+        for socknum in range(self.max_sockets):
+            if interface.socket_status(socknum)[0] != SNSR_SOCK_CLOSED:
+                count += 1
+        return count
+
+    def stats(self):
+        return {'max': self.max_sockets, 'in_use': self.in_use(), 'used': self.used, 'quotas': self.quotas,
+                'waiting': list(self._waiting), 'denied': self.denied}
@@ -1,57 +1,244 @@
 # coding: utf-8
+import time
 from collections import OrderedDict
 
+from decoder import format_ip_addr, format_mac_addr
+from rates import RATE_WINDOWS, RateCounters
+
+MAX_FLOWS = 200
+
+
+class FlowTable:
+    # Space-Saving top-k summary with a fixed number of flows and O(1) updates.
+    # a flow's true packets count is between packets_count - error and packets_count,
+    # and every flow with more than total / capacity packets is guaranteed to be in the table
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = {}
+        self.total = 0
+        # the most packets a flow which is not in the table can have, the largest count of an evicted flow
+        self.lost_count = 0
+        self._buckets = {}  # packets_count -> {key: None}, flows with the same count in insertion order
+        self._min_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def increment(self, key, weight=1):
+        # returns the entry of key, or None when the flow is not in the table (see insert)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        count = entry['packets_count']
+        entry['packets_count'] = count + weight
+        self.total += weight
+        self._remove_from_bucket(key, count, count + weight)
+        self._add_to_bucket(key, count + weight)
+        return entry
+
+    def insert(self, key, entry, weight=1):
+        # adds a flow, replacing the flow with the smallest count when the table is full.
+        # returns the key of the replaced flow or None
+        evicted = None
+        error = 0
+        if len(self.entries) >= self.capacity:
+            error = self._min_count
+            evicted = next(iter(self._buckets[error]))
+            del self.entries[evicted]
+            self.lost_count = max(self.lost_count, error)
+            self._remove_from_bucket(evicted, error, error + weight)
+        count = error + weight
+        entry['packets_count'] = count
+        entry['error'] = error
+        self.entries[key] = entry
+        self.total += weight
+        self._add_to_bucket(key, count)
+        return evicted
+
+    def resize(self, capacity):
+        # sets the number of flows, the flows with the smallest counts are evicted down to it.
+        # returns the keys of the evicted flows
+        self.capacity = capacity
+        evicted = []
+        while len(self.entries) > capacity:
+            count = self._min_count
+            bucket = self._buckets[count]
+            key = next(iter(bucket))
+            del bucket[key]
+            del self.entries[key]
+            self.lost_count = max(self.lost_count, count)
+            if not bucket:
+                del self._buckets[count]
+                self._min_count = min(self._buckets) if self._buckets else 0
+            evicted.append(key)
+        return evicted
+
+    def top_items(self, count=None):
+        # (key, entry) of the flows ordered by their guaranteed count, packets_count - error. only the flows
+        # guaranteed to be heavier than any flow the table lost are listed, flows of equal count in bucket order
+        result = []
+        lost_count = self.lost_count
+        for packets_count in sorted(self._buckets, reverse=True):
+            if packets_count <= lost_count:
+                break
+            for key in self._buckets[packets_count]:
+                entry = self.entries[key]
+                if packets_count - entry['error'] > lost_count:
+                    result.append((key, entry))
+        result.sort(key=lambda item: item[1]['packets_count'] - item[1]['error'], reverse=True)
+        return result if count is None else result[:count]
+
+    def top(self, count=None):
+        return [entry for _, entry in self.top_items(count)]
+
+    def _add_to_bucket(self, key, count):
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = {}
+        bucket[key] = None
+        if len(self.entries) == 1 or count < self._min_count:
+            self._min_count = count
+
+    def _remove_from_bucket(self, key, count, next_count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if bucket:
+            return
+        del self._buckets[count]
+        if count == self._min_count:
+            # with unit increments the key moved to the next count, so no bucket can be in between
+            if next_count == count + 1 or not self._buckets:
+                self._min_count = next_count
+            else:
+                self._min_count = min(min(self._buckets), next_count)
+
 
 class PacketStats:
-    def __init__(self, mapper, notify_every_seconds=60, max_packet_size=20):
+    def __init__(self, mapper, notify_every_seconds=60, max_packet_size=20, max_flows=MAX_FLOWS, rate_windows=RATE_WINDOWS, clock=time.time):
         self.packets_count = 0
+        # frames only counted, the frame filter skipped their decoding. they are part of packets_count
+        self.filtered_count = 0
+        # 1 in sample_every packets is counted with that weight while the load shedder samples, 1 at full fidelity
+        self.sample_every = 1
         self.packet_types = OrderedDict()
         self.mapper = mapper
-        self.stats = OrderedDict()
+        # max_flows bounds the memory of the flow table, max_packet_size is the number of top flows reported. the
+        # reported flows are those guaranteed above what the table lost, which takes about 10 slots per reported flow
+        # read through top_flows(), entries added by update_record only get their formatted macs there
+        self.flows = FlowTable(max_flows)
         self.tracking = OrderedDict()
         self.notify_every_seconds = notify_every_seconds
         self.max_packet_size = max_packet_size
+        # last raw (src_ip, dst_ip) per flow, formatted when the flow is read
+        self._flow_ips = {}
+        # rolling packet rates, devices are limited to the mapped ones so memory stays constant
+        self.device_rates = RateCounters(rate_windows)
+        self.packet_type_rates = RateCounters(rate_windows)
+        self.clock = clock
 
     def track(self, device, event):
         self.tracking[device] = event
 
-    def update(self, packet):
-        self.packets_count += 1
-        packet_type = packet['type']
+    def resize_flows(self, max_flows):
+        for key in self.flows.resize(max_flows):
+            self._flow_ips.pop(key, None)
+
+    def top_flows(self, count=None):
+        # flows added by update_record keep raw addresses, they are formatted here for the reported flows only
+        result = []
+        for key, entry in self.flows.top_items(self.max_packet_size if count is None else count):
+            if entry['src_mac'] is None:
+                entry['src_mac'] = format_mac_addr(key[0])
+                entry['dst_mac'] = format_mac_addr(key[1])
+            ips = self._flow_ips.get(key)
+            if ips is not None:
+                entry['src_ip'] = format_ip_addr(ips[0])
+                entry['dst_ip'] = format_ip_addr(ips[1])
+            result.append(entry)
+        return result
+
+    def rates(self, now=None):
+        if now is None:
+            now = self.clock()
+        return {'devices': self.device_rates.rates(now), 'packet_types': self.packet_type_rates.rates(now)}
+
+    def _count_type(self, packet_type, weight=1):
         if packet_type not in self.packet_types:
-            self.packet_types[packet_type] = 1
+            self.packet_types[packet_type] = weight
         else:
-            self.packet_types[packet_type] += 1
-        src_mac = packet['src_mac']
-        src_device = packet['src_device']
-        dst_mac = packet['dst_mac']
-        dst_device = packet['dst_device']
-
-        if len(self.stats) > self.max_packet_size:
-            self.stats.popitem()
-
-        key = (src_mac, dst_mac)
-        if key not in self.stats:
-            self.stats[key] = {
-                'src_mac': src_mac,
-                'src_device': src_device,
-                'dst_mac': dst_mac,
-                'dst_device': dst_device,
-                'packets_count': 1,
-                'packet_types': {packet_type: 1},
-                'src_ip': '',
-                'dst_ip': '',
-            }
+            self.packet_types[packet_type] += weight
+
+    def _count_rates(self, now, packet_type, src_device, dst_device, weight=1):
+        if now is None:
+            now = self.clock()
+        self.packet_type_rates.add(packet_type, now, weight)
+        if src_device:
+            self.device_rates.add(src_device, now, weight)
+        if dst_device and dst_device != src_device:
+            self.device_rates.add(dst_device, now, weight)
+
+    def _add_flow(self, key, src_mac, src_device, dst_mac, dst_device, packet_type, weight=1):
+        entry = {
+            'src_mac': src_mac,
+            'src_device': src_device,
+            'dst_mac': dst_mac,
+            'dst_device': dst_device,
+            'packets_count': weight,
+            'packet_types': {packet_type: weight},
+            'src_ip': '',
+            'dst_ip': '',
+        }
+        evicted = self.flows.insert(key, entry, weight)
+        if evicted is not None:
+            self._flow_ips.pop(evicted, None)
+        return entry
+
+    def count_frame(self):
+        self.packets_count += 1
+        self.filtered_count += 1
+
+    def update(self, packet, now=None):
+        self.packets_count += 1
+        packet_type = packet['type']
+        self._count_type(packet_type)
+        self._count_rates(now, packet_type, packet['src_device'], packet['dst_device'])
+        if packet_type == 'unknown':
+            packet_type = f"{packet['eth_proto']:x}"
+
+        key = (packet['src_mac'], packet['dst_mac'])
+        entry = self.flows.increment(key)
+        if entry is None:
+            entry = self._add_flow(key, packet['src_mac'], packet['src_device'], packet['dst_mac'], packet['dst_device'], packet_type)
+        elif packet_type not in entry['packet_types']:
+            entry['packet_types'][packet_type] = 1
         else:
-            self.stats[key]['packets_count'] += 1
-            if packet_type == 'unknown':
-                packet_type = f"{packet['eth_proto']:x}"
+            entry['packet_types'][packet_type] += 1
+
+        if packet_type == 'ipv4' and 'error' not in packet['ip_packet']:
+            entry['src_ip'] = packet['ip_packet']['src_ip']
+            entry['dst_ip'] = packet['ip_packet']['dst_ip']
 
-            if packet_type not in self.stats[key]['packet_types']:
-                self.stats[key]['packet_types'][packet_type] = 1
+    def update_record(self, record, now=None, weight=1):
+        # weight: the number of packets this sampled one stands for
+        self.packets_count += weight
+        packet_type = record.type
+        self._count_type(packet_type, weight)
+        self._count_rates(now, packet_type, record.src_device, record.dst_device, weight)
+        if packet_type == 'unknown' and record.eth_proto is not None:
+            packet_type = f"{record.eth_proto:x}"
+
+        key = (record.src_mac, record.dst_mac)
+        entry = self.flows.increment(key, weight)
+        if entry is None:
+            entry = self._add_flow(key, None, record.src_device, None, record.dst_device, packet_type, weight)
+        else:
+            packet_types = entry['packet_types']
+            if packet_type not in packet_types:
+                packet_types[packet_type] = weight
             else:
-                self.stats[key]['packet_types'][packet_type] += 1
+                packet_types[packet_type] += weight
 
-        if packet_type == 'ipv4' and 'error' not in packet['ip_packet']:
-            self.stats[key]['src_ip'] = packet['ip_packet']['src_ip']
-            self.stats[key]['dst_ip'] = packet['ip_packet']['dst_ip']
+        if packet_type == 'ipv4' and record.src_ip is not None:
+            ips = self._flow_ips.get(key)
+            if ips is None or ips[0] != record.src_ip or ips[1] != record.dst_ip:
+                self._flow_ips[key] = (record.src_ip, record.dst_ip)
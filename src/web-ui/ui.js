@@ -40,7 +40,10 @@
     
     function handleEvent(e) {
         var elements = getElements();
-        
+        if (!elements.menuLink) {
+            return;
+        }
+
         if (e.target.id === elements.menuLink.id) {
             toggleAll();
             e.preventDefault();
@@ -51,4 +54,72 @@
     
     document.addEventListener('click', handleEvent);
 
+    function escapeHtml(value) {
+        return String(value).replace(/[&<>"]/g, function (c) {
+            return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}[c];
+        });
+    }
+
+    function renderTable(headers, rows) {
+        var html = '<table class="pure-table pure-table-striped"><thead><tr>';
+        var i, j;
+        for (i = 0; i < headers.length; i++) {
+            html += '<th>' + headers[i] + '</th>';
+        }
+        html += '</tr></thead><tbody>';
+        for (i = 0; i < rows.length; i++) {
+            html += '<tr><td>' + (i + 1) + '</td>';
+            for (j = 0; j < rows[i].length; j++) {
+                html += '<td>' + escapeHtml(rows[i][j]) + '</td>';
+            }
+            html += '</tr>';
+        }
+        return html + '</tbody></table>';
+    }
+
+    function getJson(url, callback) {
+        var request = new XMLHttpRequest();
+        request.onload = function () {
+            if (request.status === 200) {
+                callback(JSON.parse(request.responseText));
+            }
+        };
+        request.open('GET', url);
+        request.send();
+    }
+
+    function loadStats() {
+        getJson('/api/stats', function (data) {
+            document.getElementById('chip-name').textContent = data.chip;
+            document.getElementById('packets-count').textContent = data.packets_count;
+            var rows = data.stats.map(function (stat) {
+                var types = Object.keys(stat.packet_types).map(function (t) {
+                    return t + ': ' + stat.packet_types[t];
+                }).join(', ');
+                return [stat.src_device || stat.src_mac, stat.dst_device || stat.dst_mac, stat.packets_count, types, stat.src_ip, stat.dst_ip];
+            });
+            document.getElementById('packets-table').innerHTML =
+                renderTable(['#', 'Source', 'Destination', 'Packets', 'Types', 'Source IP', 'Destination IP'], rows);
+        });
+    }
+
+    function loadEvents() {
+        getJson('/api/events', function (data) {
+            var element = document.getElementById('events-table');
+            if (data.events.length < 1) {
+                element.textContent = 'No events detected yet';
+                return;
+            }
+            var rows = data.events.map(function (event) {
+                var since = event.type === 'appeared' ? event.data.appeared_since : event.data.disappeared_since;
+                return [event.device, event.type, new Date(since * 1000).toLocaleString()];
+            });
+            element.innerHTML = renderTable(['#', 'Device', 'Event', 'Since'], rows);
+        });
+    }
+
+    // one request at a time, the device serves a single client per loop iteration
+    loadEvents();
+    setTimeout(loadStats, 500);
+
 }(this, this.document));
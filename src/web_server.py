@@ -8,6 +8,10 @@ import microcontroller
 import supervisor
 
 import gc
+import json
+import os
+import time
+from collections import OrderedDict
 
 # Here we create our application, registering the
 # following functions to be called on specific HTTP GET requests routes
@@ -15,8 +19,71 @@ web_app = WSGIApp()
 
 
 class MyWSGIServer(server.WSGIServer):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, send_buffer_size=0x800, sockets=None, idle_timeout=2, **kwargs):
         super().__init__(*args, **kwargs)
+        # every response is sent through this buffer, chunks of at most 2 kb (the W5x00 socket buffer size)
+        self._send_buffer = memoryview(bytearray(send_buffer_size))
+        # listeners are taken from the SocketBudget, so sockets stay available for the mqtt client
+        self.sockets = sockets
+        if sockets is not None:
+            self.MAX_SOCK_NUM = sockets.quotas.get('web', 1)
+        # connected clients which did not send a request within idle_timeout seconds are closed,
+        # the default of the base class blocks the loop for up to 20 seconds on a slow client
+        self.idle_timeout = idle_timeout
+        self._timeout = idle_timeout
+        self._connected_since = {}
+        self.idle_closed = 0
+
+    def start(self):
+        self._listen()
+
+    def _listen(self):
+        while len(self._client_sock) < self.MAX_SOCK_NUM:
+            if self.sockets is not None and not self.sockets.acquire('web'):
+                return
+            try:
+                new_sock = socket.socket()
+                new_sock.settimeout(self._timeout)
+                new_sock.bind((None, self.port))
+                new_sock.listen()
+            except RuntimeError:
+                self._release()
+                return
+            self._client_sock.append(new_sock)
+
+    def _release(self):
+        if self.sockets is not None:
+            self.sockets.release('web')
+
+    def _remove(self, sock):
+        self._client_sock.remove(sock)
+        self._connected_since.pop(sock.socknum, None)
+        self._release()
+
+    def update_poll(self):
+        # serves at most one request per call, then drops closed and idle clients and listens again
+        for sock in self._client_sock:
+            if sock.available():
+                environ = self._get_environ(sock)
+                result = self.application(environ, self._start_response)
+                self.finish_response(result, sock)
+                self._remove(sock)
+                break
+        now = time.monotonic()
+        for sock in list(self._client_sock):
+            status = sock.status
+            if status == SNSR_SOCK_CLOSED:
+                self._remove(sock)
+            elif status == SNSR_SOCK_ESTABLISHED:
+                since = self._connected_since.get(sock.socknum)
+                if since is None:
+                    self._connected_since[sock.socknum] = now
+                elif now - since > self.idle_timeout:
+                    sock.disconnect()
+                    sock.close()
+                    self._remove(sock)
+                    self.idle_closed += 1
+        self._listen()
 
     def finish_response(self, result, client):
         try:
@@ -25,16 +92,23 @@ class MyWSGIServer(server.WSGIServer):
                 response += "{0}: {1}\r\n".format(*header)
             response += "\r\n"
             client.send(response.encode("utf-8"))
+            send_buffer = self._send_buffer
+            buffer_size = len(send_buffer)
+            used = 0
             for data in result:
                 if not isinstance(data, bytes):
                     data = data.encode("utf-8")
-                if len(data) < 0x800:
-                    client.send(data)
-                else:
-                    # split to chunks of 2 kb
-                    data_chunks = [data[i:i + 0x800] for i in range(0, len(data), 0x800)]
-                    for data_chunk in data_chunks:
-                        client.send(data_chunk)
+                data = memoryview(data)
+                while len(data) > 0:
+                    size = min(buffer_size - used, len(data))
+                    send_buffer[used:used + size] = data[:size]
+                    used += size
+                    data = data[size:]
+                    if used == buffer_size:
+                        client.send(send_buffer)
+                        used = 0
+            if used:
+                client.send(send_buffer[:used])
 
             gc.collect()
         finally:
@@ -47,91 +121,51 @@ class WebServer:
         self.eth = None
         self.packet_stats = None
         self.wsgi_server = None
+        self.sockets = None
+        # applies config.json without restarting, see ConfigReloader. the board restarts when it is not set
+        self.reload_callback = None
+        self.metrics = None  # Metrics served at /metrics
 
-    def begin(self, eth, packet_stats):
+    def begin(self, eth, packet_stats, sockets=None):
         self.eth = eth
         self.packet_stats = packet_stats
+        self.sockets = sockets
 
         requests.set_socket(socket, eth)
         server.set_interface(eth)
-        self.wsgi_server = MyWSGIServer(80, application=web_app)
+        self.wsgi_server = MyWSGIServer(80, application=web_app, sockets=sockets)
 
         self.wsgi_server.start()
 
-    def get_main_page(self):
-        with open("web-ui/index.html", "r") as f:
-            index_page_source = f.read()
-        html = index_page_source.replace("$CHIPNAME", self.eth.chip)
-        html = self._update_events_table(html)
-        html = self._update_packets_table(html)
-        return html
-
-    def _update_events_table(self, html_string):
-        events = self.packet_stats.tracking
-        if len(events) < 1:
-            return html_string.replace("$EVENTS_TABLE", "No events detected yet")
-
-        events_view = """
-                <table class="pure-table pure-table-striped">
-                    <thead>
-                        <tr>
-                            <th>#</th>
-                            <th>Device</th>
-                            <th>Event</th>
-                            <th>Since</th>
-                        </tr>
-                    </thead>
-                    <tbody>"""
-        print(events)
-        i = 0
-        for device, event in events.items():
-            i += 1
-            events_view += f"<tr><td>{i}</td><td>{device}</td><td>{event['type']}</td><td>{event}</td></tr>"
-        events_view += "</tbody></table>"
-
-        return html_string.replace("$EVENTS_TABLE", events_view)
-
-    # todo: serve this as json (streaming) to avoid memory limit error
-    def _update_packets_table(self, html_string):
-        html_string = html_string.replace("$PACKETS_COUNT", str(self.packet_stats.packets_count))
-        sorted_by_packet_count = sorted(self.packet_stats.stats.items(), key=lambda x: x[1]["packets_count"], reverse=True)
-        packets_stats_view = """
-                <table class="pure-table pure-table-striped">
-                    <thead>
-                        <tr>
-                            <th>#</th>
-                            <th>Source</th>
-                            <th>Destination</th>
-                            <th>Packets</th>
-                            <th>Types</th>
-                            <th>Source IP</th>
-                            <th>Destination IP</th>
-                        </tr>
-                    </thead>
-                    <tbody>"""
-
-        i = 0
-        for key, stat in sorted_by_packet_count:
-            if i >= 20:
-                break
-
-            source = stat["src_device"]
-            if len(source) < 1:
-                source = stat["src_mac"]
-            destination = stat["dst_device"]
-            if len(destination) < 1:
-                destination = stat["dst_mac"]
-            packets = stat["packets_count"]
-            source_ip = stat["src_ip"]
-            destination_ip = stat["dst_ip"]
-
-            packet_types = ", ".join(f"{t}: {c}" for t, c in stat["packet_types"].items())
-            i += 1
-            packets_stats_view += f"<tr><td>{i}</td><td>{source}</td><td>{destination}</td><td>{packets}</td><td>{packet_types}</td>\
-                <td>{source_ip}</td><td>{destination_ip}</td></tr>"
-
-        packets_stats_view += "</tbody></table>"
-        return html_string.replace("$SNIFFED_PACKETS_STATS", packets_stats_view)
+    # the json documents are generated piece by piece, the full document is never held in memory
+    def stats_json(self):
+        stats = self.packet_stats
+        yield '{"chip": %s, "packets_count": %d, "filtered_count": %d, "sampling_rate": %s, "packet_types": ' % (
+            json.dumps(self.eth.chip), stats.packets_count, stats.filtered_count, 1 / stats.sample_every)
+        yield json.dumps(stats.packet_types)
+        yield ', "rates": '
+        yield json.dumps(stats.rates())
+        if self.sockets is not None:
+            yield ', "sockets": '
+            yield json.dumps(self.sockets.stats())
+        yield ', "stats": ['
+        separator = ''
+        for flow in stats.top_flows():
+            yield separator
+            yield json.dumps(flow)
+            separator = ', '
+        yield ']}'
+
+    def events_json(self):
+        yield '{"events": ['
+        separator = ''
+        for device, event in self.packet_stats.tracking.items():
+            yield separator
+            yield '{"device": %s, "type": %s, "data": ' % (json.dumps(device), json.dumps(event['type']))
+            yield json.dumps(event['data'])
+            yield '}'
+            separator = ', '
+        yield ']}'
 
     def loop(self):
         self.wsgi_server.update_poll()
@@ -141,27 +175,134 @@ class WebServer:
 web_server_instance = WebServer()
 
 
+def json_response(body):
+    return "200 OK", [("Connection", "close"), ("Content-Type", "application/json"), ("Cache-Control", "no-store")], body
+
+
 @web_app.route("/")
 def root(request):  # pylint: disable=unused-argument
-    return "200 OK", [("Connection", "close"), ("Content-Type", "text/html")], [web_server_instance.get_main_page()]
+    # the page is static, tables are filled by ui.js from the api endpoints
+    return static_file("web-ui/index.html", request=request, max_age=0)
+
+
+@web_app.route("/api/stats")
+def api_stats(request):  # pylint: disable=unused-argument
+    return json_response(web_server_instance.stats_json())
 
 
-def static_file(path, content_type="text/html"):
-    with open(path, "r") as f:
-        data = f.read()
-        response = ("200 OK", [("Connection", "close"), ("Content-Type", f"{content_type}; charset=utf-8"), ("Cache-Control", "max-age=604800")], [data])
-        return response
+@web_app.route("/metrics")
+def metrics(request):  # pylint: disable=unused-argument
+    if web_server_instance.metrics is None:
+        return "404 Not Found", [("Connection", "close")], []
+    return "200 OK", [("Connection", "close"), ("Content-Type", "text/plain; version=0.0.4"), ("Cache-Control", "no-store")], \
+        web_server_instance.metrics.render()
+
+
+@web_app.route("/api/events")
+def api_events(request):  # pylint: disable=unused-argument
+    return json_response(web_server_instance.events_json())
+
+
+class StaticCache:
+    # static files are read from flash once and kept in memory, least recently used first out past max_bytes.
+    # etags come from the file size and mtime, so a 304 never touches the file content
+    def __init__(self, max_bytes=20 * 1024, chunk_size=512):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._entries = OrderedDict()  # path -> (etag, data or None when too large to cache)
+        self._missing = set()  # e.g. .gz variants which were not generated
+
+    def _load(self, path):
+        if path in self._missing:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._missing.add(path)
+            return None
+        etag = '"%x-%x"' % (stat[6], int(stat[8]))
+        data = None
+        if stat[6] <= self.max_bytes:
+            with open(path, "rb") as f:
+                data = f.read()
+        return etag, data
+
+    def get(self, path):
+        # returns (etag, body iterable) or None if the file does not exist
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            entry = self._load(path)
+            if entry is None:
+                return None
+            if entry[1] is not None:
+                self.size += len(entry[1])
+        self._entries[path] = entry  # most recently used last
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            evicted_path = next(iter(self._entries))
+            evicted = self._entries.pop(evicted_path)
+            if evicted[1] is not None:
+                self.size -= len(evicted[1])
+        etag, data = entry
+        if data is None:
+            return etag, self._file_chunks(path)
+        return etag, [data]
+
+    def _file_chunks(self, path):
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self._missing = set()
+        self.size = 0
+
+
+static_cache = StaticCache()
+
+
+def _header(request, name):
+    if request is None:
+        return ""
+    return request.headers.get(name, "").strip()
+
+
+def static_file(path, content_type="text/html", request=None, max_age=604800):
+    # serves path.gz (make gzip-web-ui) with Content-Encoding: gzip when the client accepts it
+    headers = [("Connection", "close"), ("Content-Type", f"{content_type}; charset=utf-8"),
+               ("Cache-Control", f"max-age={max_age}" if max_age else "no-cache"), ("Vary", "Accept-Encoding")]
+    cached = None
+    if "gzip" in _header(request, "accept-encoding"):
+        cached = static_cache.get(path + ".gz")
+        if cached is not None:
+            headers.append(("Content-Encoding", "gzip"))
+    if cached is None:
+        cached = static_cache.get(path)
+    if cached is None:
+        return "404 Not Found", [("Connection", "close")], []
+
+    etag, body = cached
+    headers.append(("ETag", etag))
+    if etag in _header(request, "if-none-match"):
+        return "304 Not Modified", headers, []
+    return "200 OK", headers, body
 
 
 @web_app.route("/home")
 def home(request):  # pylint: disable=unused-argument
-    return static_file("web-ui/index.html")
+    return static_file("web-ui/index.html", request=request, max_age=0)
 
 
 @web_app.route("/reload")
 def reload(request):  # pylint: disable=unused-argument
-    supervisor.reload()
-    return home(request)
+    if web_server_instance.reload_callback is None:
+        supervisor.reload()
+        return home(request)
+    return json_response([json.dumps(web_server_instance.reload_callback())])
 
 
 @web_app.route("/reset")
@@ -172,24 +313,29 @@ def reset(request):  # pylint: disable=unused-argument
 
 @web_app.route("/css/pure-min.css")
 def static_resources(request):  # pylint: disable=unused-argument
-    return static_file("web-ui/pure-min.css", content_type="text/css")
+    return static_file("web-ui/pure-min.css", content_type="text/css", request=request)
 
 
 @web_app.route("/css/styles.css")
 def static_resources(request):  # pylint: disable=unused-argument
-    return static_file("web-ui/styles.css", content_type="text/css")
+    return static_file("web-ui/styles.css", content_type="text/css", request=request)
 
 
 @web_app.route("/css/grids-responsive-min.css")
 def static_resources(request):  # pylint: disable=unused-argument
-    return static_file("web-ui/grids-responsive-min.css", content_type="text/css")
+    return static_file("web-ui/grids-responsive-min.css", content_type="text/css", request=request)
+
+
+@web_app.route("/js/ui.js")
+def static_resources(request):  # pylint: disable=unused-argument
+    return static_file("web-ui/ui.js", content_type="application/javascript", request=request)
 
 
 @web_app.route("/img/github-mark.svg")
 def static_resources(request):  # pylint: disable=unused-argument
-    return static_file("web-ui/img/github-mark.svg", content_type="image/svg+xml")
+    return static_file("web-ui/img/github-mark.svg", content_type="image/svg+xml", request=request)
 
 
 @web_app.route("/img/network.svg")
 def static_resources(request):  # pylint: disable=unused-argument
-    return static_file("web-ui/img/network.svg", content_type="image/svg+xml")
+    return static_file("web-ui/img/network.svg", content_type="image/svg+xml", request=request)
@@ -0,0 +1,8 @@
+# coding: utf-8
+# the tests import the host tools, which put src/ on sys.path themselves
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
@@ -0,0 +1,72 @@
+# coding: utf-8
+import os
+import struct
+
+import host  # noqa: F401  (puts src/ on sys.path)
+from capture import LINKTYPE_ETHERNET, PCAP_MAGIC_US, PcapStreamCapture
+
+PCAP_HEADER = struct.pack('<IHHiIII', PCAP_MAGIC_US, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET)
+
+
+def record(ts_sec, ts_usec, frame):
+    return struct.pack('<IIII', ts_sec, ts_usec, len(frame), len(frame)) + frame
+
+
+class Pipe:
+    # tcpdump -w - into a non-blocking pipe, like host.live reads it
+    def __init__(self, **kwargs):
+        read_fd, self.write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        self.capture = PcapStreamCapture(open(read_fd, 'rb', buffering=0), **kwargs)
+
+    def write(self, data):
+        os.write(self.write_fd, data)
+
+    def close(self):
+        os.close(self.write_fd)
+
+    def burst(self):
+        count = self.capture.next_burst()
+        return [bytes(frame) for frame in self.capture.frames[:count]]
+
+
+def test_frames_arrive_over_partial_writes():
+    pipe = Pipe(ring_size=4, frame_size=100)
+    first, second, oversized, third = b'\x01' * 60, b'\x02' * 70, b'\x03' * 200, b'\x04' * 80
+    stream = PCAP_HEADER + record(10, 500000, first) + record(11, 0, second)
+    oversized_record = record(12, 0, oversized)
+    pipe.write(stream[:10])
+    assert pipe.burst() == []
+    assert not pipe.capture.eof
+    pipe.write(stream[10:24 + 16 + 30])
+    assert pipe.burst() == []
+    assert pipe.capture.burst_bytes == 0
+    pipe.write(stream[24 + 16 + 30:] + oversized_record[:116])
+    assert pipe.burst() == [first, second]
+    assert pipe.capture.timestamps[:2] == [10.5, 11.0]
+    assert pipe.capture.burst_frames == 2
+    assert pipe.capture.burst_bytes == 16 + 60 + 16 + 70 + 116
+    assert pipe.capture.oversized_frames == 1
+    pipe.write(oversized_record[116:] + record(13, 0, third))
+    assert pipe.burst() == [third]
+    assert pipe.capture.burst_bytes == 100 + 16 + 80
+    assert pipe.capture.oversized_frames == 1
+    assert pipe.burst() == []
+    assert not pipe.capture.eof
+    pipe.close()
+    assert pipe.burst() == []
+    assert pipe.capture.eof
+    pipe.capture.stop()
+
+
+def test_a_full_ring_leaves_the_rest_for_the_next_burst():
+    pipe = Pipe(ring_size=2)
+    frames = [bytes([i]) * 64 for i in range(5)]
+    pipe.write(PCAP_HEADER + b''.join(record(i, 0, frame) for i, frame in enumerate(frames)))
+    pipe.close()
+    assert pipe.burst() == frames[:2]
+    assert pipe.capture.remaining_bytes == 3 * (16 + 64)
+    assert pipe.burst() == frames[2:4]
+    assert pipe.burst() == frames[4:]
+    assert pipe.capture.eof
+    pipe.capture.stop()
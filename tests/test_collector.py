@@ -0,0 +1,164 @@
+# coding: utf-8
+import json
+
+from host.collector import Collector, LocalBroker, MqttSource, NodeTopics
+from payload import msgpack_dumps
+
+
+class Harness:
+    # sniffers publish to a LocalBroker, the collector reads them through MqttSource like from a real broker
+    def __init__(self, **kwargs):
+        self.broker = LocalBroker()
+        self.now = 1000.0
+        self.events = []
+        topics = NodeTopics('home/+', exclude=['home/all'])
+        self.source = MqttSource(self.broker.client(), topics.subscription())
+        self.source.start()
+        self.collector = Collector(topics, notify_callback=self._notify, clock=lambda: self.now, **kwargs)
+
+    def _notify(self, device, message):
+        event = json.loads(message)
+        self.events.append((device, event['type'], event['data']['nodes']))
+
+    def event(self, node, device, event_type, since):
+        data = {'appeared_since': since if event_type == 'appeared' else 0, 'disappeared_since': since if event_type == 'disappeared' else 0}
+        self.broker.publish(f"home/{node}/{device}", json.dumps({'type': event_type, 'data': data}))
+
+    def stats(self, node, seq, full, packets_count, flows=(), removed=(), events=None, encoding='json'):
+        payload = {'seq': seq, 'full': full, 'packets_count': packets_count, 'filtered_count': 0, 'sampling_rate': 1,
+                   'packet_types': {'ipv4': packets_count}, 'rates': {'devices': {}, 'packet_types': {}},
+                   'stats': [{'id': flow_id, 'src_mac': flow_id[:2], 'dst_mac': flow_id[3:], 'packets_count': count} for flow_id, count in flows],
+                   'events': events or {}}
+        if removed:
+            payload['removed'] = list(removed)
+        if encoding == 'msgpack':
+            self.broker.publish(f"home/{node}/stats/msgpack", msgpack_dumps(payload))
+        else:
+            self.broker.publish(f"home/{node}/stats", json.dumps(payload))
+
+    def step(self, seconds=1):
+        self.now += seconds
+        self.collector.ingest(self.source.poll(0))
+
+
+def appeared(since):
+    return {'type': 'appeared', 'data': {'appeared_since': since, 'disappeared_since': 0}}
+
+
+def test_presence_across_two_nodes():
+    h = Harness()
+    h.event('a', 'phone', 'appeared', 10)
+    h.step()
+    h.event('b', 'phone', 'appeared', 12)
+    h.step()
+    h.event('a', 'phone', 'disappeared', 20)
+    h.step()
+    assert h.events == [('phone', 'appeared', ['home/a'])]
+    h.event('b', 'phone', 'disappeared', 25)
+    h.step()
+    assert h.events == [('phone', 'appeared', ['home/a']), ('phone', 'disappeared', [])]
+    assert h.collector.tracking['phone']['data']['disappeared_since'] == 25
+
+
+def test_duplicate_events_in_a_batch_are_merged():
+    h = Harness()
+    h.event('a', 'phone', 'appeared', 10)
+    h.event('b', 'phone', 'appeared', 11)
+    h.event('a', 'phone', 'appeared', 10)
+    h.step()
+    assert h.events == [('phone', 'appeared', ['home/a', 'home/b'])]
+
+
+def test_seq_gap_waits_for_the_next_snapshot():
+    h = Harness()
+    h.stats('a', 1, True, 10, flows=[('aa>bb', 10)])
+    h.stats('a', 2, False, 15, flows=[('aa>cc', 5)])
+    h.step()
+    assert h.collector.packets_count == 15
+    assert [flow['id'] for flow in h.collector.top_flows()] == ['aa>bb', 'aa>cc']
+    h.stats('a', 4, False, 99, removed=['aa>bb'])
+    h.step()
+    state = h.collector.nodes['home/a']
+    assert (state.synced, state.gaps, h.collector.packets_count) == (False, 1, 15)
+    h.stats('a', 5, False, 100)
+    h.step()
+    assert h.collector.packets_count == 15
+    h.stats('a', 6, True, 120, flows=[('aa>dd', 120)])
+    h.step()
+    assert state.synced
+    assert h.collector.packets_count == 120
+    assert h.collector.packet_types == {'ipv4': 120}
+    assert [flow['id'] for flow in h.collector.top_flows()] == ['aa>dd']
+
+
+def test_flows_seen_by_several_nodes_count_once():
+    h = Harness()
+    h.stats('a', 1, True, 50, flows=[('aa>bb', 30)])
+    h.stats('b', 1, True, 40, flows=[('aa>bb', 35)], encoding='msgpack')
+    h.step()
+    flows = h.collector.top_flows()
+    assert [(flow['id'], flow['packets_count'], flow['nodes']) for flow in flows] == [('aa>bb', 35, ['home/a', 'home/b'])]
+    assert h.collector.packets_count == 90
+
+
+def test_remove_node_takes_back_its_stats_and_presence():
+    h = Harness()
+    h.stats('a', 1, True, 50, flows=[('aa>bb', 30)], events={'phone': appeared(10)})
+    h.stats('b', 1, True, 40, flows=[('aa>cc', 20)])
+    h.step()
+    assert h.events == [('phone', 'appeared', ['home/a'])]
+    h.collector.remove_node('home/a')
+    assert h.collector.packets_count == 40
+    assert [flow['id'] for flow in h.collector.top_flows()] == ['aa>cc']
+    assert h.events[-1] == ('phone', 'disappeared', [])
+    assert h.collector.tracking['phone']['data']['disappeared_since'] == h.now
+
+
+def test_silent_node_expires():
+    h = Harness(node_timeout=60)
+    h.event('a', 'phone', 'appeared', 10)
+    h.stats('b', 1, True, 5)
+    h.step()
+    for _ in range(3):
+        h.stats('b', 1, True, 5)
+        h.step(30)
+    assert list(h.collector.nodes) == ['home/b']
+    assert h.collector.expired_nodes == 1
+    assert h.events == [('phone', 'appeared', ['home/a']), ('phone', 'disappeared', [])]
+
+
+def test_events_after_a_node_reboot_are_not_dropped():
+    # the board clock starts over, its new events carry smaller timestamps than those before the reboot
+    h = Harness()
+    h.event('a', 'phone', 'appeared', 1000)
+    h.step()
+    h.event('a', 'phone', 'disappeared', 1100)
+    h.step()
+    h.event('a', 'phone', 'appeared', 30)
+    h.step()
+    assert [event[1] for event in h.events] == ['appeared', 'disappeared', 'appeared']
+    assert h.collector.tracking['phone']['data']['appeared_since'] == 30
+
+
+def test_snapshot_after_a_reboot_clears_the_node_sightings():
+    h = Harness()
+    h.stats('a', 7, True, 500, events={'phone': appeared(1000)})
+    h.step()
+    # rebooted: seq starts over and the tracking is empty until the device is seen again
+    h.stats('a', 1, True, 3)
+    h.step()
+    assert h.events == [('phone', 'appeared', ['home/a']), ('phone', 'disappeared', [])]
+    assert h.collector.packets_count == 3
+    assert h.collector.nodes['home/a'].synced
+
+
+def test_output_topic_and_other_messages_are_ignored():
+    h = Harness()
+    h.broker.publish('home/all/phone', json.dumps(appeared(1)))
+    h.broker.publish('home/a/features/phone', '{}')
+    h.broker.publish('home/a/_mqtt_notifier', '{"message": "connected to MQTT broker."}')
+    h.broker.publish('home/a/phone', 'not json')
+    h.broker.publish('office/a/phone', json.dumps(appeared(1)))
+    h.step()
+    assert h.events == []
+    assert h.collector.ignored == 4
@@ -0,0 +1,98 @@
+# coding: utf-8
+import host  # noqa: F401  (puts src/ on sys.path)
+from mapper import Mapper
+from stats import FlowTable, PacketStats
+
+
+def packet(src_mac, dst_mac):
+    return {'type': 'arp', 'eth_proto': 0x806, 'src_mac': src_mac, 'dst_mac': dst_mac, 'src_device': None, 'dst_device': None}
+
+
+def check_buckets(table):
+    # every flow is in the bucket of its count, and the min count is the smallest bucket
+    counts = {}
+    for count, bucket in table._buckets.items():
+        assert bucket
+        for key in bucket:
+            counts[key] = count
+    assert counts == {key: entry['packets_count'] for key, entry in table.entries.items()}
+    assert table._min_count == min(table._buckets)
+
+
+def test_increment_moves_the_flow_to_its_count_bucket():
+    table = FlowTable(3)
+    table.insert('a', {})
+    table.insert('b', {}, weight=4)
+    assert table.increment('c') is None
+    table.increment('a')
+    check_buckets(table)
+    table.increment('a', weight=5)
+    check_buckets(table)
+    assert table._min_count == 4
+    assert table.entries['a']['packets_count'] == 7
+    assert table.total == 11
+
+
+def test_eviction_replaces_the_oldest_smallest_flow():
+    table = FlowTable(3)
+    table.insert('a', {}, weight=2)
+    table.insert('b', {}, weight=2)
+    table.insert('c', {}, weight=5)
+    assert table.insert('d', {}, weight=3) == 'a'
+    check_buckets(table)
+    assert table.entries['d'] == {'packets_count': 5, 'error': 2}
+    assert table.lost_count == 2
+    assert table.insert('e', {}, weight=10) == 'b'
+    check_buckets(table)
+    assert table.entries['e'] == {'packets_count': 12, 'error': 2}
+    assert table._min_count == 5
+    assert table.insert('f', {}, weight=2) == 'c'
+    check_buckets(table)
+    assert table.lost_count == 5
+    assert table.total == 24
+
+
+def test_top_items_only_lists_flows_above_what_was_lost():
+    table = FlowTable(3)
+    table.insert('a', {}, weight=10)
+    table.insert('b', {}, weight=8)
+    table.insert('c', {}, weight=3)
+    table.insert('d', {}, weight=6)
+    # d counts 9 but only 6 are guaranteed, it ranks below b
+    assert table.lost_count == 3
+    assert [key for key, _ in table.top_items()] == ['a', 'b', 'd']
+    table.insert('e', {}, weight=1)
+    # b was evicted with 8, a lost flow may be heavier than d or e
+    assert table.lost_count == 8
+    assert [key for key, _ in table.top_items()] == ['a']
+    assert table.top_items(0) == []
+    table.increment('e', weight=20)
+    assert [key for key, _ in table.top_items()] == ['e', 'a']
+
+
+def test_resize_evicts_the_smallest_flows():
+    table = FlowTable(200)
+    for i in range(200):
+        table.insert(i, {}, weight=1000 + i)
+    table.resize(20)
+    assert len(table) == 20
+    assert table.lost_count == 1179
+    assert [key for key, _ in table.top_items()] == list(range(199, 179, -1))
+    for i in range(200, 1200):
+        if table.increment(i) is None:
+            table.insert(i, {})
+    assert len(table) == 20
+    assert table.capacity == 20
+
+
+def test_lowering_max_flows_frees_the_flows():
+    stats = PacketStats(Mapper({}), max_flows=200)
+    for i in range(200):
+        for _ in range(i + 1):
+            stats.update(packet(i, 0))
+    stats.resize_flows(20)
+    assert len(stats.flows) == 20
+    assert [flow['src_mac'] for flow in stats.top_flows(5)] == [199, 198, 197, 196, 195]
+    for i in range(200, 1200):
+        stats.update(packet(i, 0))
+    assert len(stats.flows) == 20